@@ -1,25 +1,33 @@
 # app.py
-from flask import Flask, render_template, request, jsonify, session, redirect, url_for
+from flask import (Flask, render_template, request, jsonify, session, redirect, url_for,
+                   Response, stream_with_context)
 from jinja2 import TemplateNotFound
-import base64, io, inspect, os, time, secrets
-from PIL import Image
-import numpy as np
-import cv2
+import inspect, json, os, time, secrets, threading
 
 # --- DB helpers ---
-from db import get_users, add_user, get_logs, log_event, update_user_level
+from db import (get_users, add_user, get_logs, log_event, update_user_level, query_logs,
+                auth_stats, LOG_QUERY_MAX_LIMIT, STATS_SCORE_BIN)
 try:
     from db import update_user_image_path   # opcional
 except ImportError:
     update_user_image_path = None
 
 # --- Face helpers ---
-from face_utils import save_face_image, predict_face, train_model, LBPH_THRESHOLD, load_label_map
+from face_utils import (save_face_image, predict_face, add_sample,
+                        backfill_user_samples, detector_for, current_artifact, TRAINER,
+                        LBPH_THRESHOLD, lookup_identity, LIVENESS_FLOW_MODE,
+                        LIVENESS_MIN_FLOW, LIVENESS_DECODE_REDUCE, decode_image,
+                        FrameContext, LivenessStream)
+
+# --- Pool de visão (decode/detecção/fluxo/LBPH fora do thread da requisição) ---
+import vision_pool
+from vision_pool import Busy, analyze_frame, analyze_first_frontal, analyze_burst, predict_frames
 
 app = Flask(__name__)
 app.secret_key = "dev-secret-change-me-stronger-key"  # MUDE EM PRODUÇÃO
 app.config['SESSION_COOKIE_SAMESITE'] = 'Lax'
 app.config['SESSION_COOKIE_SECURE'] = False  # ok para dev local
+app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # rajada de liveness cabe com folga
 
 # ---------------- Config ----------------
 LEVEL_LABELS = {1: "Nível 1 (Geral)", 2: "Nível 2 (Diretoria)", 3: "Nível 3 (Ministro)"}
@@ -29,26 +37,97 @@ ADMIN_PASS = "0000"
 # Requer liveness para login /api/verify
 LIVENESS_REQUIRED = True
 LIVENESS_WINDOW_SEC = 20
+LIVENESS_MAX_GLARE = 0.25    # fração de pixels estourados (tela?)
+LIVENESS_MIN_BLUR = 30.0     # variância do Laplaciano mínima
+LIVE_VERIFY_CANDIDATES = 3   # /api/liveness_verify: frames mais nítidos tentados em busca de rosto frontal
+
+# Liveness em streaming (/api/liveness_stream): decide assim que tiver confiança
+LIVE_STREAM_MIN_FRAMES = 4   # antes disso nunca decide
+LIVE_STREAM_MAX_FRAMES = 12  # mesmo teto do burst; aqui decide com os limiares normais
+LIVE_STREAM_MARGIN = 1.5     # folga sobre os limiares para decidir antes do teto
+LIVE_STREAMS_MAX = 256       # streams abertos por processo (os mais antigos caem)
+
+# Corpo cru aceito como uma única imagem (campos extras vão na query string)
+RAW_IMAGE_MIMETYPES = ("image/jpeg", "image/png", "image/webp", "application/octet-stream")
 
 # ---------------- Utils ----------------
-def b64_to_image(b64data: str):
-    """Converte base64 (dataURL ou cru) para ndarray BGR (OpenCV)."""
-    if "," in b64data:
-        b64data = b64data.split(",", 1)[1]
-    img_bytes = base64.b64decode(b64data)
-    img = Image.open(io.BytesIO(img_bytes)).convert("RGB")
-    return np.array(img)[:, :, ::-1]
-
-def _repredict_once(img):
-    """Treina e tenta predizer 1x novamente (para casos logo após cadastro)."""
+def _read_upload():
+    """
+    (campos, imagens) da requisição, em qualquer dos formatos aceitos pelas
+    rotas de captura:
+      - multipart/form-data: campos no form; arquivo "image" ou vários "frames";
+      - corpo cru image/jpeg|png|webp ou octet-stream: uma imagem; campos na query;
+      - JSON (legado): "image_b64" ou lista "frames" em base64/dataURL.
+    As imagens saem como bytes (binário) ou str (base64); decode_image e
+    decode_frames aceitam os dois, então o binário vai direto ao imdecode.
+    """
+    mimetype = request.mimetype or ""
+    if mimetype == "multipart/form-data":
+        files = request.files.getlist("frames") or request.files.getlist("image")
+        return request.form.to_dict(), [f.read() for f in files]
+    if mimetype in RAW_IMAGE_MIMETYPES:
+        body = request.get_data(cache=False)
+        return request.args.to_dict(), [body] if body else []
+
+    data = request.get_json(force=True) or {}
+    frames = data.get("frames")
+    if not isinstance(frames, list):
+        frames = [data.get("image_b64")]
+    images = [str(f).strip() for f in frames if f]
+    return data, [f for f in images if f]
+
+def _repredict_once(data):
+    """
+    Garante o modelo em dia com o cadastro e analisa o frame 1x novamente (para
+    casos logo após cadastro). Se o modelo já cobre o cadastro atual não há o
+    que refazer e retorna None na hora (o resultado anterior vale); logins que
+    falham ao mesmo tempo compartilham um único rebuild (TRAINER.ensure_current).
+    None também se o rebuild falhou.
+    """
     try:
-        ok = train_model()
-        if ok:
-            time.sleep(0.1)
-            return predict_face(img)
+        fresh = TRAINER.ensure_current()
+        if fresh is None:
+            return None
+        if fresh:
+            return vision_pool.run("verify", analyze_frame, data, detector_for("verify"))
+        log_event(status="api_error", note=f"_repredict_once: {TRAINER.status().get('last_error')}")
+    except Busy:
+        raise
     except Exception as e:
         log_event(status="api_error", note=f"_repredict_once: {e}")
-    return None, None, None
+    return None
+
+def _analyze(data, where: str, group: str = "verify"):
+    """
+    Decodifica e reconhece o frame no pool de visão: (análise, None) ou (None,
+    resposta) — 400 se a imagem não decodifica, 500 se o processamento falhou.
+    Busy (sem vaga) sobe para o handler, que responde 429/503 com Retry-After.
+    """
+    try:
+        return vision_pool.run(group, analyze_frame, data, detector_for("verify")), None
+    except Busy:
+        raise
+    except ValueError as e:
+        log_event(status="api_error", note=f"{where}: decode_image falhou: {e}")
+        return None, (jsonify({"ok": False, "error": "Imagem inválida."}), 400)
+    except Exception as e:
+        log_event(status="api_error", note=f"{where}: predict_face falhou: {e}")
+        return None, (jsonify({"ok": False, "error": "Erro no processamento da imagem."}), 500)
+
+@app.errorhandler(Busy)
+def _vision_busy(e):
+    log_event(status="api_busy", note=f"{request.path}: {e}")
+    resp = jsonify({"ok": False, "error": "Servidor ocupado, tente novamente em instantes.",
+                    "retry_after": e.retry_after})
+    resp.status_code = e.status
+    resp.headers["Retry-After"] = str(e.retry_after)
+    return resp
+
+def _identity(analysis):
+    """(nome, nível) da análise, resolvidos no processo que predisse o label."""
+    if not analysis.get("name"):
+        return "Usuário reconhecido", 1
+    return analysis["name"], int(analysis["level"])
 
 # ---------------- Páginas ----------------
 @app.get("/")
@@ -144,23 +223,15 @@ def api_verify_enroll():
     - Não reconhecido: precisa admin.
     (Liveness AQUI é opcional; geralmente exigimos só no login)
     """
-    data = request.get_json(force=True) or {}
-    img64 = (data.get("image_b64") or "").strip()
-    if not img64:
+    _, images = _read_upload()
+    if not images:
         log_event(status="api_error", note="api_verify_enroll: Imagem não enviada.")
         return jsonify({"ok": False, "error": "Imagem não enviada."}), 400
 
-    try:
-        img = b64_to_image(img64)
-    except Exception as e:
-        log_event(status="api_error", note=f"api_verify_enroll: b64_to_image falhou: {e}")
-        return jsonify({"ok": False, "error": "Imagem inválida."}), 400
-
-    try:
-        label, conf, bbox = predict_face(img)
-    except Exception as e:
-        log_event(status="api_error", note=f"api_verify_enroll: predict_face falhou: {e}")
-        return jsonify({"ok": False, "error": "Erro no processamento da imagem."}), 500
+    analysis, failed = _analyze(images[0], "api_verify_enroll", group="enroll")
+    if failed:
+        return failed
+    label, conf, bbox = analysis["label"], analysis["conf"], analysis["bbox"]
 
     if label is None:
         log_event(status="enroll_gate_failed", note="api_verify_enroll: Rosto não detectado / modelo vazio")
@@ -174,20 +245,11 @@ def api_verify_enroll():
         conf_val, thr_val = 1e9, 70.0
 
     if conf_val <= thr_val:
-        try:
-            lm = load_label_map()
-            name = lm.get(label, "Usuário reconhecido")
-        except Exception:
-            name = "Usuário reconhecido"
-        try:
-            users = get_users()
-            user = next((u for u in users if u.get("name") == name), None)
-            level = int(user.get("level", 1)) if user else 1
-        except Exception:
-            level = 1
+        name, level = _identity(analysis)
 
         level_label = LEVEL_LABELS.get(level, f"Nível {level}")
-        log_event(status="enroll_gate_face", user_name=name, score=float(conf_val), note=level_label)
+        log_event(status="enroll_gate_face", user_name=name, score=float(conf_val), note=level_label,
+                  level=level)
 
         if level == 3:
             session["user_name"] = name
@@ -219,16 +281,15 @@ def admin_login():
 # ---------------- Cadastro ----------------
 @app.post("/api/enroll")
 def api_enroll():
-    data = request.get_json(force=True)
-    name = data.get("name", "").strip()
+    data, images = _read_upload()
+    name = (data.get("name") or "").strip()
     try:
         level = int(data.get("level", 1))
     except ValueError:
         level = 1
         log_event(status="api_error", note=f"api_enroll: Nível inválido ({data.get('level')})")
 
-    img64 = data.get("image_b64")
-    if not name or not img64:
+    if not name or not images:
         log_event(status="api_error", note="api_enroll: nome/imagem ausentes")
         return jsonify({"ok": False, "error": "Nome e imagem são obrigatórios."}), 400
 
@@ -237,18 +298,29 @@ def api_enroll():
                   note="api_enroll: sem permissão")
         return jsonify({"ok": False, "error": "Somente Nível 3 ou Admin podem cadastrar/editar."}), 403
 
-    img = b64_to_image(img64)
+    # grava amostra e atualiza o modelo deste processo: roda aqui, mas ocupa
+    # vaga do grupo "enroll" para não tomar o pool do login
+    with vision_pool.slot("enroll"):
+        return _enroll(name, level, images[0])
+
+def _enroll(name: str, level: int, data):
+    try:
+        # o mesmo contexto vai para predição e gravação: o rosto é detectado 1x
+        img = FrameContext(decode_image(data))
+    except Exception as e:
+        log_event(status="api_error", note=f"api_enroll: decode_image falhou: {e}")
+        return jsonify({"ok": False, "error": "Imagem inválida."}), 400
 
     # tenta reconhecer para atualizar
     label, conf, bbox = None, None, None
     try:
-        label, conf, bbox = predict_face(img)
+        label, conf, bbox = predict_face(img, detector=detector_for("enroll"))
     except Exception as e:
         log_event(status="api_error", note=f"api_enroll: predict_face: {e}")
 
     if label is not None and conf is not None and float(conf) <= float(LBPH_THRESHOLD):
-        lm = load_label_map()
-        current_name = lm.get(label)
+        ident = lookup_identity(label)
+        current_name = ident["name"] if ident else None
         if current_name:
             updated_level_flag = False
             try:
@@ -259,7 +331,7 @@ def api_enroll():
 
             saved_sample_flag = False
             try:
-                path_rel_update = save_face_image(current_name, img, level)
+                path_rel_update = save_face_image(current_name, img, level, detector=detector_for("enroll"))
                 if path_rel_update:
                     saved_sample_flag = True
                     if callable(update_user_image_path):
@@ -272,12 +344,11 @@ def api_enroll():
                 log_event(status="api_error", user_name=current_name,
                           note=f"api_enroll: salvar amostra: {e}")
 
-            try:
-                ok = train_model()
-                if ok:
-                    time.sleep(0.15)
-            except Exception as e:
-                log_event(status="api_error", note=f"api_enroll: treinar após update: {e}")
+            if saved_sample_flag:
+                try:
+                    add_sample(current_name, path_rel_update)
+                except Exception as e:
+                    log_event(status="api_error", note=f"api_enroll: adicionar amostra ao modelo: {e}")
 
             log_event(status="enroll_update_level", user_name=current_name,
                       note=f"Nível->{level}; update_level={updated_level_flag}; nova_amostra={saved_sample_flag}")
@@ -288,7 +359,7 @@ def api_enroll():
             })
 
     # novo cadastro
-    path_rel = save_face_image(name, img, level)
+    path_rel = save_face_image(name, img, level, detector=detector_for("enroll"))
     if not path_rel:
         log_event(status="enroll_failed", user_name=name, note="Rosto não detectado")
         return jsonify({"ok": False, "error": "Rosto não detectado na imagem."}), 200
@@ -304,11 +375,9 @@ def api_enroll():
         return jsonify({"ok": False, "error": f"Falha ao salvar no DB: {e}"}), 500
 
     try:
-        ok = train_model()
-        if ok:
-            time.sleep(0.15)  # flush para o próximo predict já ver o modelo novo
+        add_sample(name, path_rel)  # incremental; o modelo vivo já enxerga a amostra
     except Exception as e:
-        log_event(status="api_error", note=f"api_enroll: treinar após novo cadastro: {e}")
+        log_event(status="api_error", note=f"api_enroll: adicionar amostra ao modelo: {e}")
 
     log_event(status="enroll_ok", user_name=name, note=f"Novo usuário nível {level}")
     return jsonify({"ok": True, "note": "Novo usuário cadastrado com sucesso."})
@@ -326,144 +395,129 @@ def liveness_challenge():
 
     return jsonify({"ok": True, "nonce": nonce, "actions": list(actions)})
 
-def _b64_to_bgr(b64data: str):
-    if "," in b64data:
-        b64data = b64data.split(",", 1)[1]
-    img_bytes = base64.b64decode(b64data)
-    img = Image.open(io.BytesIO(img_bytes)).convert("RGB")
-    return np.array(img)[:, :, ::-1]
-
-def _optical_flow_score(frames_bgr):
-    if len(frames_bgr) < 3: return 0.0
-    mags = []
-    prev = cv2.cvtColor(frames_bgr[0], cv2.COLOR_BGR2GRAY)
-    for i in range(1, len(frames_bgr)):
-        nxt = cv2.cvtColor(frames_bgr[i], cv2.COLOR_BGR2GRAY)
-        flow = cv2.calcOpticalFlowFarneback(prev, nxt, None, 0.5, 3, 15, 3, 5, 1.2, 0)
-        mag, _ = cv2.cartToPolar(flow[...,0], flow[...,1])
-        mags.append(float(np.median(mag)))
-        prev = nxt
-    return float(np.mean(mags)) if mags else 0.0
-
-def _glare_ratio(bgr):
-    gray = cv2.cvtColor(bgr, cv2.COLOR_BGR2GRAY)
-    return float((gray > 245).mean())
-
-def _blur_score(bgr):
-    gray = cv2.cvtColor(bgr, cv2.COLOR_BGR2GRAY)
-    return float(cv2.Laplacian(gray, cv2.CV_64F).var())
-
-@app.post("/api/liveness_complete")
-def liveness_complete():
-    data = request.get_json(force=True)
+def _liveness_burst(data, frames_in):
+    """
+    Nonce/janela do desafio + movimento, brilho e nitidez do burst. Se aprovado,
+    marca a sessão e retorna ([(nitidez, índice em frames_in)], None); senão
+    (None, resposta).
+    """
     client_nonce = data.get("nonce", "")
-    frames_b64 = data.get("frames", [])
 
     # 1) validação do nonce/janela
     if client_nonce != session.get("live_nonce"):
-        return jsonify({"ok": False, "error": "nonce inválido"}), 400
+        return None, (jsonify({"ok": False, "error": "nonce inválido"}), 400)
     if (time.time() - session.get("live_issued_at", 0)) > LIVENESS_WINDOW_SEC:
-        return jsonify({"ok": False, "error": "desafio expirado"}), 400
-
-    # 2) frames -> movimento
-    frames_bgr = []
-    for b64 in frames_b64[:12]:
-        try:
-            frames_bgr.append(_b64_to_bgr(b64))
-        except Exception:
-            pass
-    if len(frames_bgr) < 3:
-        return jsonify({"ok": False, "error": "frames insuficientes"}), 400
+        return None, (jsonify({"ok": False, "error": "desafio expirado"}), 400)
 
-    flow = _optical_flow_score(frames_bgr)
-    mid = frames_bgr[len(frames_bgr)//2]
-    glare = _glare_ratio(mid)
-    blurv = _blur_score(mid)
+    # 2) frames -> movimento (decode em cinza + fluxo no pool de visão)
+    m = vision_pool.run("liveness", analyze_burst, frames_in[:12], LIVENESS_DECODE_REDUCE)
+    if m["frames"] < 3:
+        return None, (jsonify({"ok": False, "error": "frames insuficientes"}), 400)
+    flow, glare, blurv = m["flow"], m["glare"], m["blur"]    # modo em LIVENESS_FLOW_MODE
 
-    MIN_FLOW, MAX_GLARE, MIN_BLUR_V = 0.50, 0.25, 30.0
+    MIN_FLOW = LIVENESS_MIN_FLOW.get(LIVENESS_FLOW_MODE, 0.50)
     if flow < MIN_FLOW:
-        return jsonify({"ok": False, "error": "pouca variação temporal"}), 200
-    if glare > MAX_GLARE:
-        return jsonify({"ok": False, "error": "brilho/saturação excessivos (tela?)"}), 200
-    if blurv < MIN_BLUR_V:
-        return jsonify({"ok": False, "error": "imagem artificial/desfocada"}), 200
+        return None, (jsonify({"ok": False, "error": "pouca variação temporal"}), 200)
+    if glare > LIVENESS_MAX_GLARE:
+        return None, (jsonify({"ok": False, "error": "brilho/saturação excessivos (tela?)"}), 200)
+    if blurv < LIVENESS_MIN_BLUR:
+        return None, (jsonify({"ok": False, "error": "imagem artificial/desfocada"}), 200)
 
     session["live_ok"] = True
     session["live_valid_until"] = time.time() + LIVENESS_WINDOW_SEC
+    return m["sharpness"], None
+
+@app.post("/api/liveness_complete")
+def liveness_complete():
+    data, frames_in = _read_upload()
+    _, failed = _liveness_burst(data, frames_in)
+    if failed:
+        return failed
     return jsonify({"ok": True})
 
 # ---------------- Login ----------------
-@app.post("/api/verify")
-def api_verify():
-    """
-    Autenticação facial (login):
-    - Se LIVENESS_REQUIRED=True: bloqueia com 409 quando faltando/expirado (NÃO consome aqui).
-    - Predição LBPH; se falhar, re-treina e tenta 1x.
-    - Heurísticas anti-foto simples.
-    - Consome o token de liveness APÓS sucesso.
-    """
-    # Liveness obrigatório?
-    if LIVENESS_REQUIRED:
-        import time as _time
-        live_ok = bool(session.get("live_ok", False))
-        live_until = float(session.get("live_valid_until", 0))
-        if not (live_ok and _time.time() <= live_until):
-            log_event(status="auth_blocked", note="api_verify: liveness ausente/expirado")
-            return jsonify({
-                "ok": False,
-                "error": "Faça a verificação de vivacidade antes do login.",
-                "require_liveness": True
-            }), 409
+MAX_BATCH_FRAMES = 8
 
-    data = request.get_json(force=True) or {}
-    img64 = (data.get("image_b64") or "").strip()
-    if not img64:
-        log_event(status="api_error", note="api_verify: Imagem não enviada.")
-        return jsonify({"ok": False, "error": "Imagem não enviada."}), 400
+def _login_ok(analysis, conf_val, bbox, **extra):
+    """Abre a sessão do usuário reconhecido e monta a resposta de sucesso."""
+    name, level = _identity(analysis)
 
-    # Converte imagem
-    try:
-        img = b64_to_image(img64)
-    except Exception as e:
-        log_event(status="api_error", note=f"api_verify: b64_to_image falhou: {e}")
-        return jsonify({"ok": False, "error": "Imagem inválida."}), 400
+    level_label = LEVEL_LABELS.get(level, f"Nível {level}")
+    session["user_name"] = name
+    session["user_level"] = level
 
-    # 1ª predição
+    # Consome o token de liveness SOMENTE após sucesso
     try:
-        label, conf, bbox = predict_face(img)
-    except Exception as e:
-        log_event(status="api_error", note=f"api_verify: predict_face falhou: {e}")
-        return jsonify({"ok": False, "error": "Erro no processamento da imagem."}), 500
+        session["live_ok"] = False
+    except Exception:
+        pass
+
+    log_event(status="auth_ok", user_name=name, score=float(conf_val), note=level_label, level=level)
+    return jsonify({
+        "ok": True,
+        "match": True,
+        "name": name,
+        "level": level,
+        "level_label": level_label,
+        "distance": float(conf_val),
+        "bbox": bbox,
+        "redirect": url_for("overview"),
+        **extra
+    }), 200
+
+def _liveness_blocked(where: str):
+    """Resposta 409 se o liveness é obrigatório e está ausente/expirado; senão None."""
+    if not LIVENESS_REQUIRED:
+        return None
+    live_ok = bool(session.get("live_ok", False))
+    live_until = float(session.get("live_valid_until", 0))
+    if live_ok and time.time() <= live_until:
+        return None
+    log_event(status="auth_blocked", note=f"{where}: liveness ausente/expirado")
+    return jsonify({
+        "ok": False,
+        "error": "Faça a verificação de vivacidade antes do login.",
+        "require_liveness": True
+    }), 409
+
+def _verify_frame(data, analysis, where: str, **extra):
+    """
+    Decisão de login sobre a análise de um frame (analyze_frame) já liberado
+    pelo liveness: repredict, heurísticas anti-foto, limiar; abre a sessão se
+    casar. 'data' é o frame original (para o repredict). 'extra' vai em todas
+    as respostas (ex.: resultado do liveness no endpoint combinado).
+    """
+    label, conf, bbox = analysis["label"], analysis["conf"], analysis["bbox"]
 
     # Sem rosto/modelo: tenta re-treinar e prever 1x
     if label is None:
-        log_event(status="auth_warn", note="api_verify: label=None; tentando repredict")
-        label, conf, bbox = _repredict_once(img)
+        log_event(status="auth_warn", note=f"{where}: label=None; tentando repredict")
+        again = _repredict_once(data)
+        if again is not None:
+            analysis = again
+            label, conf, bbox = analysis["label"], analysis["conf"], analysis["bbox"]
         if label is None:
             return jsonify({"ok": True, "match": False,
                             "reason": "Rosto não detectado ou modelo vazio",
-                            "bbox": bbox}), 200
+                            "bbox": bbox, **extra}), 200
 
     # Heurísticas anti-foto
     try:
-        H, W = img.shape[:2]
+        H, W = analysis["shape"]
         if bbox:
             x, y, w, h = bbox
             area_ratio = (w * h) / float(W * H + 1e-6)
             if area_ratio < 0.04 or area_ratio > 0.75:
-                log_event(status="auth_failed", note=f"api_verify: área rosto fora do esperado ({area_ratio:.3f})")
+                log_event(status="auth_failed", note=f"{where}: área rosto fora do esperado ({area_ratio:.3f})")
                 return jsonify({"ok": True, "match": False,
                                 "reason": "Rosto fora do enquadramento esperado",
-                                "bbox": bbox}), 200
-            gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
-            roi = gray[max(0,y):y+h, max(0,x):x+w]
-            if roi.size > 0:
-                lap = cv2.Laplacian(roi, cv2.CV_64F).var()
-                if lap < 25:
-                    log_event(status="auth_failed", note=f"api_verify: nitidez muito baixa (Laplacian={lap:.1f})")
-                    return jsonify({"ok": True, "match": False,
-                                    "reason": "Imagem muito borrada/estática",
-                                    "bbox": bbox}), 200
+                                "bbox": bbox, **extra}), 200
+            lap = analysis["face_blur"]    # calculado no pool, sobre o mesmo cinza da detecção
+            if lap is not None and lap < 25:
+                log_event(status="auth_failed", note=f"{where}: nitidez muito baixa (Laplacian={lap:.1f})")
+                return jsonify({"ok": True, "match": False,
+                                "reason": "Imagem muito borrada/estática",
+                                "bbox": bbox, **extra}), 200
     except Exception:
         pass
 
@@ -476,81 +530,358 @@ def api_verify():
 
     # Se acima do limiar, tenta repredict final
     if conf_val > thr_val:
-        log_event(status="auth_warn", note=f"api_verify: acima do threshold ({conf_val:.2f}>{thr_val:.2f}); repredict")
-        label2, conf2, bbox2 = _repredict_once(img)
-        if label2 is not None:
-            label, conf, bbox = label2, conf2, (bbox2 or bbox)
+        log_event(status="auth_warn", note=f"{where}: acima do threshold ({conf_val:.2f}>{thr_val:.2f}); repredict")
+        again = _repredict_once(data)
+        if again is not None and again["label"] is not None:
+            analysis = again
+            label, conf, bbox = again["label"], again["conf"], (again["bbox"] or bbox)
             try:
                 conf_val = float(conf) if conf is not None else conf_val
             except Exception:
                 pass
 
     if conf_val <= thr_val:
-        try:
-            lm = load_label_map()
-            name = lm.get(label, "Usuário reconhecido")
-        except Exception:
-            name = "Usuário reconhecido"
+        return _login_ok(analysis, conf_val, bbox, **extra)
 
-        try:
-            users = get_users()
-            user = next((u for u in users if u.get("name") == name), None)
-            level = int(user.get("level", 1)) if user else 1
-        except Exception:
-            level = 1
+    log_event(status="auth_failed", score=float(conf_val),
+              note=f"{where}: Conf acima do threshold (após repredict)")
+    return jsonify({"ok": True, "match": False, "reason": "Sem correspondência", "bbox": bbox, **extra}), 200
 
-        level_label = LEVEL_LABELS.get(level, f"Nível {level}")
-        session["user_name"] = name
-        session["user_level"] = level
+@app.post("/api/verify")
+def api_verify():
+    """
+    Autenticação facial (login):
+    - Se LIVENESS_REQUIRED=True: bloqueia com 409 quando faltando/expirado (NÃO consome aqui).
+    - Predição LBPH; se falhar, re-treina e tenta 1x.
+    - Heurísticas anti-foto simples.
+    - Consome o token de liveness APÓS sucesso.
+    """
+    # Liveness obrigatório?
+    blocked = _liveness_blocked("api_verify")
+    if blocked:
+        return blocked
 
-        # Consome o token de liveness SOMENTE após sucesso
+    _, images = _read_upload()
+    if not images:
+        log_event(status="api_error", note="api_verify: Imagem não enviada.")
+        return jsonify({"ok": False, "error": "Imagem não enviada."}), 400
+
+    # Decodifica + 1ª predição (pool de visão)
+    analysis, failed = _analyze(images[0], "api_verify")
+    if failed:
+        return failed
+    return _verify_frame(images[0], analysis, "api_verify")
+
+@app.post("/api/liveness_verify")
+def liveness_verify():
+    """
+    Login num só envio: o mesmo burst do /api/liveness_complete (nonce + frames).
+    Se o liveness passa, reconhece o frame mais nítido (variância do Laplaciano
+    já calculada pelo liveness) em que o detector frontal de "verify" acha o
+    rosto, tentando até LIVE_VERIFY_CANDIDATES frames, e responde liveness e
+    identidade juntos, sem o /api/verify e sem decodificar outro frame.
+    """
+    data, frames_in = _read_upload()
+    sharpness, failed = _liveness_burst(data, frames_in)
+    if failed:
+        return failed
+    return _verify_sharpest([(b, i, frames_in[i]) for b, i in sharpness], "api_liveness_verify")
+
+def _verify_sharpest(candidates, where: str, **extra):
+    """
+    Reconhece o frame mais nítido em que o detector frontal de "verify" acha o
+    rosto, tentando até LIVE_VERIFY_CANDIDATES (decodificados na resolução
+    cheia, no pool). 'candidates' = [(nitidez, índice, dados do frame)].
+    """
+    ranked = sorted(candidates, key=lambda c: c[0], reverse=True)[:LIVE_VERIFY_CANDIDATES]
+    try:
+        analysis = vision_pool.run("verify", analyze_first_frontal,
+                                   [(i, d) for _, i, d in ranked], detector_for("verify"))
+    except Busy:
+        raise
+    except Exception as e:
+        log_event(status="api_error", note=f"{where}: predict_face falhou: {e}")
+        return jsonify({"ok": False, "error": "Erro no processamento da imagem."}), 500
+    if analysis is None:
+        log_event(status="auth_failed", note=f"{where}: nenhum frame frontal no burst")
+        return jsonify({"ok": True, "liveness": True, "match": False,
+                        "reason": "Rosto não detectado", "bbox": None, **extra}), 200
+    i = analysis["frame"]
+    data = next(d for _, j, d in ranked if j == i)
+    return _verify_frame(data, analysis, where, liveness=True, frame=i, **extra)
+
+# ---------------- Liveness em streaming ----------------
+class _LiveStream:
+    """Liveness em andamento de um nonce (só neste processo): métricas + frames candidatos."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.motion = LivenessStream(scale=LIVENESS_DECODE_REDUCE)
+        self.best = []      # [(nitidez, seq, bytes)] dos LIVE_VERIFY_CANDIDATES mais nítidos
+
+    def keep(self, sharpness, seq, data):
+        self.best.append((sharpness, seq, data))
+        self.best.sort(key=lambda c: c[0], reverse=True)
+        del self.best[LIVE_VERIFY_CANDIDATES:]
+
+_LIVE_STREAMS = {}
+_LIVE_STREAMS_LOCK = threading.Lock()
+
+def _live_stream(nonce: str, seq: int):
+    """
+    Estado do stream do nonce. seq=0 abre um novo; para seq>0 devolve None se
+    o estado não está neste processo (expirou, ou o frame anterior foi para
+    outro worker).
+    """
+    now = time.time()
+    with _LIVE_STREAMS_LOCK:
+        for key in [k for k, st in _LIVE_STREAMS.items() if now - st.started > LIVENESS_WINDOW_SEC]:
+            del _LIVE_STREAMS[key]
+        if seq == 0:
+            while len(_LIVE_STREAMS) >= LIVE_STREAMS_MAX:
+                del _LIVE_STREAMS[min(_LIVE_STREAMS, key=lambda k: _LIVE_STREAMS[k].started)]
+            _LIVE_STREAMS[nonce] = _LiveStream()
+        return _LIVE_STREAMS.get(nonce)
+
+def _stream_decision(motion):
+    """
+    None enquanto não dá para decidir; senão (aprovado, erro). Antes do teto de
+    frames só decide com LIVE_STREAM_MARGIN de folga sobre os limiares; no
+    teto aplica os mesmos limiares (e mensagens) do burst.
+    """
+    if motion.frames < LIVE_STREAM_MIN_FRAMES:
+        return None
+    min_flow = LIVENESS_MIN_FLOW.get(LIVENESS_FLOW_MODE, 0.50)
+    flow, glare, blurv = motion.flow, motion.glare_ratio, motion.blur_score
+
+    if motion.frames >= LIVE_STREAM_MAX_FRAMES:
+        if flow < min_flow:
+            return False, "pouca variação temporal"
+        if glare > LIVENESS_MAX_GLARE:
+            return False, "brilho/saturação excessivos (tela?)"
+        if blurv < LIVENESS_MIN_BLUR:
+            return False, "imagem artificial/desfocada"
+        return True, None
+
+    k = LIVE_STREAM_MARGIN
+    if glare > LIVENESS_MAX_GLARE * k:
+        return False, "brilho/saturação excessivos (tela?)"
+    if blurv < LIVENESS_MIN_BLUR / k:
+        return False, "imagem artificial/desfocada"
+    if flow >= min_flow * k and glare <= LIVENESS_MAX_GLARE and blurv >= LIVENESS_MIN_BLUR:
+        return True, None
+    return None
+
+@app.post("/api/liveness_stream")
+def liveness_stream():
+    """
+    Liveness com um frame por requisição (JPEG cru, multipart "image" ou JSON
+    image_b64), com 'nonce' e 'seq' (0, 1, 2, …) na query/form. Movimento,
+    brilho e nitidez são atualizados a cada frame e o servidor responde
+    {"done": true, ...} assim que decide (muitas vezes com 4–5 frames); até lá
+    {"ok": true, "done": false}. Só o frame anterior e os candidatos a
+    reconhecimento ficam em memória. Com verify=1 a aprovação já traz a
+    identidade, como /api/liveness_verify.
+    Se o estado do stream não está neste processo (vários workers sem sessão
+    fixa) responde 409 com "fallback": o cliente reenvia o burst inteiro.
+    """
+    data, images = _read_upload()
+    nonce = data.get("nonce", "")
+    if nonce != session.get("live_nonce"):
+        return jsonify({"ok": False, "done": True, "error": "nonce inválido"}), 400
+    if (time.time() - session.get("live_issued_at", 0)) > LIVENESS_WINDOW_SEC:
+        return jsonify({"ok": False, "done": True, "error": "desafio expirado"}), 400
+    try:
+        seq = int(data.get("seq", 0))
+    except (TypeError, ValueError):
+        return jsonify({"ok": False, "done": True, "error": "seq inválido"}), 400
+    if not images:
+        return jsonify({"ok": False, "done": True, "error": "frame não enviado"}), 400
+
+    st = _live_stream(nonce, seq)
+    if st is None:
+        return jsonify({"ok": False, "done": False, "fallback": True,
+                        "error": "stream desconhecido"}), 409
+    # estado do stream mora neste processo: o trabalho fica aqui, mas ocupa vaga
+    with vision_pool.slot("liveness"), st.lock:
+        if seq != st.motion.frames:
+            with _LIVE_STREAMS_LOCK:
+                _LIVE_STREAMS.pop(nonce, None)
+            return jsonify({"ok": False, "done": False, "fallback": True,
+                            "error": "frame fora de ordem"}), 409
         try:
-            session["live_ok"] = False
+            gray = decode_image(images[0], gray=True, reduce=LIVENESS_DECODE_REDUCE)
         except Exception:
-            pass
-
-        log_event(status="auth_ok", user_name=name, score=float(conf_val), note=level_label)
-        return jsonify({
-            "ok": True,
-            "match": True,
-            "name": name,
-            "level": level,
-            "level_label": level_label,
-            "distance": float(conf_val),
-            "bbox": bbox,
-            "redirect": url_for("overview")
-        }), 200
+            return jsonify({"ok": False, "done": False, "error": "frame inválido"}), 400
+        ctx = st.motion.push(gray)
+        st.keep(ctx.blur_score(), seq, images[0])
+        decided = _stream_decision(st.motion)
+        if decided is None:
+            return jsonify({"ok": True, "done": False, "frames": st.motion.frames})
+
+    with _LIVE_STREAMS_LOCK:
+        _LIVE_STREAMS.pop(nonce, None)
+    passed, error = decided
+    if not passed:
+        return jsonify({"ok": False, "done": True, "error": error, "frames": st.motion.frames}), 200
 
-    log_event(status="auth_failed", score=float(conf_val),
-              note="api_verify: Conf acima do threshold (após repredict)")
-    return jsonify({"ok": True, "match": False, "reason": "Sem correspondência", "bbox": bbox}), 200
+    session["live_ok"] = True
+    session["live_valid_until"] = time.time() + LIVENESS_WINDOW_SEC
+    if str(data.get("verify", "")).lower() not in ("1", "true"):
+        return jsonify({"ok": True, "done": True, "frames": st.motion.frames})
+    return _verify_sharpest(st.best, "api_liveness_stream", done=True, frames=st.motion.frames)
+
+@app.post("/api/verify_batch")
+def api_verify_batch():
+    """
+    Login com vários frames candidatos num só envio (quiosques):
+    - Mesmo gate de liveness e mesmo limiar do /api/verify.
+    - Reconhece todos os frames em lote (predict_faces) e usa o de menor distância,
+      com as mesmas heurísticas anti-foto do /api/verify (_verify_frame).
+    - Devolve também o resultado de cada frame.
+    """
+    blocked = _liveness_blocked("api_verify_batch")
+    if blocked:
+        return blocked
+
+    _, frames_in = _read_upload()
+    if not frames_in:
+        log_event(status="api_error", note="api_verify_batch: frames não enviados.")
+        return jsonify({"ok": False, "error": "Frames não enviados."}), 400
+
+    try:
+        results = vision_pool.run("verify_batch", predict_frames, frames_in[:MAX_BATCH_FRAMES],
+                                  detector_for("verify_batch"))
+    except Busy:
+        raise
+    except Exception as e:
+        log_event(status="api_error", note=f"api_verify_batch: predict_faces falhou: {e}")
+        return jsonify({"ok": False, "error": "Erro no processamento da imagem."}), 500
+    if results is None:
+        log_event(status="api_error", note="api_verify_batch: nenhum frame válido.")
+        return jsonify({"ok": False, "error": "Imagens inválidas."}), 400
+
+    # "frame" = índice no envio (frames que não decodificam ficam de fora)
+    per_frame = [{"frame": r["frame"], "label": r["label"], "distance": r["conf"], "bbox": r["bbox"]}
+                 for r in results]
+    scored = [(r["conf"], k) for k, r in enumerate(results) if r["label"] is not None]
+    if not scored:
+        return jsonify({"ok": True, "match": False, "reason": "Rosto não detectado ou modelo vazio",
+                        "frames": per_frame}), 200
+
+    # o frame escolhido passa pelas mesmas heurísticas/limiar do /api/verify
+    best = min(scored)[1]
+    chosen = results[best]
+    return _verify_frame(frames_in[chosen["frame"]], chosen, "api_verify_batch",
+                         frame_index=chosen["frame"], frames=per_frame)
 
 # ---------------- Diagnóstico ----------------
 @app.get("/api/model_status")
 def model_status():
-    from face_utils import MODEL_PATH, LABELS_PATH
     users = get_users()
-    exists_model = os.path.exists(MODEL_PATH)
-    exists_labels = os.path.exists(LABELS_PATH)
+    art = current_artifact()
+    exists_model = bool(art and os.path.exists(art["model"]))
+    # no formato binário o mapa de labels vai dentro do próprio modelo
+    exists_labels = bool(art) and (os.path.exists(art["labels"]) if art["labels"] else exists_model)
+    training = TRAINER.status()
     return jsonify({
         "ok": True,
         "users_count": len(users),
         "model_exists": exists_model,
         "labels_exists": exists_labels,
+        "model_version": training["version"] if training["version"] is not None else (art or {}).get("version"),
+        "model_built_at": (art or {}).get("built_at"),
+        "model_format": (art or {}).get("format"),
+        "queue_depth": training["queue_depth"],
+        "training": training,
+        "vision": vision_pool.stats(),
         "threshold": float(LBPH_THRESHOLD)
     })
 
 @app.post("/api/retrain")
 def api_retrain():
+    """
+    Rebuild completo do modelo a partir de users.json (manutenção).
+    Enfileira no worker e responde 202; com ?wait=1 espera o build terminar.
+    """
     try:
-        ok = train_model()
-        if ok:
-            time.sleep(0.15)
-        return jsonify({"ok": bool(ok)})
+        backfill_user_samples()  # capturas antigas em faces/ entram no treino
+        ticket = TRAINER.submit("rebuild")
+        if request.args.get("wait") in ("1", "true"):
+            ok = TRAINER.wait(ticket)
+            return jsonify({"ok": bool(ok), "training": TRAINER.status()})
+        return jsonify({"ok": True, "queued": True, "training": TRAINER.status()}), 202
     except Exception as e:
         log_event(status="api_error", note=f"api_retrain: {e}")
         return jsonify({"ok": False, "error": str(e)}), 500
 
+# ---------------- Auditoria ----------------
+@app.get("/api/logs")
+def api_logs():
+    """
+    Consulta paginada do log de auditoria (admin ou Nível 3).
+    Query: since, until, status (vírgulas p/ vários), user_name, cursor, limit, order.
+    A resposta sai em streaming: os itens são escritos conforme lidos do índice.
+    """
+    if not (session.get("admin_ok") or session.get("user_level") == 3):
+        log_event(status="access_denied", user_name=session.get("user_name"),
+                  note="api_logs sem admin/Nível 3")
+        return jsonify({"ok": False, "error": "Acesso restrito"}), 403
+    args = request.args
+    try:
+        cursor = int(args["cursor"]) if args.get("cursor") else None
+        limit = max(1, min(int(args.get("limit", 100)), LOG_QUERY_MAX_LIMIT))
+    except ValueError:
+        return jsonify({"ok": False, "error": "cursor/limit inválidos"}), 400
+    order = "asc" if args.get("order", "desc").lower() == "asc" else "desc"
+    status = [s for s in args.get("status", "").split(",") if s.strip()] or None
+    rows = query_logs(since=args.get("since"), until=args.get("until"), status=status,
+                      user_name=args.get("user_name") or None, cursor=cursor,
+                      limit=limit, order=order)
+
+    def generate():
+        yield '{"ok": true, "items": ['
+        n, last = 0, None
+        for row in rows:
+            yield ("," if n else "") + json.dumps(row, ensure_ascii=False)
+            n, last = n + 1, row["id"]
+        # página cheia => pode haver mais; o cursor é o id do último item
+        nxt = str(last) if last is not None and n >= limit else None
+        yield '], "count": %d, "next_cursor": %s}' % (n, json.dumps(nxt))
+
+    return Response(stream_with_context(generate()), mimetype="application/json")
+
+@app.get("/api/stats")
+def api_stats():
+    """
+    Painel de autenticação (admin ou Nível 3): contagens e distribuição de
+    score por bucket/status/nível, lidas dos contadores incrementais.
+    Query: granularity=minute|hour, since, until, status (vírgulas p/ vários).
+    """
+    if not (session.get("admin_ok") or session.get("user_level") == 3):
+        log_event(status="access_denied", user_name=session.get("user_name"),
+                  note="api_stats sem admin/Nível 3")
+        return jsonify({"ok": False, "error": "Acesso restrito"}), 403
+    args = request.args
+    gran = args.get("granularity", "hour")
+    status = [s for s in args.get("status", "").split(",") if s.strip()] or None
+    try:
+        buckets = auth_stats(gran, since=args.get("since"), until=args.get("until"), status=status)
+    except ValueError as e:
+        return jsonify({"ok": False, "error": str(e)}), 400
+    totals = {}
+    for b in buckets:
+        t = totals.setdefault(b["status"], {"count": 0, "scored": 0, "score_sum": 0.0})
+        t["count"] += b["count"]
+        t["scored"] += b["scored"]
+        t["score_sum"] += (b["mean_score"] or 0.0) * b["scored"]
+    for t in totals.values():
+        score_sum = t.pop("score_sum")
+        t["mean_score"] = score_sum / t["scored"] if t["scored"] else None
+    return jsonify({"ok": True, "granularity": gran, "threshold": float(LBPH_THRESHOLD),
+                    "bin_width": STATS_SCORE_BIN, "totals": totals, "buckets": buckets})
+
 # ---------------- Sessão ----------------
 @app.get("/logout")
 def logout():
@@ -561,4 +892,5 @@ def logout():
 # ---------------- Main ----------------
 if __name__ == "__main__":
     # Para HTTPS em rede local, gere certs e use ssl_context
+    vision_pool.start()
     app.run(host="127.0.0.1", port=5000, debug=True, use_reloader=False)
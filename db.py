@@ -1,12 +1,34 @@
 # db.py
+import atexit
+import copy
 import json
+import logging
+import math
+import os
+import re
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
 from pathlib import Path
 from datetime import datetime
 from typing import Optional, Dict, Any, List
 
+from storage import ChangeWatcher, FileLock, atomic_write_json, file_signature
+
+logger = logging.getLogger(__name__)
+
 DB_PATH = Path(__file__).with_name("users.json")
 LOG_PATH = Path(__file__).with_name("logs.json")
 
+# Backend de usuários: "sqlite" (database.db) ou "json" (users.json, legado).
+# No primeiro uso do SQLite o users.json é importado uma única vez.
+USERS_BACKEND = "sqlite"
+SQLITE_PATH = Path(__file__).with_name("database.db")
+SQLITE_TIMEOUT = 10.0     # s esperando o lock de escrita de outro worker
+
+_USERS_FILE_LOCK = FileLock(DB_PATH)
+
 
 def _now() -> str:
     return datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S")
@@ -28,69 +50,373 @@ def _read_json(path: Path) -> Any:
 
 
 def _write_json(path: Path, data: Any) -> None:
-    # Grava de forma simples e consistente
-    path.write_text(json.dumps(data, ensure_ascii=False, indent=2), encoding="utf-8")
+    # temporário + os.replace: outro worker nunca lê o arquivo pela metade
+    atomic_write_json(path, data, indent=2)
 
 
 def _norm_name(name: str) -> str:
     return (name or "").strip().lower()
 
 
+# ---------- backend SQLite ----------
+# Tabelas novas no database.db; as antigas 'users'/'logs' do protótipo ficam
+# intactas (têm nomes repetidos e caminhos do Windows). O nome normalizado tem
+# índice único, então busca e upsert são O(log n) e dois registros "iguais"
+# não coexistem. Os SQL são constantes com parâmetros "?": o sqlite3 guarda o
+# statement preparado no cache da conexão e reaproveita a cada chamada.
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS user_accounts (
+    id         INTEGER PRIMARY KEY AUTOINCREMENT,
+    name       TEXT NOT NULL,
+    name_norm  TEXT NOT NULL,
+    level      INTEGER NOT NULL DEFAULT 1,
+    image_path TEXT NOT NULL DEFAULT ''
+);
+CREATE UNIQUE INDEX IF NOT EXISTS ux_user_accounts_name_norm ON user_accounts(name_norm);
+CREATE TABLE IF NOT EXISTS user_account_samples (
+    id      INTEGER PRIMARY KEY AUTOINCREMENT,
+    user_id INTEGER NOT NULL REFERENCES user_accounts(id) ON DELETE CASCADE,
+    path    TEXT NOT NULL,
+    UNIQUE (user_id, path)
+);
+CREATE TABLE IF NOT EXISTS user_meta (key TEXT PRIMARY KEY, value INTEGER NOT NULL);
+INSERT OR IGNORE INTO user_meta (key, value) VALUES ('rev', 0);
+CREATE TRIGGER IF NOT EXISTS tr_user_accounts_ins AFTER INSERT ON user_accounts
+BEGIN UPDATE user_meta SET value = value + 1 WHERE key = 'rev'; END;
+CREATE TRIGGER IF NOT EXISTS tr_user_accounts_upd AFTER UPDATE ON user_accounts
+BEGIN UPDATE user_meta SET value = value + 1 WHERE key = 'rev'; END;
+CREATE TRIGGER IF NOT EXISTS tr_user_accounts_del AFTER DELETE ON user_accounts
+BEGIN UPDATE user_meta SET value = value + 1 WHERE key = 'rev'; END;
+CREATE TRIGGER IF NOT EXISTS tr_user_account_samples_ins AFTER INSERT ON user_account_samples
+BEGIN UPDATE user_meta SET value = value + 1 WHERE key = 'rev'; END;
+CREATE TRIGGER IF NOT EXISTS tr_user_account_samples_del AFTER DELETE ON user_account_samples
+BEGIN UPDATE user_meta SET value = value + 1 WHERE key = 'rev'; END;
+"""
+
+_SQL_REV = "SELECT value FROM user_meta WHERE key = 'rev'"
+_SQL_ALL_USERS = "SELECT id, name, level, image_path FROM user_accounts ORDER BY id"
+_SQL_ALL_SAMPLES = "SELECT user_id, path FROM user_account_samples ORDER BY id"
+_SQL_BY_NAME = "SELECT id, name, level, image_path FROM user_accounts WHERE name_norm = ?"
+_SQL_SAMPLES_OF = "SELECT path FROM user_account_samples WHERE user_id = ? ORDER BY id"
+_SQL_INSERT_USER = "INSERT INTO user_accounts (name, name_norm, level, image_path) VALUES (?, ?, ?, ?)"
+_SQL_INSERT_SAMPLE = "INSERT OR IGNORE INTO user_account_samples (user_id, path) VALUES (?, ?)"
+_SQL_SET_LEVEL = "UPDATE user_accounts SET level = ? WHERE id = ? AND level <> ?"
+_SQL_SET_IMAGE = "UPDATE user_accounts SET image_path = ? WHERE id = ? AND image_path <> ?"
+
+
+class _SqliteStore:
+    """
+    Uma conexão por thread (sqlite3 não compartilha conexão entre threads).
+    WAL deixa leituras seguirem durante uma escrita; BEGIN IMMEDIATE pega o
+    lock de escrita logo no início, então dois workers do gunicorn gravando
+    ao mesmo tempo serializam em vez de um sobrescrever o outro.
+    """
+    schema = ""
+
+    def __init__(self, path: Path):
+        self.path = Path(path)
+        self._local = threading.local()
+        self._init_lock = threading.Lock()
+        self._ready = False
+
+    def conn(self) -> sqlite3.Connection:
+        c = getattr(self._local, "conn", None)
+        if c is None:
+            # isolation_level=None: transações só onde abrimos explicitamente
+            c = sqlite3.connect(str(self.path), timeout=SQLITE_TIMEOUT, isolation_level=None)
+            c.execute("PRAGMA journal_mode=WAL")
+            c.execute("PRAGMA synchronous=NORMAL")
+            c.execute("PRAGMA foreign_keys=ON")
+            self._local.conn = c
+            with self._init_lock:
+                if not self._ready:
+                    c.executescript(self.schema)
+                    self._ready = True
+                    self._on_ready()
+        return c
+
+    def _on_ready(self) -> None:
+        """Roda uma vez por processo, logo após criar o schema."""
+
+    @contextmanager
+    def tx(self):
+        c = self.conn()
+        c.execute("BEGIN IMMEDIATE")
+        try:
+            yield c
+        except BaseException:
+            c.execute("ROLLBACK")
+            raise
+        c.execute("COMMIT")
+
+
+class _SqliteUsers(_SqliteStore):
+    schema = _SCHEMA
+
+    # ----- leitura -----
+
+    def rev(self) -> int:
+        row = self.conn().execute(_SQL_REV).fetchone()
+        return int(row[0]) if row else 0
+
+    def all(self) -> List[Dict[str, Any]]:
+        c = self.conn()
+        users, by_id = [], {}
+        for uid, name, level, image_path in c.execute(_SQL_ALL_USERS):
+            u = {"name": name, "level": int(level), "image_path": image_path, "samples": []}
+            by_id[uid] = u
+            users.append(u)
+        for uid, path in c.execute(_SQL_ALL_SAMPLES):
+            if uid in by_id:
+                by_id[uid]["samples"].append(path)
+        return users
+
+    def _row(self, c: sqlite3.Connection, norm: str):
+        return c.execute(_SQL_BY_NAME, (norm,)).fetchone()
+
+    def by_name(self, name: str) -> Optional[Dict[str, Any]]:
+        c = self.conn()
+        row = self._row(c, _norm_name(name))
+        if row is None:
+            return None
+        uid, nm, level, image_path = row
+        samples = [p for (p,) in c.execute(_SQL_SAMPLES_OF, (uid,))]
+        return {"name": nm, "level": int(level), "image_path": image_path, "samples": samples}
+
+    # ----- escrita (cada método é uma transação) -----
+
+    @staticmethod
+    def _upsert(c: sqlite3.Connection, name: str, level, paths: List[str],
+                current: Optional[str], row=None) -> bool:
+        """
+        Núcleo do upsert: cria o usuário ou atualiza level (se dado), acrescenta
+        'paths' às amostras e, se 'current' vier, torna-o o image_path atual.
+        """
+        name = str(name or "").strip()
+        norm = _norm_name(name)
+        paths = [p for p in (str(p or "").strip() for p in paths) if p]
+        current = str(current or "").strip()
+        if current and current not in paths:
+            paths.append(current)
+        changed = False
+        if row is None:
+            row = c.execute(_SQL_BY_NAME, (norm,)).fetchone()
+        if row is None:
+            uid = c.execute(_SQL_INSERT_USER, (name, norm, int(level or 1), current)).lastrowid
+            changed = True
+        else:
+            uid = row[0]
+            if level is not None:
+                new_level = int(level or row[2])
+                changed |= c.execute(_SQL_SET_LEVEL, (new_level, uid, new_level)).rowcount > 0
+            if current:
+                changed |= c.execute(_SQL_SET_IMAGE, (current, uid, current)).rowcount > 0
+        for p in paths:
+            changed |= c.execute(_SQL_INSERT_SAMPLE, (uid, p)).rowcount > 0
+        return changed
+
+    def upsert(self, name: str, level, image_path: str) -> bool:
+        with self.tx() as c:
+            return self._upsert(c, name, level, [], image_path)
+
+    def set_level(self, name: str, new_level: int) -> bool:
+        with self.tx() as c:
+            row = self._row(c, _norm_name(name))
+            if row is None:
+                return False
+            return c.execute(_SQL_SET_LEVEL, (int(new_level), row[0], int(new_level))).rowcount > 0
+
+    def add_samples(self, name: str, paths: List[str], current: Optional[str] = None) -> bool:
+        """Só para usuários existentes (como no backend JSON)."""
+        with self.tx() as c:
+            row = self._row(c, _norm_name(name))
+            if row is None:
+                return False
+            return self._upsert(c, row[1], None, paths, current, row=row)
+
+    def replace_all(self, users: List[Dict[str, Any]]) -> None:
+        """save_users(): troca o conteúdo inteiro numa transação só."""
+        with self.tx() as c:
+            c.execute("DELETE FROM user_account_samples")
+            c.execute("DELETE FROM user_accounts")
+            self._import(c, users)
+
+    # ----- migração -----
+
+    @classmethod
+    def _import(cls, c: sqlite3.Connection, users) -> int:
+        """Registros no formato do users.json; nomes repetidos são fundidos."""
+        n = 0
+        for u in users if isinstance(users, list) else []:
+            if not isinstance(u, dict) or not str(u.get("name", "")).strip():
+                continue
+            samples = user_samples(u)
+            current = str(u.get("image_path", "")).strip() or (samples[-1] if samples else "")
+            if cls._upsert(c, u["name"], u.get("level", 1), samples, current):
+                n += 1
+        return n
+
+    def _on_ready(self) -> None:
+        # importação única do users.json
+        c = self._local.conn
+        with self.tx():
+            done = c.execute("SELECT value FROM user_meta WHERE key = 'json_migrated'").fetchone()
+            if done is not None:
+                return
+            empty = c.execute("SELECT 1 FROM user_accounts LIMIT 1").fetchone() is None
+            if empty:
+                self._import(c, _read_json(DB_PATH))
+            c.execute("INSERT INTO user_meta (key, value) VALUES ('json_migrated', 1)")
+
+    def migrate(self, json_path: Path) -> int:
+        with self.tx() as c:
+            return self._import(c, _read_json(Path(json_path)))
+
+
+_SQL = _SqliteUsers(SQLITE_PATH)
+
+
+def migrate_users_json(json_path: Optional[Path] = None) -> int:
+    """
+    Importa um users.json para o SQLite (upsert por nome, amostras somadas).
+    Roda sozinho uma vez no primeiro uso; chamar de novo é idempotente.
+    Retorna quantos usuários foram criados/alterados.
+    """
+    return _SQL.migrate(json_path or DB_PATH)
+
+
+# ---------- cache de usuários ----------
+# A lista completa é recarregada só quando muda. JSON: assinatura (mtime,
+# tamanho, inode) do arquivo, que pega as trocas atômicas feitas por outros
+# processos; o cache local soma o contador de gravações deste processo.
+# SQLite: contador 'rev' mantido por triggers, visto por todos.
+
+_users_lock = threading.Lock()
+_users_rev = 0
+_users_cache: Dict[str, Any] = {"stamp": None, "users": [], "by_name": {}}
+
+
+def users_stamp() -> tuple:
+    """
+    Muda sempre que os usuários mudam; barato (um stat ou uma leitura
+    indexada). Igual em todos os processos (vai para current.json), por isso
+    não inclui nada local ao processo.
+    """
+    if USERS_BACKEND == "sqlite":
+        return ("sqlite", _SQL.rev())
+    return ("json", file_signature(DB_PATH))
+
+
+def _users_index() -> Dict[str, Any]:
+    stamp = (_users_rev, users_stamp())
+    with _users_lock:
+        if _users_cache["stamp"] != stamp:
+            if USERS_BACKEND == "sqlite":
+                users = _SQL.all()
+            else:
+                data = _read_json(DB_PATH)
+                users = data if isinstance(data, list) else []
+            _users_cache["users"] = users
+            _users_cache["by_name"] = {_norm_name(u.get("name", "")): u for u in users}
+            _users_cache["stamp"] = stamp
+        return _users_cache
+
+
 # ---------- API de usuários ----------
 
 def get_users() -> List[Dict[str, Any]]:
-    data = _read_json(DB_PATH)
-    return data if isinstance(data, list) else []
+    # cópia: quem chama pode alterar e gravar sem sujar o cache
+    return copy.deepcopy(_users_index()["users"])
 
 
 def save_users(users: List[Dict[str, Any]]) -> None:
-    _write_json(DB_PATH, users)
+    global _users_rev
+    if USERS_BACKEND == "sqlite":
+        _SQL.replace_all(users)
+        return
+    with _USERS_FILE_LOCK:
+        _write_json(DB_PATH, users)
+    with _users_lock:
+        _users_rev += 1
+
+
+def user_samples(u: Dict[str, Any]) -> List[str]:
+    """
+    Caminhos de todas as amostras do usuário. Registros antigos só têm
+    'image_path'; nos novos ele aponta para a amostra mais recente de 'samples'.
+    """
+    samples = [str(p).strip() for p in (u.get("samples") or []) if str(p).strip()]
+    ip = str(u.get("image_path", "")).strip()
+    if ip and ip not in samples:
+        samples.append(ip)
+    return samples
+
+
+def _add_sample(u: Dict[str, Any], path: str) -> bool:
+    """Acrescenta 'path' às amostras de 'u' e o torna o image_path atual."""
+    path = str(path or "").strip()
+    if not path:
+        return False
+    samples = user_samples(u)
+    changed = path not in samples or u.get("samples") != samples
+    if path not in samples:
+        samples.append(path)
+    u["samples"] = samples
+    if str(u.get("image_path", "")).strip() != path:
+        u["image_path"] = path
+        changed = True
+    return changed
 
 
 def get_user_by_name(name: str) -> Optional[Dict[str, Any]]:
-    target = _norm_name(name)
-    for u in get_users():
-        if _norm_name(u.get("name", "")) == target:
-            return u
-    return None
+    """Busca por nome (case-insensitive): índice único no SQLite, dict em memória no JSON."""
+    if USERS_BACKEND == "sqlite":
+        return _SQL.by_name(name)
+    u = _users_index()["by_name"].get(_norm_name(name))
+    return copy.deepcopy(u) if u is not None else None
 
 
 def set_user(name: str, level: int, image_path: str) -> bool:
     """
     Upsert por 'name' (case-insensitive).
-    Se existir, atualiza level e image_path (se fornecidos).
+    Se existir, atualiza level e acrescenta image_path às amostras (se fornecidos).
     Se não existir, cria.
     Retorna True se houve mudança em disco.
     """
-    users = get_users()
-    target = _norm_name(name)
-    changed = False
-    found = False
-
-    for u in users:
-        if _norm_name(u.get("name", "")) == target:
-            found = True
-            # atualiza somente se diferente
-            new_level = int(level or u.get("level", 1))
-            new_path = (image_path or u.get("image_path", "")).strip()
-            if int(u.get("level", 1)) != new_level:
-                u["level"] = new_level
-                changed = True
-            if new_path and str(u.get("image_path", "")).strip() != new_path:
-                u["image_path"] = new_path
-                changed = True
-            break
-
-    if not found:
-        users.append({
-            "name": str(name).strip(),
-            "level": int(level or 1),
-            "image_path": str(image_path or "").strip()
-        })
-        changed = True
-
-    if changed:
-        save_users(users)
+    if USERS_BACKEND == "sqlite":
+        return _SQL.upsert(name, level, image_path)
+    # lock entre processos: ler-alterar-gravar sem perder a gravação de outro worker
+    with _USERS_FILE_LOCK:
+        users = get_users()
+        target = _norm_name(name)
+        changed = False
+        found = False
+
+        for u in users:
+            if _norm_name(u.get("name", "")) == target:
+                found = True
+                # atualiza somente se diferente
+                new_level = int(level or u.get("level", 1))
+                if int(u.get("level", 1)) != new_level:
+                    u["level"] = new_level
+                    changed = True
+                if _add_sample(u, image_path):
+                    changed = True
+                break
+
+        if not found:
+            path = str(image_path or "").strip()
+            users.append({
+                "name": str(name).strip(),
+                "level": int(level or 1),
+                "image_path": path,
+                "samples": [path] if path else []
+            })
+            changed = True
+
+        if changed:
+            save_users(users)
     return changed
 
 
@@ -115,50 +441,531 @@ def add_user(name_or_dict, level=None, image_path=None) -> bool:
 
 def update_user_level(name: str, new_level: int) -> bool:
     """Atualiza o nível por nome (case-insensitive). Retorna True se mudou algo."""
-    users = get_users()
-    target = _norm_name(name)
-    changed = False
-    for u in users:
-        if _norm_name(u.get("name", "")) == target:
-            if int(u.get("level", 1)) != int(new_level):
-                u["level"] = int(new_level)
-                changed = True
-            break
-    if changed:
-        save_users(users)
+    if USERS_BACKEND == "sqlite":
+        return _SQL.set_level(name, new_level)
+    with _USERS_FILE_LOCK:
+        users = get_users()
+        target = _norm_name(name)
+        changed = False
+        for u in users:
+            if _norm_name(u.get("name", "")) == target:
+                if int(u.get("level", 1)) != int(new_level):
+                    u["level"] = int(new_level)
+                    changed = True
+                break
+        if changed:
+            save_users(users)
     return changed
 
 
 def update_user_image_path(name: str, new_rel_path: str) -> bool:
-    """Atualiza image_path do usuário (por nome). Retorna True se mudou algo."""
-    users = get_users()
-    target = _norm_name(name)
-    changed = False
-    for u in users:
-        if _norm_name(u.get("name", "")) == target:
-            if str(u.get("image_path", "")).strip() != str(new_rel_path).strip():
-                u["image_path"] = str(new_rel_path).strip()
-                changed = True
-            break
-    if changed:
-        save_users(users)
+    """
+    Registra nova amostra do usuário (por nome): entra em 'samples' sem
+    descartar as anteriores e vira o image_path atual. Retorna True se mudou algo.
+    """
+    if USERS_BACKEND == "sqlite":
+        return _SQL.add_samples(name, [], current=new_rel_path)
+    with _USERS_FILE_LOCK:
+        users = get_users()
+        target = _norm_name(name)
+        changed = False
+        for u in users:
+            if _norm_name(u.get("name", "")) == target:
+                changed = _add_sample(u, new_rel_path)
+                break
+        if changed:
+            save_users(users)
+    return changed
+
+
+def merge_user_samples(name: str, paths: List[str]) -> bool:
+    """Acrescenta várias amostras de uma vez (sem mudar o image_path atual)."""
+    if USERS_BACKEND == "sqlite":
+        return _SQL.add_samples(name, paths)
+    with _USERS_FILE_LOCK:
+        users = get_users()
+        target = _norm_name(name)
+        changed = False
+        for u in users:
+            if _norm_name(u.get("name", "")) == target:
+                samples = user_samples(u)
+                for p in paths:
+                    p = str(p or "").strip()
+                    if p and p not in samples:
+                        samples.append(p)
+                if u.get("samples") != samples:
+                    u["samples"] = samples
+                    changed = True
+                break
+        if changed:
+            save_users(users)
     return changed
 
 
 # ---------- logs ----------
+# Log de auditoria append-only em JSON Lines (um evento por linha). log_event só
+# enfileira em memória: um thread grava em lote quando a fila passa de
+# LOG_FLUSH_EVENTS ou a cada LOG_FLUSH_SEC, então o custo na requisição é
+# constante, independente do tamanho do histórico. Ao passar de LOG_MAX_BYTES o
+# arquivo gira (logs.jsonl -> logs.jsonl.1 -> ...), guardando LOG_BACKUPS
+# antigos. O logs.json antigo continua sendo lido como o trecho mais velho.
+
+LOG_JSONL_PATH = Path(__file__).with_name("logs.jsonl")
+LOG_FLUSH_EVENTS = 256
+LOG_FLUSH_SEC = 1.0
+LOG_MAX_BYTES = 5 * 1024 * 1024
+LOG_BACKUPS = 5
 
-def get_logs() -> List[Dict[str, Any]]:
-    data = _read_json(LOG_PATH)
-    return data if isinstance(data, list) else []
 
+def _log_segments() -> List[Path]:
+    """Arquivos JSONL do mais antigo ao mais novo."""
+    olds = [LOG_JSONL_PATH.with_name(f"{LOG_JSONL_PATH.name}.{i}") for i in range(LOG_BACKUPS, 0, -1)]
+    return [p for p in olds if p.exists()] + [LOG_JSONL_PATH]
 
-def log_event(status: str, user_name: Optional[str] = None, score: Optional[float] = None, note: Optional[str] = None) -> None:
-    logs = get_logs()
-    logs.append({
+
+def _read_jsonl(path: Path) -> List[Dict[str, Any]]:
+    out = []
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    out.append(json.loads(line))
+                except ValueError:
+                    continue   # linha cortada (queda no meio da gravação)
+    except OSError:
+        pass
+    return out
+
+
+class _LogWriter:
+    def __init__(self, path: Path):
+        self.path = Path(path)
+        self._cond = threading.Condition()
+        self._queue: List[Dict[str, Any]] = []
+        # gravação + rotação; também entre processos, senão um worker gira o
+        # arquivo enquanto outro ainda acrescenta no antigo
+        self._write_lock = FileLock(self.path)
+        self._thread: Optional[threading.Thread] = None
+
+    def _ensure_thread(self) -> None:
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = threading.Thread(target=self._run, name="audit-log", daemon=True)
+            self._thread.start()
+
+    def put(self, event: Dict[str, Any]) -> None:
+        with self._cond:
+            self._queue.append(event)
+            self._ensure_thread()
+            if len(self._queue) >= LOG_FLUSH_EVENTS:
+                self._cond.notify()
+
+    def pending(self) -> List[Dict[str, Any]]:
+        with self._cond:
+            return list(self._queue)
+
+    def _run(self) -> None:
+        while True:
+            with self._cond:
+                if len(self._queue) < LOG_FLUSH_EVENTS:
+                    self._cond.wait(LOG_FLUSH_SEC)
+                idle = not self._queue
+            # fila vazia: nem toca no FileLock (cada acordada em cada worker abriria o arquivo)
+            if not idle:
+                try:
+                    self.flush()
+                except Exception:
+                    logger.exception("falha ao gravar o log de auditoria")
+            try:
+                _STATS.maybe_persist()
+            except Exception:
+                logger.exception("falha ao gravar as estatísticas")
+
+    def flush(self) -> None:
+        # _write_lock antes de esvaziar a fila: um get_logs() concorrente vê o
+        # lote ou em pending() ou no arquivo, nunca em nenhum dos dois
+        with self._write_lock:
+            with self._cond:
+                batch, self._queue = self._queue, []
+            if not batch:
+                return
+            data = "".join(json.dumps(e, ensure_ascii=False) + "\n" for e in batch).encode("utf-8")
+            # índice antes do arquivo: quem cria o índice importa o que já está
+            # em disco, e nada chega ao arquivo sem antes ter passado por aqui
+            try:
+                _LOG_INDEX.add(batch)
+            except sqlite3.Error:
+                logger.exception("falha ao indexar o log de auditoria")
+            self._maybe_rotate(len(data))
+            # uma única write() em modo append: lotes de processos diferentes
+            # não se intercalam no meio de uma linha
+            with open(self.path, "ab") as f:
+                f.write(data)
+
+    def _maybe_rotate(self, incoming: int) -> None:
+        try:
+            size = self.path.stat().st_size
+        except OSError:
+            return
+        if size == 0 or size + incoming <= LOG_MAX_BYTES:
+            return
+        for i in range(LOG_BACKUPS - 1, 0, -1):
+            src = self.path.with_name(f"{self.path.name}.{i}")
+            if src.exists():
+                os.replace(src, self.path.with_name(f"{self.path.name}.{i + 1}"))
+        if LOG_BACKUPS > 0:
+            os.replace(self.path, self.path.with_name(f"{self.path.name}.1"))
+        else:
+            self.path.unlink()
+
+
+# ----- índice de consulta -----
+# Cópia indexada dos eventos no database.db, para filtrar por período,
+# status e usuário sem ler o histórico inteiro. Índices de uma coluna numa
+# tabela rowid já vêm ordenados por (coluna, id), então "status = ? AND
+# id < cursor ORDER BY id DESC" percorre só a fatia pedida. Eventos ainda na
+# fila (até LOG_FLUSH_SEC) só aparecem aqui depois de gravados.
+
+LOG_QUERY_MAX_LIMIT = 1000
+
+_LOG_SCHEMA = """
+CREATE TABLE IF NOT EXISTS audit_events (
+    id        INTEGER PRIMARY KEY AUTOINCREMENT,
+    ts        TEXT NOT NULL,
+    status    TEXT NOT NULL,
+    user_name TEXT,
+    score     REAL,
+    note      TEXT
+);
+CREATE INDEX IF NOT EXISTS ix_audit_events_ts ON audit_events(ts);
+CREATE INDEX IF NOT EXISTS ix_audit_events_status ON audit_events(status);
+CREATE INDEX IF NOT EXISTS ix_audit_events_user ON audit_events(user_name);
+CREATE TABLE IF NOT EXISTS audit_meta (key TEXT PRIMARY KEY, value INTEGER NOT NULL);
+"""
+
+_SQL_INSERT_EVENT = "INSERT INTO audit_events (ts, status, user_name, score, note) VALUES (?, ?, ?, ?, ?)"
+
+
+def _event_row(e: Dict[str, Any]) -> tuple:
+    score = e.get("score")
+    return (str(e.get("ts") or ""), str(e.get("status") or ""), e.get("user_name"),
+            float(score) if isinstance(score, (int, float)) else None,
+            None if e.get("note") is None else str(e.get("note")))
+
+
+def _norm_ts(ts: Optional[str]) -> Optional[str]:
+    """Aceita 'YYYY-MM-DD', 'YYYY-MM-DD HH:MM:SS' ou ISO com 'T' (formato de _now())."""
+    if ts is None or not str(ts).strip():
+        return None
+    return str(ts).strip().replace("T", " ").rstrip("Z")[:19]
+
+
+class _LogIndex(_SqliteStore):
+    schema = _LOG_SCHEMA
+
+    def _on_ready(self) -> None:
+        # importação única do logs.json legado + segmentos JSONL existentes
+        c = self._local.conn
+        with self.tx():
+            if c.execute("SELECT 1 FROM audit_meta WHERE key = 'backfilled'").fetchone():
+                return
+            legacy = _read_json(LOG_PATH)
+            events = legacy if isinstance(legacy, list) else []
+            for seg in _log_segments():
+                events.extend(_read_jsonl(seg))
+            c.executemany(_SQL_INSERT_EVENT, (_event_row(e) for e in events if isinstance(e, dict)))
+            c.execute("INSERT INTO audit_meta (key, value) VALUES ('backfilled', 1)")
+
+    def add(self, events: List[Dict[str, Any]]) -> None:
+        with self.tx() as c:
+            c.executemany(_SQL_INSERT_EVENT, (_event_row(e) for e in events))
+
+    def query(self, since=None, until=None, status=None, user_name=None,
+              cursor=None, limit=100, order="desc"):
+        where, args = [], []
+        since, until = _norm_ts(since), _norm_ts(until)
+        if since:
+            where.append("ts >= ?"); args.append(since)
+        if until:
+            where.append("ts < ?"); args.append(until)
+        if status:
+            statuses = [status] if isinstance(status, str) else list(status)
+            where.append("status IN (%s)" % ",".join("?" * len(statuses))); args.extend(statuses)
+        if user_name:
+            where.append("user_name = ?"); args.append(user_name)
+        desc = str(order).lower() != "asc"
+        if cursor is not None:
+            where.append("id < ?" if desc else "id > ?"); args.append(int(cursor))
+        sql = ("SELECT id, ts, status, user_name, score, note FROM audit_events"
+               + (" WHERE " + " AND ".join(where) if where else "")
+               + (" ORDER BY id DESC" if desc else " ORDER BY id ASC") + " LIMIT ?")
+        args.append(max(1, min(int(limit), LOG_QUERY_MAX_LIMIT)))
+        # o cursor do sqlite3 busca as linhas sob demanda
+        for row in self.conn().execute(sql, args):
+            yield dict(zip(("id", "ts", "status", "user_name", "score", "note"), row))
+
+
+# ----- estatísticas de autenticação -----
+# Contadores e histogramas de score por (minuto|hora, status, nível),
+# atualizados a cada log_event; o painel lê O(buckets), sem varrer o log.
+# Em memória ficam a base (último stats.json lido) e o delta ainda não gravado;
+# a gravação relê o arquivo, soma o delta e troca atomicamente, então vários
+# processos somam suas contagens em vez de sobrescrever. Sem stats.json, a
+# primeira carga reconstrói tudo a partir do histórico de logs.
+
+STATS_PATH = Path(__file__).with_name("stats.json")
+STATS_PERSIST_SEC = 30.0
+STATS_KEEP = {"minute": 180, "hour": 24 * 30}   # buckets mantidos por granularidade
+STATS_SCORE_BIN = 5.0
+STATS_SCORE_MAX = 200.0                          # última faixa acumula o que passar disso
+
+_STATS_PREFIX = {"minute": 16, "hour": 13}       # 'YYYY-MM-DD HH:MM' / 'YYYY-MM-DD HH'
+_LEVEL_RE = re.compile(r"N[ií]vel\s*(\d)")
+
+
+def _stats_nbins() -> int:
+    return int(math.ceil(STATS_SCORE_MAX / STATS_SCORE_BIN)) + 1
+
+
+def _event_level(e: Dict[str, Any]) -> Optional[int]:
+    """Nível explícito ou, nos eventos antigos, o 'Nível N' gravado na nota."""
+    lv = e.get("level")
+    if lv is None and e.get("status") in ("auth_ok", "enroll_gate_face"):
+        m = _LEVEL_RE.search(str(e.get("note") or ""))
+        lv = m.group(1) if m else None
+    try:
+        return int(lv) if lv is not None else None
+    except (TypeError, ValueError):
+        return None
+
+
+def _new_cell() -> Dict[str, Any]:
+    return {"n": 0, "scored": 0, "sum": 0.0, "hist": [0] * _stats_nbins()}
+
+
+def _merge_cell(dst: Dict[str, Any], src: Dict[str, Any]) -> None:
+    dst["n"] += src["n"]
+    dst["scored"] += src["scored"]
+    dst["sum"] += src["sum"]
+    dst["hist"] = [a + b for a, b in zip(dst["hist"], src["hist"])]
+
+
+def _merge_tree(dst: Dict[str, Any], src: Dict[str, Any]) -> None:
+    """{gran: {bucket: {"status|nível": cell}}} somado em 'dst'."""
+    for gran, buckets in src.items():
+        dg = dst.setdefault(gran, {})
+        for bucket, cells in buckets.items():
+            db_ = dg.setdefault(bucket, {})
+            for key, cell in cells.items():
+                if key in db_:
+                    _merge_cell(db_[key], cell)
+                else:
+                    db_[key] = copy.deepcopy(cell)
+
+
+class _AuthStats:
+    def __init__(self, path: Path):
+        self.path = Path(path)
+        self._lock = threading.RLock()
+        self._base: Optional[Dict[str, Any]] = None
+        self._delta: Dict[str, Any] = {}
+        self._last_persist = time.monotonic()
+        self._file_lock = FileLock(self.path)   # ler-somar-gravar entre processos
+        self._watch = ChangeWatcher(self.path)  # gravações de outros processos
+
+    def _read_file(self) -> Optional[Dict[str, Any]]:
+        data = _read_json(self.path) if self.path.exists() else None
+        if (not isinstance(data, dict) or data.get("bin") != STATS_SCORE_BIN
+                or data.get("max") != STATS_SCORE_MAX):
+            return None   # ausente ou com outras faixas: reconstrói
+        return {g: data.get(g) or {} for g in _STATS_PREFIX}
+
+    def _ensure_loaded(self) -> None:
+        if self._base is not None:
+            return
+        base = self._read_file()
+        if base is None:
+            # sem arquivo: reconstrói do histórico uma vez só, sob o lock do
+            # arquivo, e grava já; quem chegar depois lê o arquivo pronto em vez
+            # de reprocessar o histórico no próprio delta (contaria em dobro)
+            with self._file_lock:
+                base = self._read_file()
+                if base is None:
+                    base = {}
+                    for e in get_logs():
+                        if isinstance(e, dict):
+                            self._add(base, e, _event_level(e))
+                    self._prune(base)
+                    self._write(base)
+        self._watch.mark()
+        self._base = base
+
+    def _write(self, tree: Dict[str, Any]) -> None:
+        out = {"bin": STATS_SCORE_BIN, "max": STATS_SCORE_MAX, "updated_at": _now()}
+        out.update({g: tree.get(g) or {} for g in _STATS_PREFIX})
+        atomic_write_json(self.path, out)
+
+    @staticmethod
+    def _add(tree: Dict[str, Any], e: Dict[str, Any], level: Optional[int]) -> None:
+        ts = str(e.get("ts") or "")
+        if not ts:
+            return
+        key = f"{e.get('status')}|{'-' if level is None else level}"
+        score = e.get("score")
+        for gran, k in _STATS_PREFIX.items():
+            cell = tree.setdefault(gran, {}).setdefault(ts[:k], {}).get(key)
+            if cell is None:
+                cell = tree[gran][ts[:k]][key] = _new_cell()
+            cell["n"] += 1
+            if isinstance(score, (int, float)):
+                cell["scored"] += 1
+                cell["sum"] += float(score)
+                b = min(int(max(float(score), 0.0) // STATS_SCORE_BIN), len(cell["hist"]) - 1)
+                cell["hist"][b] += 1
+
+    def record(self, e: Dict[str, Any], level: Optional[int]) -> None:
+        with self._lock:
+            self._ensure_loaded()
+            self._add(self._delta, e, level)
+
+    @staticmethod
+    def _prune(tree: Dict[str, Any]) -> None:
+        for gran, keep in STATS_KEEP.items():
+            buckets = tree.get(gran) or {}
+            for old in sorted(buckets)[:-keep] if len(buckets) > keep else []:
+                del buckets[old]
+
+    def persist(self) -> None:
+        with self._lock:
+            if self._base is None and not self._delta:
+                return      # nada registrado neste processo (ex.: worker do pool de visão)
+        with self._lock, self._file_lock:
+            self._ensure_loaded()
+            delta, self._delta = self._delta, {}
+            try:
+                merged = self._read_file() or {}
+                _merge_tree(merged, delta)
+                self._prune(merged)
+                self._write(merged)
+            except Exception:
+                _merge_tree(self._delta, delta)   # não perde o delta
+                raise
+            self._watch.mark()
+            self._base = merged
+            self._last_persist = time.monotonic()
+
+    def maybe_persist(self) -> None:
+        if self._delta and time.monotonic() - self._last_persist >= STATS_PERSIST_SEC:
+            self.persist()
+
+    def cells(self, granularity: str, since: Optional[str], until: Optional[str],
+              statuses: Optional[List[str]]) -> Dict[str, Dict[str, Any]]:
+        """{bucket: {"status|nível": cell}} de base + delta, só na faixa pedida."""
+        out: Dict[str, Dict[str, Any]] = {}
+        with self._lock:
+            self._ensure_loaded()
+            if self._watch.changed():
+                # outro processo persistiu: o delta daqui ainda não está no arquivo
+                self._base = self._read_file() or {}
+            for tree in (self._base, self._delta):
+                for bucket, cells in (tree.get(granularity) or {}).items():
+                    # bucket entra se se sobrepõe a [since, until)
+                    if (since and bucket < since[:len(bucket)]) or (until and bucket >= until):
+                        continue
+                    for key, cell in cells.items():
+                        if statuses and key.split("|", 1)[0] not in statuses:
+                            continue
+                        dst = out.setdefault(bucket, {})
+                        if key in dst:
+                            _merge_cell(dst[key], cell)
+                        else:
+                            dst[key] = copy.deepcopy(cell)
+        return out
+
+
+_LOG_INDEX = _LogIndex(SQLITE_PATH)
+_LOG = _LogWriter(LOG_JSONL_PATH)
+_STATS = _AuthStats(STATS_PATH)
+atexit.register(_LOG.flush)
+atexit.register(_STATS.persist)
+
+
+def flush_logs() -> None:
+    """Grava já o que está na fila (testes, desligamento, ferramentas)."""
+    _LOG.flush()
+
+
+def get_logs() -> List[Dict[str, Any]]:
+    """Histórico completo: logs.json legado + segmentos JSONL + fila ainda não gravada."""
+    with _LOG._write_lock:
+        data = _read_json(LOG_PATH)
+        logs = data if isinstance(data, list) else []
+        for seg in _log_segments():
+            logs.extend(_read_jsonl(seg))
+        logs.extend(_LOG.pending())
+    return logs
+
+
+def log_event(status: str, user_name: Optional[str] = None, score: Optional[float] = None,
+              note: Optional[str] = None, level: Optional[int] = None) -> None:
+    event = {
         "ts": _now(),
         "status": status,
         "user_name": user_name,
         "score": score,
         "note": note
-    })
-    _write_json(LOG_PATH, logs)
+    }
+    if level is not None:
+        event["level"] = int(level)
+    # estatística antes da fila: na primeira carga sem stats.json o histórico
+    # (incluindo a fila) é reprocessado, e este evento ainda não está nele
+    try:
+        _STATS.record(event, _event_level(event))
+    except Exception:
+        logger.exception("falha ao contabilizar o evento nas estatísticas")
+    _LOG.put(event)
+
+
+def auth_stats(granularity: str = "hour", since: Optional[str] = None, until: Optional[str] = None,
+               status=None) -> List[Dict[str, Any]]:
+    """
+    Agregados por bucket/status/nível: contagem, média e p50/p90 do score
+    (pelo histograma, em múltiplos de STATS_SCORE_BIN). O(buckets).
+    """
+    if granularity not in _STATS_PREFIX:
+        raise ValueError(f"granularity inválida: {granularity}")
+    statuses = [status] if isinstance(status, str) else (list(status) if status else None)
+    out = []
+    cells = _STATS.cells(granularity, _norm_ts(since), _norm_ts(until), statuses)
+    for bucket in sorted(cells):
+        for key, cell in sorted(cells[bucket].items()):
+            st, lv = key.split("|", 1)
+            item = {"bucket": bucket, "status": st, "level": None if lv == "-" else int(lv),
+                    "count": cell["n"], "scored": cell["scored"],
+                    "mean_score": cell["sum"] / cell["scored"] if cell["scored"] else None,
+                    "p50": None, "p90": None, "hist": cell["hist"]}
+            if cell["scored"]:
+                acc = 0
+                for i, h in enumerate(cell["hist"]):
+                    acc += h
+                    edge = (i + 1) * STATS_SCORE_BIN
+                    if item["p50"] is None and acc >= 0.5 * cell["scored"]:
+                        item["p50"] = edge
+                    if acc >= 0.9 * cell["scored"]:
+                        item["p90"] = edge
+                        break
+            out.append(item)
+    return out
+
+
+def query_logs(since: Optional[str] = None, until: Optional[str] = None,
+               status=None, user_name: Optional[str] = None,
+               cursor: Optional[int] = None, limit: int = 100, order: str = "desc"):
+    """
+    Consulta paginada do log (gerador de dicts com 'id'). Filtros opcionais:
+    período [since, until), status (um ou vários), user_name exato. Próxima
+    página: passe o 'id' do último item como cursor (mesmo 'order').
+    """
+    return _LOG_INDEX.query(since, until, status, user_name, cursor, limit, order)
@@ -1,20 +1,91 @@
 import os
+import copy
+import json
+import logging
+import re
 import time
+import base64
+import shutil
+import threading
+from concurrent.futures import ThreadPoolExecutor
 import cv2
 import numpy as np
 
+from storage import FileLock, ChangeWatcher, atomic_replace_write as _atomic_replace_write
+
+logger = logging.getLogger(__name__)
+
 # Base = pasta onde está este arquivo (raiz do projeto)
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 
 # Caminhos (sempre apontam para a RAIZ do projeto)
 FACES_DIR_ABS = os.path.join(BASE_DIR, "faces")         # absoluto para salvar/acessar
 FACES_DIR_REL = "faces"                                  # relativo para gravar no DB
-MODEL_PATH = os.path.join(BASE_DIR, "lbph_model.yml")
+MODEL_PATH = os.path.join(BASE_DIR, "lbph_model.yml")     # legado: lido só se não houver models/
 LABELS_PATH = os.path.join(BASE_DIR, "labels.txt")
+MODELS_DIR = os.path.join(BASE_DIR, "models")            # models/v000001/{lbph_model.yml,labels.txt}
+MODEL_CURRENT_PATH = os.path.join(MODELS_DIR, "current.json")
+MODEL_KEEP_VERSIONS = 3
+_MODELS_LOCK = FileLock(os.path.join(MODELS_DIR, "publish"))  # numeração + current.json entre processos
+FEATURES_DIR = os.path.join(BASE_DIR, "features")     # cache de ROI + histograma por amostra
 
 # Haar Cascade (vem com OpenCV)
 CASCADE = cv2.CascadeClassifier(cv2.data.haarcascades + "haarcascade_frontalface_default.xml")
 
+# Detectores: "haar" (mais preciso), "lbp" (cascade LBP, bem mais rápido em CPU)
+# e "tracked" (procura perto do último rosto do mesmo fluxo e cai no detector
+# base se perder). Escolha por endpoint em DETECTOR_BY_ENDPOINT.
+DETECTOR_DEFAULT = "haar"
+DETECTOR_BY_ENDPOINT = {"enroll": "haar", "verify": "haar", "verify_batch": "tracked", "liveness": "lbp"}
+TRACKED_BASE = "haar"
+TRACKED_MARGIN = 0.5       # janela = bbox anterior expandida em 50% por lado
+# Os XML LBP vêm no repositório do OpenCV (data/lbpcascades), mas os pacotes
+# pip (opencv-contrib-python 4.10 incluso) não os trazem: copie
+# lbpcascade_frontalface_improved.xml para ./cascades. Sem ele, "lbp" usa Haar
+# (sem ganho de velocidade) e isso é avisado no log uma vez por processo.
+LBP_CASCADE_FILES = ("lbpcascade_frontalface_improved.xml", "lbpcascade_frontalface.xml")
+
+# Detecção: DETECT_DOWNSCALE < 1.0 procura o rosto numa cópia reduzida do frame
+# (ex.: 0.5) e recorta a ROI 200x200 da imagem em resolução cheia.
+# DETECT_MIN_SIZE é em pixels da resolução cheia. Compare com benchmark_detection().
+DETECT_DOWNSCALE = 1.0
+DETECT_SCALE_FACTOR = 1.1
+DETECT_MIN_NEIGHBORS = 5
+DETECT_MIN_SIZE = 60
+
+# Liveness: movimento entre os frames do desafio, em px/frame da resolução
+# original. "full" = Farneback denso no quadro inteiro (cálculo original, caro);
+# "frame" = a mesma mediana do quadro inteiro, reduzido para FLOW_FRAME_WIDTH
+# (~20x mais barato, mas a decisão diverge do "full" quando o rosto ocupa boa
+# parte do quadro — até ~1/4 dos bursts nesse enquadramento); "roi" = Farneback só na região do rosto,
+# reduzida para FLOW_ROI_WIDTH; "lk" = Lucas-Kanade esparso em cantos dentro do
+# rosto. "roi"/"lk" medem o movimento do ROSTO, enquanto a mediana do quadro
+# inteiro é dominada pelo fundo quando o rosto ocupa menos da metade da
+# imagem: são sinais diferentes, por isso o limiar é por modo. Calibre com
+# benchmark_liveness_flow() sobre bursts reais (suggested_min_flow; para
+# "roi"/"lk" com labels). Limiares de "roi"/"lk" calibrados em bursts
+# sintéticos rotulados (rosto se movendo >= 0.6 px/frame = vivo).
+# Sem rosto, "roi" e "lk" caem no cálculo do "frame".
+# O padrão segue "full" até outro modo reproduzir a decisão dele.
+LIVENESS_FLOW_MODE = "full"
+LIVENESS_MIN_FLOW = {"full": 0.50, "frame": 0.50, "roi": 0.55, "lk": 0.55}
+FLOW_ROI_WIDTH = 96
+# fração do bbox acrescentada em cada lado; com margem o fundo parado ocupa
+# boa parte do recorte e puxa a mediana para zero
+FLOW_ROI_MARGIN = 0.0
+FLOW_FRAME_WIDTH = 160
+FLOW_DETECT_DOWNSCALE = 0.33  # busca do rosto para "roi"/"lk"
+
+# Decodificação de frames (base64/bytes -> ndarray) direto pelo cv2.imdecode.
+# Bursts são decodificados em paralelo num pool de DECODE_WORKERS threads
+# (imdecode solta o GIL), compartilhado por todas as requisições.
+# LIVENESS_DECODE_REDUCE = 2/4/8 decodifica o burst já reduzido
+# (IMREAD_REDUCED_GRAYSCALE_*); o flow volta para px da resolução original,
+# mas nitidez (Laplaciano) muda com a escala, então o padrão é 1.
+DECODE_WORKERS = min(4, os.cpu_count() or 1)
+LIVENESS_DECODE_REDUCE = 1
+LK_MAX_CORNERS = 40
+
 # Parâmetros LBPH
 LBPH_RADIUS = 2            # levemente maior (mais textura)
 LBPH_NEIGHBORS = 8
@@ -22,6 +93,44 @@ LBPH_GRID_X = 8
 LBPH_GRID_Y = 8
 LBPH_THRESHOLD = 70.0      # fallback global (se não usar por nível)
 
+# Agregação por identidade: cada pessoa tem várias amostras; o score dela é o
+# "min" ou a "mean" das MATCH_TOPK menores distâncias entre suas amostras.
+# (o motor "opencv" só devolve o vizinho mais próximo, equivalente a "min")
+MATCH_AGGREGATE = "min"
+MATCH_TOPK = 3
+
+# Índice ANN (só motor "numpy"): IVF sobre projeções aleatórias dos histogramas
+# restringe os candidatos antes do chi-quadrado exato. Vale a partir de
+# ANN_MIN_GALLERY amostras; ANN_NPROBE maior = mais recall e mais latência
+# (meça com benchmark_ann). ANN_NLIST=None usa ~sqrt(N) listas.
+ANN_ENABLED = False
+ANN_MIN_GALLERY = 2000
+ANN_NLIST = None
+ANN_NPROBE = 8
+ANN_PROJ_DIM = 64
+
+# Worker de treino: pedidos que chegam dentro da janela viram um único build
+TRAIN_COALESCE_SEC = 0.5
+TRAIN_WAIT_SEC = 30.0
+
+# Motor de reconhecimento: "numpy" (LBP vetorizado abaixo, mesmas distâncias do
+# OpenCV; grava o modelo binário model.lbpb) ou "opencv" (cv2.face LBPH; grava
+# o YAML lbph_model.yml + labels.txt). O "numpy" também lê o YAML antigo.
+# Só é o padrão porque benchmark_recognizer() o mede mais rápido que o
+# cv2.face com as mesmas distâncias (~12 vs 28 ms com 200 amostras, ~51 vs
+# 127 ms com 1000); se isso mudar na sua máquina, volte para "opencv".
+RECOGNIZER_ENGINE = "numpy"
+
+# Chi-quadrado do motor NumPy: blocos de galeria com ~CHI2_BLOCK_ELEMS
+# elementos (P probes x linhas x D), para os temporários ficarem no cache L2;
+# os buffers são reaproveitados entre chamadas (por thread).
+# Compare com o cv2.face em benchmark_recognizer().
+CHI2_BLOCK_ELEMS = 1 << 16
+
+# Formato binário: "float32" (mapeado direto do disco), "float16" ou "uint16"
+# (metade do tamanho; convertidos para float32 na carga)
+MODEL_DTYPE = "float32"
+
 # OPCIONAL: thresholds por nível (se quiser endurecer no app.py)
 # use: from face_utils import PER_LEVEL_THR
 PER_LEVEL_THR = {1: 62.0, 2: 56.0, 3: 52.0}
@@ -48,39 +157,300 @@ def _to_rel(path_abs: str) -> str:
         return path_abs
 
 # --------- Pré-processamentos para robustez (iluminação/contraste) ----------
+# Objetos OpenCV com estado interno (CLAHE) e buffers de rascunho não são
+# seguros entre threads: cada thread do servidor/pool guarda os seus.
+_TLS = threading.local()
+
+def _clahe_op():
+    op = getattr(_TLS, "clahe", None)
+    if op is None:
+        op = _TLS.clahe = cv2.createCLAHE(clipLimit=2.0, tileGridSize=(8, 8))
+    return op
+
+def _scratch(key: str, shape, dtype) -> np.ndarray:
+    """Buffer temporário reaproveitado pela thread (só para resultados descartáveis)."""
+    bufs = getattr(_TLS, "bufs", None)
+    if bufs is None:
+        bufs = _TLS.bufs = {}
+    buf = bufs.get(key)
+    if buf is None or buf.shape != tuple(shape) or buf.dtype != dtype:
+        buf = bufs[key] = np.empty(shape, dtype)
+    return buf
+
 def _clahe(gray: np.ndarray) -> np.ndarray:
     # Equalização adaptativa melhora contraste em baixa luz / alto brilho
-    clahe = cv2.createCLAHE(clipLimit=2.0, tileGridSize=(8, 8))
-    return clahe.apply(gray)
+    return _clahe_op().apply(gray)
 
 def _norm_0_255(gray: np.ndarray) -> np.ndarray:
     # Normaliza para [0,255] preservando contraste
     g = cv2.normalize(gray, None, 0, 255, cv2.NORM_MINMAX)
-    return g.astype("uint8")
+    return g.astype("uint8", copy=False)
+
+GLARE_LEVEL = 245          # pixel acima disso conta como brilho estourado
+
+class FrameContext:
+    """
+    Um frame e o que se deriva dele, calculado sob demanda e no máximo uma vez:
+    cinza, cinza+CLAHE, rosto (ROI 200x200 + bbox, por detector) e métricas de
+    qualidade (brilho estourado, nitidez). detect_face, predict_face,
+    save_face_image e flow_score aceitam o contexto no lugar do ndarray, então
+    o mesmo frame passa por detecção, anti-foto e reconhecimento sem repetir
+    conversões.
+    """
+    __slots__ = ("image", "_gray", "_clahe", "_faces", "_metrics")
+
+    def __init__(self, image: np.ndarray):
+        self.image = image
+        self._gray = None
+        self._clahe = None
+        self._faces = {}
+        self._metrics = {}
+
+    @classmethod
+    def of(cls, frame):
+        return frame if isinstance(frame, cls) else cls(frame)
+
+    @property
+    def shape(self):
+        return self.image.shape
+
+    @property
+    def gray(self) -> np.ndarray:
+        if self._gray is None:
+            img = self.image
+            self._gray = img if img.ndim == 2 else cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+        return self._gray
+
+    @property
+    def clahe(self) -> np.ndarray:
+        if self._clahe is None:
+            self._clahe = _clahe(self.gray)
+        return self._clahe
+
+    def face(self, detector=None):
+        """(ROI, bbox) com os parâmetros DETECT_* do módulo; memoizado por detector."""
+        key = (detector or DETECTOR_DEFAULT).lower() if detector is None or isinstance(detector, str) else detector
+        if key not in self._faces:
+            self._faces[key] = _detect_on(self.clahe, DETECT_DOWNSCALE, DETECT_SCALE_FACTOR,
+                                          DETECT_MIN_SIZE, detector)
+        return self._faces[key]
+
+    def glare_ratio(self) -> float:
+        """Fração de pixels acima de GLARE_LEVEL no frame inteiro."""
+        if "glare" not in self._metrics:
+            g = self.gray
+            mask = _scratch("mask", g.shape, np.uint8)
+            cv2.threshold(g, GLARE_LEVEL, 255, cv2.THRESH_BINARY, dst=mask)
+            self._metrics["glare"] = cv2.countNonZero(mask) / float(g.size or 1)
+        return self._metrics["glare"]
+
+    def blur_score(self, bbox=None) -> float:
+        """Variância do Laplaciano (cinza sem CLAHE) do frame ou só do bbox."""
+        key = ("blur", tuple(bbox) if bbox else None)
+        if key not in self._metrics:
+            g = self.gray
+            if bbox:
+                x, y, w, h = bbox
+                g = g[max(0, y):y + h, max(0, x):x + w]
+            if g.size == 0:
+                self._metrics[key] = 0.0
+            else:
+                lap = cv2.Laplacian(g, cv2.CV_64F, dst=_scratch("lap", g.shape, np.float64))
+                self._metrics[key] = float(cv2.meanStdDev(lap)[1][0, 0] ** 2)
+        return self._metrics[key]
+
+# ------------------------ Decodificação de frames ---------------------------
+_IMREAD_FLAGS = {
+    # IGNORE_ORIENTATION: mesmo resultado do PIL (que não aplica o EXIF)
+    (False, 1): cv2.IMREAD_COLOR | cv2.IMREAD_IGNORE_ORIENTATION,
+    (False, 2): cv2.IMREAD_REDUCED_COLOR_2 | cv2.IMREAD_IGNORE_ORIENTATION,
+    (False, 4): cv2.IMREAD_REDUCED_COLOR_4 | cv2.IMREAD_IGNORE_ORIENTATION,
+    (False, 8): cv2.IMREAD_REDUCED_COLOR_8 | cv2.IMREAD_IGNORE_ORIENTATION,
+    (True, 1): cv2.IMREAD_GRAYSCALE | cv2.IMREAD_IGNORE_ORIENTATION,
+    (True, 2): cv2.IMREAD_REDUCED_GRAYSCALE_2 | cv2.IMREAD_IGNORE_ORIENTATION,
+    (True, 4): cv2.IMREAD_REDUCED_GRAYSCALE_4 | cv2.IMREAD_IGNORE_ORIENTATION,
+    (True, 8): cv2.IMREAD_REDUCED_GRAYSCALE_8 | cv2.IMREAD_IGNORE_ORIENTATION,
+}
+_DECODE_POOL = None
+_DECODE_POOL_LOCK = threading.Lock()
+
+def decode_image(data, gray: bool = False, reduce: int = 1) -> np.ndarray:
+    """
+    JPEG/PNG -> ndarray BGR (ou cinza com gray=True), direto do cv2.imdecode.
+    'data' = bytes/bytearray/memoryview ou string base64 (dataURL ou crua).
+    reduce = 1, 2, 4 ou 8 decodifica já reduzido. ValueError se não decodifica.
+    """
+    if isinstance(data, str):
+        if "," in data:
+            data = data.split(",", 1)[1]
+        data = base64.b64decode(data)
+    flags = _IMREAD_FLAGS.get((bool(gray), int(reduce)))
+    if flags is None:
+        raise ValueError(f"reduce inválido: {reduce}")
+    buf = np.frombuffer(data, dtype=np.uint8)
+    img = cv2.imdecode(buf, flags) if buf.size else None
+    if img is None:
+        raise ValueError("imagem inválida ou formato não suportado")
+    return img
+
+def _decode_pool() -> ThreadPoolExecutor:
+    global _DECODE_POOL
+    if _DECODE_POOL is None:
+        with _DECODE_POOL_LOCK:
+            if _DECODE_POOL is None:
+                _DECODE_POOL = ThreadPoolExecutor(max_workers=max(1, DECODE_WORKERS),
+                                                  thread_name_prefix="decode")
+    return _DECODE_POOL
+
+def decode_frames(items, gray: bool = False, reduce: int = 1) -> list:
+    """
+    Decodifica um burst em paralelo (pool limitado). Mantém a ordem; frames
+    que não decodificam viram None.
+    """
+    items = list(items)
+    def _one(data):
+        try:
+            return decode_image(data, gray=gray, reduce=reduce)
+        except Exception:
+            return None
+    if len(items) <= 1 or DECODE_WORKERS <= 1:
+        return [_one(d) for d in items]
+    return list(_decode_pool().map(_one, items))
 
 # --------------------------- Detecção de rosto ------------------------------
-def detect_face(img_bgr):
+class CascadeDetector:
+    """Detector baseado em cv2.CascadeClassifier (Haar ou LBP)."""
+    def __init__(self, name: str, cascade):
+        self.name = name
+        self.cascade = cascade
+
+    def detect(self, gray, scale_factor, min_neighbors, min_size):
+        return self.cascade.detectMultiScale(
+            gray,
+            scaleFactor=scale_factor,
+            minNeighbors=min_neighbors,
+            minSize=(min_size, min_size)
+        )
+
+class TrackedDetector:
     """
-    Retorna (ROI_200x200_gray, bbox) do maior rosto detectado.
-    Aplica CLAHE para robustez. bbox no formato (x,y,w,h) em ints.
+    Para sequências de frames do mesmo cliente (burst de liveness, lote do
+    quiosque): procura só numa janela em volta do último rosto e recorre ao
+    detector base no frame inteiro quando não acha. Guarda estado; use uma
+    instância por fluxo (get_detector("tracked") sempre cria uma nova).
     """
-    if img_bgr is None or img_bgr.size == 0:
-        return None, None
+    def __init__(self, base, margin: float = None):
+        self.name = "tracked"
+        self.base = base
+        self.margin = TRACKED_MARGIN if margin is None else margin
+        self._last = None
+
+    def detect(self, gray, scale_factor, min_neighbors, min_size):
+        if self._last is not None:
+            H, W = gray.shape[:2]
+            x, y, w, h = self._last
+            mx, my = int(w * self.margin), int(h * self.margin)
+            x0, y0 = max(0, x - mx), max(0, y - my)
+            x1, y1 = min(W, x + w + mx), min(H, y + h + my)
+            # o rosto não muda muito de tamanho entre frames: corta as escalas pequenas
+            near_min = max(min_size, int(0.7 * min(w, h)))
+            faces = self.base.detect(gray[y0:y1, x0:x1], scale_factor, min_neighbors, near_min)
+            if len(faces):
+                faces = [(fx + x0, fy + y0, fw, fh) for fx, fy, fw, fh in faces]
+                self._last = max(faces, key=lambda b: b[2] * b[3])
+                return faces
+        faces = self.base.detect(gray, scale_factor, min_neighbors, min_size)
+        self._last = max(faces, key=lambda b: b[2] * b[3]) if len(faces) else None
+        return faces
+
+def _find_lbp_cascade():
+    dirs = [cv2.data.haarcascades,
+            os.path.join(os.path.dirname(os.path.normpath(cv2.data.haarcascades)), "lbpcascades"),
+            os.path.join(BASE_DIR, "cascades")]
+    for d in dirs:
+        for fname in LBP_CASCADE_FILES:
+            path = os.path.join(d, fname)
+            if os.path.exists(path):
+                cascade = cv2.CascadeClassifier(path)
+                if not cascade.empty():
+                    return cascade
+    return None
+
+_DETECTORS = {"haar": CascadeDetector("haar", CASCADE)}
+_DETECTORS_LOCK = threading.Lock()
+
+def get_detector(name: str = None):
+    """
+    Detector pelo nome ("haar", "lbp", "tracked"); aceita também uma instância
+    pronta. "lbp" cai para Haar se o XML não estiver disponível.
+    """
+    if name is not None and not isinstance(name, str):
+        return name
+    name = (name or DETECTOR_DEFAULT).lower()
+    if name == "tracked":
+        return TrackedDetector(get_detector(TRACKED_BASE))
+    with _DETECTORS_LOCK:
+        if name not in _DETECTORS:
+            cascade = _find_lbp_cascade() if name == "lbp" else None
+            if cascade is None and name == "lbp":
+                # 1x por processo: o detector fica em cache em _DETECTORS
+                logger.warning("detector '%s' indisponível (XML LBP não encontrado em cv2.data "
+                               "nem em %s); usando Haar", name, os.path.join(BASE_DIR, "cascades"))
+            _DETECTORS[name] = CascadeDetector(name, cascade) if cascade is not None else _DETECTORS["haar"]
+        return _DETECTORS[name]
 
-    gray = cv2.cvtColor(img_bgr, cv2.COLOR_BGR2GRAY)
-    gray = _clahe(gray)  # ajuda a detecção com variação de luz
+def detector_for(endpoint: str):
+    """Nome do detector configurado para o endpoint (DETECTOR_BY_ENDPOINT)."""
+    return DETECTOR_BY_ENDPOINT.get(endpoint, DETECTOR_DEFAULT)
 
-    faces = CASCADE.detectMultiScale(
-        gray,
-        scaleFactor=1.1,
-        minNeighbors=5,
-        minSize=(60, 60)
+def detect_face(img_bgr, downscale: float = None, scale_factor: float = None, min_size: int = None,
+                detector=None):
+    """
+    Retorna (ROI_200x200_gray, bbox) do maior rosto detectado (aceita BGR,
+    cinza ou FrameContext). Aplica CLAHE para robustez. bbox no formato
+    (x,y,w,h) em ints, sempre nas coordenadas do frame original. Sem argumentos
+    usa DETECT_* do módulo (e, com FrameContext, reaproveita a detecção já
+    feita no frame); com downscale < 1 a busca roda na cópia reduzida e só o
+    recorte usa a resolução cheia. 'detector' = nome ou instância (ver get_detector).
+    """
+    if isinstance(img_bgr, FrameContext):
+        ctx = img_bgr
+    elif img_bgr is None:
+        return None, None
+    else:
+        ctx = FrameContext(img_bgr)
+    if ctx.image is None or ctx.image.size == 0:
+        return None, None
+
+    if downscale is None and scale_factor is None and min_size is None:
+        return ctx.face(detector)
+    return _detect_on(
+        ctx.clahe,
+        DETECT_DOWNSCALE if downscale is None else float(downscale),
+        DETECT_SCALE_FACTOR if scale_factor is None else scale_factor,
+        DETECT_MIN_SIZE if min_size is None else min_size,
+        detector,
     )
+
+def _detect_on(gray, s, scale_factor, min_size, detector):
+    """Núcleo de detect_face sobre o cinza já equalizado (CLAHE)."""
+    small = gray
+    if 0.0 < s < 1.0:
+        small = cv2.resize(gray, None, fx=s, fy=s, interpolation=cv2.INTER_AREA)
+    else:
+        s = 1.0
+    m = max(1, int(round(min_size * s)))
+
+    faces = get_detector(detector).detect(small, scale_factor, DETECT_MIN_NEIGHBORS, m)
     if len(faces) == 0:
         return None, None
 
-    # pega o maior rosto
+    # pega o maior rosto e volta para a resolução cheia
     x, y, w, h = sorted(faces, key=lambda b: b[2] * b[3], reverse=True)[0]
+    if s != 1.0:
+        H, W = gray.shape[:2]
+        x, y = int(round(x / s)), int(round(y / s))
+        w, h = min(int(round(w / s)), W - x), min(int(round(h / s)), H - y)
     roi = gray[y:y + h, x:x + w]
     roi = cv2.resize(roi, (200, 200))
 
@@ -90,7 +460,261 @@ def detect_face(img_bgr):
 
     return roi, (int(x), int(y), int(w), int(h))
 
-def get_recognizer():
+def _iou(a, b) -> float:
+    ax, ay, aw, ah = a
+    bx, by, bw, bh = b
+    iw = max(0, min(ax + aw, bx + bw) - max(ax, bx))
+    ih = max(0, min(ay + ah, by + bh) - max(ay, by))
+    inter = iw * ih
+    union = aw * ah + bw * bh - inter
+    return inter / float(union) if union > 0 else 0.0
+
+def benchmark_detection(images_bgr, configs=None, repeat: int = 3):
+    """
+    Compara configurações de detect_face num conjunto de frames BGR.
+    A referência é a configuração original (Haar, resolução cheia,
+    scaleFactor 1.1, minSize 60). Para cada config (dict com downscale/
+    scale_factor/min_size/detector)
+    retorna ms_per_frame, hit_rate (frames com rosto) e agreement (fração dos
+    rostos da referência achados com IoU >= 0.5).
+    """
+    ref_cfg = {"downscale": 1.0, "scale_factor": 1.1, "min_size": 60, "detector": "haar"}
+    configs = configs or [ref_cfg,
+                          {"downscale": 1.0, "scale_factor": 1.1, "min_size": 60, "detector": "lbp"},
+                          {"downscale": 0.5, "scale_factor": 1.1, "min_size": 60},
+                          {"downscale": 0.5, "scale_factor": 1.2, "min_size": 60},
+                          {"downscale": 0.33, "scale_factor": 1.2, "min_size": 60}]
+    images_bgr = list(images_bgr)
+    if not images_bgr:
+        return []
+    ref = [detect_face(img, **ref_cfg)[1] for img in images_bgr]
+    rows = []
+    for cfg in configs:
+        t0 = time.perf_counter()
+        for _ in range(max(1, repeat)):
+            got = [detect_face(img, **cfg)[1] for img in images_bgr]
+        ms = (time.perf_counter() - t0) * 1000.0 / (max(1, repeat) * len(images_bgr))
+        n_ref = sum(1 for r in ref if r)
+        agree = sum(1 for r, g in zip(ref, got) if r and g and _iou(r, g) >= 0.5)
+        rows.append(dict(cfg, ms_per_frame=ms,
+                         hit_rate=sum(1 for g in got if g) / len(images_bgr),
+                         agreement=agree / n_ref if n_ref else None))
+    return rows
+
+# ------------------------ Movimento (liveness) ------------------------------
+def _flow_region(shape, bbox):
+    """(x0, y0, x1, y1) do bbox ampliado por FLOW_ROI_MARGIN, ou None."""
+    if not bbox:
+        return None
+    H, W = shape[:2]
+    x, y, w, h = bbox
+    mx, my = int(w * FLOW_ROI_MARGIN), int(h * FLOW_ROI_MARGIN)
+    x0, y0 = max(0, x - mx), max(0, y - my)
+    x1, y1 = min(W, x + w + mx), min(H, y + h + my)
+    return (x0, y0, x1, y1) if x1 - x0 >= 16 and y1 - y0 >= 16 else None
+
+def _farneback_median(prev, nxt, levels=3, winsize=15, iterations=3) -> float:
+    flow = cv2.calcOpticalFlowFarneback(prev, nxt, None, 0.5, levels, winsize, iterations, 5, 1.2, 0)
+    mag, _ = cv2.cartToPolar(flow[..., 0], flow[..., 1])
+    return float(np.median(mag))
+
+def _shrink(gray, width: int):
+    """Cópia com largura 'width' (se menor que a original) e o fator de volta."""
+    w = gray.shape[1]
+    if w <= width:
+        return gray, 1.0
+    s = width / float(w)
+    return cv2.resize(gray, None, fx=s, fy=s, interpolation=cv2.INTER_AREA), w / float(width)
+
+def _lk_median(prev, nxt):
+    """Deslocamento mediano dos cantos rastreados (ida e volta < 1 px), ou None."""
+    pts = cv2.goodFeaturesToTrack(prev, LK_MAX_CORNERS, 0.01, 5)
+    if pts is None or len(pts) < 5:
+        return None
+    fwd, st1, _ = cv2.calcOpticalFlowPyrLK(prev, nxt, pts, None, winSize=(15, 15), maxLevel=2)
+    back, st2, _ = cv2.calcOpticalFlowPyrLK(nxt, prev, fwd, None, winSize=(15, 15), maxLevel=2)
+    good = (st1.ravel() == 1) & (st2.ravel() == 1) & \
+           (np.linalg.norm((back - pts).reshape(-1, 2), axis=1) < 1.0)
+    if good.sum() < 5:
+        return None
+    d = (fwd - pts).reshape(-1, 2)[good]
+    return float(np.median(np.hypot(d[:, 0], d[:, 1])))
+
+def flow_score(frames_bgr, mode: str = None, bbox=None, detector=None, scale: float = 1.0) -> float:
+    """
+    Movimento mediano entre frames consecutivos (média dos pares), em px da
+    resolução original. Frames BGR, cinza ou FrameContext; 'scale' > 1 quando foram
+    decodificados reduzidos (ex.: 2 para IMREAD_REDUCED_*_2). 'bbox' evita
+    detectar de novo; sem ele, o rosto é procurado no frame do meio
+    (detector de "liveness", busca reduzida).
+    """
+    if len(frames_bgr) < 3:
+        return 0.0
+    grays = [FrameContext.of(f).gray for f in frames_bgr]
+    return _flow_score_gray(grays, (mode or LIVENESS_FLOW_MODE).lower(), bbox, detector) * float(scale)
+
+def _flow_score_gray(grays, mode: str, bbox, detector) -> float:
+    region = None
+    if mode not in ("full", "frame"):
+        if bbox is None:
+            mid = grays[len(grays) // 2]
+            bbox = detect_face(mid, downscale=FLOW_DETECT_DOWNSCALE,
+                               detector=detector or detector_for("liveness"))[1]
+        region = _flow_region(grays[0].shape, bbox)
+    preps = [_flow_prep(g, mode, region) for g in grays]
+    mags = [_pair_flow(a, b, mode) for a, b in zip(preps, preps[1:])]
+    return float(np.mean(mags)) if mags else 0.0
+
+def _flow_prep(gray, mode: str, region):
+    """
+    O que _pair_flow usa de um frame: (recorte, recorte reduzido, fator de volta).
+    "frame" ou sem rosto: quadro inteiro reduzido (mesma estatística do "full").
+    """
+    if mode == "full":
+        return gray, gray, 1.0
+    if region is None:
+        small, k = _shrink(gray, FLOW_FRAME_WIDTH)
+        return None, small, k
+    x0, y0, x1, y1 = region
+    crop = gray[y0:y1, x0:x1]
+    small, k = _shrink(crop, FLOW_ROI_WIDTH)
+    return crop, small, k
+
+def _pair_flow(a, b, mode: str) -> float:
+    """Movimento mediano entre dois frames preparados por _flow_prep."""
+    if mode == "full":
+        return _farneback_median(a[0], b[0])
+    m = _lk_median(a[0], b[0]) if mode == "lk" and a[0] is not None else None
+    if m is None:   # "frame"/"roi", ou LK sem cantos suficientes
+        m = _farneback_median(a[1], b[1], 2, 9, 2) * a[2]
+    return m
+
+class LivenessStream:
+    """
+    flow_score incremental, para frames que chegam um a um: guarda só o frame
+    anterior (já preparado para o modo) e as métricas de cada frame/par.
+    Mesmo modo e mesma escala do cálculo em lote; em "roi"/"lk" o rosto é
+    procurado no primeiro frame (no lote, no do meio).
+    """
+
+    def __init__(self, mode: str = None, scale: float = 1.0, detector=None):
+        self.mode = (mode or LIVENESS_FLOW_MODE).lower()
+        self.scale = float(scale)
+        self.detector = detector
+        self.frames = 0
+        self.mags = []
+        self.glare = []
+        self.blur = []
+        self._region = None
+        self._prev = None
+
+    def push(self, frame) -> "FrameContext":
+        """Acrescenta um frame (cinza, BGR ou FrameContext) e devolve o contexto dele."""
+        ctx = FrameContext.of(frame)
+        gray = ctx.gray
+        if self.frames == 0 and self.mode not in ("full", "frame"):
+            bbox = detect_face(gray, downscale=FLOW_DETECT_DOWNSCALE,
+                               detector=self.detector or detector_for("liveness"))[1]
+            self._region = _flow_region(gray.shape, bbox)
+        prep = _flow_prep(gray, self.mode, self._region)
+        if self._prev is not None:
+            self.mags.append(_pair_flow(self._prev, prep, self.mode))
+        self._prev = prep
+        self.glare.append(ctx.glare_ratio())
+        self.blur.append(ctx.blur_score())
+        self.frames += 1
+        return ctx
+
+    @property
+    def flow(self) -> float:
+        """Como flow_score: média dos pares, 0.0 com menos de 3 frames."""
+        if self.frames < 3:
+            return 0.0
+        return float(np.mean(self.mags)) * self.scale
+
+    @property
+    def glare_ratio(self) -> float:
+        return float(np.median(self.glare)) if self.glare else 0.0
+
+    @property
+    def blur_score(self) -> float:
+        return float(np.median(self.blur)) if self.blur else 0.0
+
+def benchmark_liveness_flow(bursts, modes=("full", "frame", "roi", "lk"), min_flow: dict = None,
+                            labels=None):
+    """
+    Compara os modos de flow_score em bursts reais (listas de frames BGR).
+    Referência: "full" com o seu limiar, ou 'labels' (True = pessoa se mexendo)
+    quando dados — necessário para calibrar "roi"/"lk", que medem o rosto e
+    não o quadro inteiro. Por modo devolve ms_per_challenge, agreement
+    (fração dos bursts com a mesma decisão aprovado/reprovado), corr (Pearson
+    com os scores do "full") e suggested_min_flow (limiar que maximiza a
+    concordância nesses bursts).
+    """
+    min_flow = dict(LIVENESS_MIN_FLOW, **(min_flow or {}))
+    if labels is not None:
+        labels = [bool(x) for b, x in zip(bursts, labels) if len(b) >= 3]
+    bursts = [list(b) for b in bursts if len(b) >= 3]
+    if not bursts:
+        return []
+    ref = [flow_score(b, "full") for b in bursts]
+    ref_ok = labels if labels is not None else [r >= min_flow["full"] for r in ref]
+    rows = []
+    for mode in modes:
+        t0 = time.perf_counter()
+        scores = [flow_score(b, mode) for b in bursts]     # inclui a detecção do rosto
+        ms = (time.perf_counter() - t0) * 1000.0 / len(bursts)
+        thr = min_flow.get(mode, min_flow["full"])
+        agree = sum((sc >= thr) == ok for sc, ok in zip(scores, ref_ok)) / len(bursts)
+        cands = sorted(set(scores)) + [max(scores) + 1e-6]
+        best = max(cands, key=lambda t: (sum((sc >= t) == ok for sc, ok in zip(scores, ref_ok)),
+                                         -abs(t - thr)))
+        corr = float(np.corrcoef(ref, scores)[0, 1]) if len(bursts) > 1 and np.std(scores) > 0 and np.std(ref) > 0 else None
+        agree_best = sum((sc >= best) == ok for sc, ok in zip(scores, ref_ok)) / len(bursts)
+        rows.append({"mode": mode, "ms_per_challenge": ms, "min_flow": thr, "agreement": agree,
+                     "corr": corr, "suggested_min_flow": float(best),
+                     "agreement_at_suggested": agree_best, "scores": scores})
+    return rows
+
+def benchmark_recognizer(images, labels, probes, repeat: int = 3):
+    """
+    Paridade e latência do motor NumPy contra o cv2.face LBPH, treinados nas
+    mesmas ROIs 200x200. Por motor devolve ms_per_predict; para o "numpy",
+    label_agreement (mesmo label do OpenCV) e max_abs_diff (maior diferença
+    de distância). Agregação "min" (a do OpenCV) durante a medição.
+    """
+    global MATCH_AGGREGATE
+    labels = np.asarray(labels, np.int32)
+    engines = {"opencv": get_recognizer("opencv"), "numpy": NumpyLBPH(
+        radius=LBPH_RADIUS, neighbors=LBPH_NEIGHBORS, grid_x=LBPH_GRID_X, grid_y=LBPH_GRID_Y)}
+    saved, MATCH_AGGREGATE = MATCH_AGGREGATE, "min"
+    try:
+        results, rows = {}, []
+        for name, rec in engines.items():
+            rec.train(list(images), labels)
+            results[name] = [rec.predict(p) for p in probes]
+            t0 = time.perf_counter()
+            for _ in range(max(1, repeat)):
+                for p in probes:
+                    rec.predict(p)
+            ms = (time.perf_counter() - t0) * 1000.0 / (max(1, repeat) * max(1, len(probes)))
+            rows.append({"engine": name, "gallery": len(labels), "ms_per_predict": ms})
+    finally:
+        MATCH_AGGREGATE = saved
+    ref, got = results["opencv"], results["numpy"]
+    rows[1]["label_agreement"] = sum(int(a[0]) == int(b[0]) for a, b in zip(ref, got)) / max(1, len(probes))
+    rows[1]["max_abs_diff"] = max((abs(float(a[1]) - float(b[1])) for a, b in zip(ref, got)), default=0.0)
+    return rows
+
+def get_recognizer(engine: str = None):
+    engine = (engine or RECOGNIZER_ENGINE).lower()
+    if engine == "numpy":
+        return NumpyLBPH(
+            radius=LBPH_RADIUS,
+            neighbors=LBPH_NEIGHBORS,
+            grid_x=LBPH_GRID_X,
+            grid_y=LBPH_GRID_Y
+        )
     recognizer = cv2.face.LBPHFaceRecognizer_create(
         radius=LBPH_RADIUS,
         neighbors=LBPH_NEIGHBORS,
@@ -99,115 +723,1418 @@ def get_recognizer():
     )
     return recognizer
 
+# ---------------------- Motor LBPH vetorizado (NumPy) -----------------------
+def lbp_histograms(imgs: np.ndarray, radius: int = LBPH_RADIUS, neighbors: int = LBPH_NEIGHBORS,
+                   grid_x: int = LBPH_GRID_X, grid_y: int = LBPH_GRID_Y) -> np.ndarray:
+    """
+    Histogramas espaciais LBP idênticos aos do cv2.face LBPH (ELBP circular
+    com interpolação bilinear, células grid_x x grid_y normalizadas pela área)
+    para uma pilha de imagens (B, H, W) do mesmo tamanho.
+    Retorna matriz float32 (B, grid_x*grid_y*2^neighbors).
+    """
+    src = np.asarray(imgs, np.float32)
+    batch, rows, cols = src.shape
+    h, w = rows - 2 * radius, cols - 2 * radius
+    center = src[:, radius:radius + h, radius:radius + w]
+    codes = np.zeros((batch, h, w), np.int32)
+    eps = np.finfo(np.float32).eps
+
+    def _shift(dy, dx):
+        return src[:, radius + dy:radius + dy + h, radius + dx:radius + dx + w]
+
+    for n in range(neighbors):
+        x = np.float32(radius * np.cos(2.0 * np.pi * n / neighbors))
+        y = np.float32(-radius * np.sin(2.0 * np.pi * n / neighbors))
+        fx, fy = int(np.floor(x)), int(np.floor(y))
+        cx, cy = int(np.ceil(x)), int(np.ceil(y))
+        ty, tx = y - fy, x - fx
+        w1, w2 = (1 - tx) * (1 - ty), tx * (1 - ty)
+        w3, w4 = (1 - tx) * ty, tx * ty
+        t = w1 * _shift(fy, fx) + w2 * _shift(fy, cx) + w3 * _shift(cy, fx) + w4 * _shift(cy, cx)
+        bit = (t > center) | (np.abs(t - center) < eps)
+        codes |= bit.astype(np.int32) << n
+
+    bins = 1 << neighbors
+    ncells = grid_y * grid_x
+    ch, cw = h // grid_y, w // grid_x
+    cells = (codes[:, :grid_y * ch, :grid_x * cw]
+             .reshape(batch, grid_y, ch, grid_x, cw)
+             .transpose(0, 1, 3, 2, 4)
+             .reshape(batch * ncells, ch * cw))
+    offsets = (np.arange(batch * ncells, dtype=np.int64) * bins)[:, None]
+    hist = np.bincount((cells + offsets).ravel(), minlength=batch * ncells * bins)
+    return (hist / float(ch * cw)).astype(np.float32).reshape(batch, ncells * bins)
+
+def lbp_histogram(img: np.ndarray, radius: int = LBPH_RADIUS, neighbors: int = LBPH_NEIGHBORS,
+                  grid_x: int = LBPH_GRID_X, grid_y: int = LBPH_GRID_Y) -> np.ndarray:
+    """Histograma LBP de uma única imagem (ver lbp_histograms)."""
+    return lbp_histograms(np.asarray(img)[None], radius, neighbors, grid_x, grid_y)[0]
+
+def chi_square_distances(gallery: np.ndarray, probe: np.ndarray) -> np.ndarray:
+    """
+    Distância chi-quadrado (HISTCMP_CHISQR_ALT, a mesma do LBPH do OpenCV)
+    do 'probe' contra todas as linhas de 'gallery'.
+    """
+    return chi_square_distances_batch(gallery, probe.reshape(1, -1))[0]
+
+_CHI2_TINY = np.float32(1e-30)
+
+def chi_square_distances_batch(gallery: np.ndarray, probes: np.ndarray, max_elems: int = None) -> np.ndarray:
+    """
+    Matriz (P, N) de distâncias chi-quadrado de P probes contra N linhas da
+    galeria, em blocos de galeria com ~'max_elems' (CHI2_BLOCK_ELEMS)
+    elementos sobre dois buffers float32 reaproveitados.
+
+    O OpenCV ignora os bins com a + b <= eps. Aqui o denominador é só
+    limitado por baixo (sem máscara): bin vazio nos dois lados dá 0/tiny = 0,
+    e em histogramas LBPH todo bin não vazio vale >= 1/área da célula, muito
+    acima de eps — mesma soma, sem a passada extra da máscara.
+    """
+    probes = np.asarray(probes, np.float32)
+    P, D = probes.shape
+    out = np.empty((P, len(gallery)), np.float64)
+    rows = max(1, int(max_elems or CHI2_BLOCK_ELEMS) // max(1, P * D))
+    num = _scratch("chi2_num", (P, rows, D), np.float32)
+    den = _scratch("chi2_den", (P, rows, D), np.float32)
+    q = probes[:, None, :]
+    for i in range(0, len(gallery), rows):
+        g = gallery[i:i + rows][None, :, :]
+        r = g.shape[1]
+        nb, db = num[:, :r], den[:, :r]
+        np.subtract(g, q, out=nb)
+        np.multiply(nb, nb, out=nb)
+        np.add(g, q, out=db)
+        np.maximum(db, _CHI2_TINY, out=db)
+        np.divide(nb, db, out=nb)
+        out[:, i:i + r] = 2.0 * nb.sum(axis=2, dtype=np.float64)
+    return out
+
+def aggregate_by_label(labels: np.ndarray, dists: np.ndarray, k: int = None, how: str = None):
+    """
+    Agrupa distâncias por label numa passada: mantém as k menores de cada
+    identidade e reduz por "min" ou "mean". Retorna (labels, scores) ordenado
+    do melhor para o pior. Padrões: MATCH_TOPK / MATCH_AGGREGATE.
+    """
+    k = MATCH_TOPK if k is None else k
+    how = MATCH_AGGREGATE if how is None else how
+    if not len(dists):
+        return np.empty(0, np.int32), np.empty(0, np.float64)
+    order = np.lexsort((dists, labels))
+    lab, d = labels[order], dists[order]
+    starts = np.flatnonzero(np.r_[True, lab[1:] != lab[:-1]])
+    counts = np.diff(np.r_[starts, len(lab)])
+    rank = np.arange(len(lab)) - np.repeat(starts, counts)
+    keep = rank < max(1, int(k))
+    lab, d = lab[keep], d[keep]
+    starts = np.flatnonzero(np.r_[True, lab[1:] != lab[:-1]])
+    if how == "mean":
+        scores = np.add.reduceat(d, starts) / np.diff(np.r_[starts, len(lab)])
+    else:
+        scores = d[starts]      # já ordenado: primeiro de cada grupo = mínimo
+    best = np.argsort(scores, kind="stable")
+    return lab[starts][best], scores[best]
+
+# ------------------------- Formato binário do modelo ------------------------
+# Layout (little-endian):
+#   "LBPHBIN1" | uint32 tamanho do cabeçalho | cabeçalho JSON (parâmetros LBPH,
+#   n, dim, dtype, mapa label -> nome) | labels int32[n] | histogramas dtype[n, dim]
+# labels e histogramas começam em offsets alinhados a 64 bytes para np.memmap.
+_LBPB_MAGIC = b"LBPHBIN1"
+_LBPB_DTYPES = {"float32": "<f4", "float16": "<f2", "uint16": "<u2"}
+
+def _align64(n: int) -> int:
+    return (n + 63) // 64 * 64
+
+def _is_binary_model(path: str) -> bool:
+    try:
+        with open(path, "rb") as f:
+            return f.read(len(_LBPB_MAGIC)) == _LBPB_MAGIC
+    except OSError:
+        return False
+
+# ---------------------- Índice ANN (IVF) sobre histogramas ------------------
+def _nearest_center(z: np.ndarray, centers: np.ndarray) -> np.ndarray:
+    d = (z * z).sum(axis=1)[:, None] - 2.0 * (z @ centers.T) + (centers * centers).sum(axis=1)[None, :]
+    return np.argmin(d, axis=1)
+
+def _kmeans(z: np.ndarray, k: int, iters: int, rng) -> np.ndarray:
+    centers = z[rng.choice(len(z), k, replace=False)].copy()
+    for _ in range(iters):
+        assign = _nearest_center(z, centers)
+        sums = np.zeros_like(centers)
+        np.add.at(sums, assign, z)
+        counts = np.bincount(assign, minlength=k)
+        filled = counts > 0
+        centers[filled] = sums[filled] / counts[filled, None]
+    return centers
+
+class IVFIndex:
+    """
+    Índice invertido grosso: sqrt(hist) (aprox. de Hellinger, coerente com o
+    chi-quadrado) projetado em ANN_PROJ_DIM dimensões, agrupado por k-means
+    em nlist listas. search() devolve as linhas das nprobe listas mais
+    próximas do probe; a ordenação final é sempre o chi-quadrado exato.
+    """
+    def __init__(self, dim: int, nlist: int = None, nprobe: int = None, proj_dim: int = None,
+                 iters: int = 10, seed: int = 0):
+        self.nlist = nlist if nlist is not None else ANN_NLIST
+        self.nprobe = nprobe if nprobe is not None else ANN_NPROBE
+        self.iters = iters
+        self._rng = np.random.default_rng(seed)
+        proj_dim = proj_dim or ANN_PROJ_DIM
+        self._proj = (self._rng.standard_normal((dim, proj_dim)) / np.sqrt(proj_dim)).astype(np.float32)
+        self._centers = None
+        self._lists = []
+
+    def _project(self, hists: np.ndarray, chunk: int = 1024) -> np.ndarray:
+        out = np.empty((len(hists), self._proj.shape[1]), np.float32)
+        for i in range(0, len(hists), chunk):
+            out[i:i + chunk] = np.sqrt(hists[i:i + chunk]) @ self._proj
+        return out
+
+    def build(self, hists: np.ndarray) -> "IVFIndex":
+        n = len(hists)
+        nlist = max(1, min(n, int(self.nlist or np.sqrt(n))))
+        z = self._project(hists)
+        sample = z[self._rng.choice(n, min(n, 64 * nlist), replace=False)]
+        self._centers = _kmeans(sample, nlist, self.iters, self._rng)
+        assign = _nearest_center(z, self._centers)
+        order = np.argsort(assign, kind="stable")
+        splits = np.cumsum(np.bincount(assign, minlength=nlist))[:-1]
+        self._lists = np.split(order, splits)
+        return self
+
+    def copy(self) -> "IVFIndex":
+        """Cópia em que add() não altera as listas do original (centros e projeção compartilhados)."""
+        other = copy.copy(self)
+        other._lists = list(self._lists)
+        return other
+
+    def add(self, hists: np.ndarray, start: int) -> None:
+        """Indexa as linhas start..start+len(hists)-1 (cadastro incremental)."""
+        for i, c in enumerate(_nearest_center(self._project(hists), self._centers)):
+            self._lists[c] = np.append(self._lists[c], start + i)
+
+    def search(self, probe: np.ndarray, nprobe: int = None) -> np.ndarray:
+        nprobe = max(1, min(int(nprobe or self.nprobe), len(self._lists)))
+        z = self._project(probe.reshape(1, -1))[0]
+        d = ((self._centers - z) ** 2).sum(axis=1)
+        pick = np.argpartition(d, nprobe - 1)[:nprobe]
+        return np.concatenate([self._lists[c] for c in pick])
+
+class NumpyLBPH:
+    """
+    Alternativa ao cv2.face LBPH com a mesma interface (train/update/predict/
+    read/write). A galeria fica numa única matriz float32 contígua e o probe é
+    comparado com todas as linhas de uma vez; predict_topk() expõe os k
+    melhores identidades, com as distâncias das amostras de cada pessoa
+    agregadas por MATCH_AGGREGATE/MATCH_TOPK. Lê e grava o mesmo YAML do OpenCV, então os dois motores são
+    intercambiáveis sobre lbph_model.yml.
+    """
+    def __init__(self, radius=LBPH_RADIUS, neighbors=LBPH_NEIGHBORS, grid_x=LBPH_GRID_X, grid_y=LBPH_GRID_Y):
+        self.radius = int(radius)
+        self.neighbors = int(neighbors)
+        self.grid_x = int(grid_x)
+        self.grid_y = int(grid_y)
+        self._hists = np.empty((0, self.dim), np.float32)   # buffer com folga
+        self._labels = np.empty(0, np.int32)
+        self._n = 0
+        self._ann = None
+
+    @property
+    def dim(self) -> int:
+        return self.grid_x * self.grid_y * (1 << self.neighbors)
+
+    @property
+    def histograms(self) -> np.ndarray:
+        return self._hists[:self._n]
+
+    @property
+    def labels(self) -> np.ndarray:
+        return self._labels[:self._n]
+
+    def compute(self, img: np.ndarray) -> np.ndarray:
+        return lbp_histogram(img, self.radius, self.neighbors, self.grid_x, self.grid_y)
+
+    def compute_batch(self, imgs) -> np.ndarray:
+        return lbp_histograms(np.stack(imgs), self.radius, self.neighbors, self.grid_x, self.grid_y)
+
+    def _append(self, hists: np.ndarray, labels: np.ndarray) -> None:
+        need = self._n + len(hists)
+        # buffers mapeados de um modelo binário são só leitura: copia no 1º append
+        if need > len(self._hists) or not (self._hists.flags.writeable and self._labels.flags.writeable):
+            cap = max(need, 2 * len(self._hists), 16)
+            buf = np.empty((cap, self.dim), np.float32)
+            buf[:self._n] = self.histograms
+            lab = np.empty(cap, np.int32)
+            lab[:self._n] = self.labels
+            self._hists, self._labels = buf, lab
+        self._hists[self._n:need] = hists
+        self._labels[self._n:need] = labels
+        start, self._n = self._n, need
+        self._refresh_ann(start)
+
+    def _refresh_ann(self, start: int) -> None:
+        """Indexa as linhas novas; (re)constrói o IVF num treino ou ao cruzar ANN_MIN_GALLERY."""
+        if not ANN_ENABLED or self._n < ANN_MIN_GALLERY:
+            self._ann = None
+        elif self._ann is None or start == 0:
+            self._ann = IVFIndex(self.dim).build(self.histograms)
+        else:
+            self._ann.add(self.histograms[start:self._n], start)
+
+    def fork(self) -> "NumpyLBPH":
+        """
+        Cópia barata para copy-on-write: compartilha os buffers da galeria.
+        Seguro porque o original só lê as suas _n linhas e o fork só escreve
+        depois delas (ou num buffer novo, ao crescer ou re-treinar).
+        """
+        other = copy.copy(self)
+        if self._ann is not None:
+            other._ann = self._ann.copy()
+        return other
+
+    def _reset(self) -> None:
+        # buffers novos: um fork pode compartilhar os antigos
+        self._hists = np.empty((0, self.dim), np.float32)
+        self._labels = np.empty(0, np.int32)
+        self._n = 0
+
+    def train(self, images, labels) -> None:
+        self._reset()
+        self.update(images, labels)
+
+    def update(self, images, labels) -> None:
+        labels = np.asarray(labels, np.int32).ravel()
+        if len(images) != len(labels):
+            raise ValueError("images e labels com tamanhos diferentes")
+        if not len(images):
+            return
+        self._append(self.compute_batch(images), labels)
+
+    def train_histograms(self, hists, labels) -> None:
+        """Como train(), mas com histogramas já calculados (FeatureStore)."""
+        self._reset()
+        self.update_histograms(hists, labels)
+
+    def update_histograms(self, hists, labels) -> None:
+        hists = np.asarray(hists, np.float32).reshape(-1, self.dim)
+        labels = np.asarray(labels, np.int32).ravel()
+        if len(hists) != len(labels):
+            raise ValueError("histogramas e labels com tamanhos diferentes")
+        self._append(hists, labels)
+
+    def predict_topk(self, img: np.ndarray, k: int = 1):
+        """Lista [(label, score)] das k identidades mais próximas (menor = melhor)."""
+        if self._n == 0:
+            return []
+        return self._match(self.compute(img), k)
+
+    def _match(self, probe: np.ndarray, k: int, exact: bool = False, nprobe: int = None):
+        if self._ann is not None and not exact:
+            rows = self._ann.search(probe, nprobe)
+            dists = chi_square_distances(self.histograms[rows], probe)
+            labels = self.labels[rows]
+        else:
+            dists = chi_square_distances(self.histograms, probe)
+            labels = self.labels
+        labs, scores = aggregate_by_label(labels, dists)
+        return [(int(l), float(d)) for l, d in zip(labs[:k], scores[:k])]
+
+    def _best(self, probe: np.ndarray, **kw):
+        # listas do IVF sem candidatos (nprobe pequeno / lista vazia): sem match, como predict
+        top = self._match(probe, 1, **kw)
+        return top[0] if top else (-1, float(np.finfo(np.float64).max))
+
+    def predict(self, img: np.ndarray):
+        top = self.predict_topk(img, 1)
+        if not top:
+            return -1, float(np.finfo(np.float64).max)
+        return top[0]
+
+    def predict_batch(self, imgs):
+        """
+        [(label, score)] para várias ROIs: histogramas em lote e uma única
+        matriz de distâncias probes x galeria (com ANN, cada probe tem seus
+        próprios candidatos e a busca volta a ser por probe).
+        """
+        if not len(imgs):
+            return []
+        if self._n == 0:
+            return [(-1, float(np.finfo(np.float64).max))] * len(imgs)
+        feats = self.compute_batch(imgs)
+        if self._ann is not None:
+            return [self._best(f) for f in feats]
+        dists = chi_square_distances_batch(self.histograms, feats)
+        out = []
+        for row in dists:
+            labs, scores = aggregate_by_label(self.labels, row)
+            out.append((int(labs[0]), float(scores[0])))
+        return out
+
+    def benchmark_ann(self, probes, nprobes=(1, 2, 4, 8, 16, 32)):
+        """
+        Mede o trade-off do índice ANN: para cada nprobe, recall@1 frente à
+        busca exata e latência média por probe (ms). 'probes' = ROIs 200x200
+        pré-processadas. Constrói o índice se ainda não existir.
+        """
+        if self._n == 0:
+            return []
+        ann = self._ann or IVFIndex(self.dim).build(self.histograms)
+        saved, self._ann = self._ann, ann
+        try:
+            feats = [self.compute(p) for p in probes]
+            t0 = time.perf_counter()
+            truth = [self._best(f, exact=True)[0] for f in feats]
+            exact_ms = (time.perf_counter() - t0) * 1000.0 / max(1, len(feats))
+            rows = []
+            for nprobe in nprobes:
+                t0 = time.perf_counter()
+                got = [self._best(f, nprobe=nprobe)[0] for f in feats]
+                ms = (time.perf_counter() - t0) * 1000.0 / max(1, len(feats))
+                hits = sum(1 for a, b in zip(got, truth) if a == b)
+                rows.append({"nprobe": int(nprobe), "recall_at_1": hits / max(1, len(feats)),
+                             "ms_per_probe": ms, "exact_ms_per_probe": exact_ms})
+            return rows
+        finally:
+            self._ann = saved
+
+    # --- persistência: formato binário (model.lbpb) ---
+    def write_binary(self, path: str, label_names: dict = None, dtype: str = None) -> None:
+        """Grava o modelo no formato binário, com o mapa label -> nome embutido."""
+        dtype = dtype or MODEL_DTYPE
+        if dtype not in _LBPB_DTYPES:
+            raise ValueError(f"dtype inválido: {dtype}")
+        hists = self.histograms
+        if dtype == "uint16":
+            data = np.round(np.clip(hists, 0.0, 1.0) * 65535.0).astype("<u2")
+        else:
+            data = hists.astype(_LBPB_DTYPES[dtype])
+        header = json.dumps({
+            "radius": self.radius, "neighbors": self.neighbors,
+            "grid_x": self.grid_x, "grid_y": self.grid_y,
+            "n": int(self._n), "dim": int(self.dim), "dtype": dtype,
+            "labels": {str(k): v for k, v in (label_names or {}).items()},
+        }, ensure_ascii=False).encode("utf-8")
+        lab_off = _align64(len(_LBPB_MAGIC) + 4 + len(header))
+        hist_off = _align64(lab_off + 4 * self._n)
+        with open(path, "wb") as f:
+            f.write(_LBPB_MAGIC)
+            f.write(len(header).to_bytes(4, "little"))
+            f.write(header)
+            f.write(b"\0" * (lab_off - f.tell()))
+            f.write(self.labels.astype("<i4").tobytes())
+            f.write(b"\0" * (hist_off - f.tell()))
+            f.write(data.tobytes())
+
+    def read_binary(self, path: str) -> dict:
+        """
+        Carrega um model.lbpb; em float32 a galeria fica mapeada do disco
+        (sem cópia). Retorna o mapa label -> nome embutido.
+        """
+        with open(path, "rb") as f:
+            if f.read(len(_LBPB_MAGIC)) != _LBPB_MAGIC:
+                raise ValueError(f"não é um modelo binário LBPH: {path}")
+            hlen = int.from_bytes(f.read(4), "little")
+            header = json.loads(f.read(hlen).decode("utf-8"))
+        self.radius = int(header["radius"])
+        self.neighbors = int(header["neighbors"])
+        self.grid_x = int(header["grid_x"])
+        self.grid_y = int(header["grid_y"])
+        n, dim, dtype = int(header["n"]), int(header["dim"]), header["dtype"]
+        lab_off = _align64(len(_LBPB_MAGIC) + 4 + hlen)
+        hist_off = _align64(lab_off + 4 * n)
+        if n:
+            labels = np.memmap(path, dtype="<i4", mode="r", offset=lab_off, shape=(n,))
+            raw = np.memmap(path, dtype=_LBPB_DTYPES[dtype], mode="r", offset=hist_off, shape=(n, dim))
+            if dtype == "uint16":
+                hists = raw.astype(np.float32) / np.float32(65535.0)
+            elif dtype == "float16":
+                hists = raw.astype(np.float32)
+            else:
+                hists = raw
+        else:
+            labels, hists = np.empty(0, np.int32), np.empty((0, dim), np.float32)
+        self._hists, self._labels, self._n = hists, labels, n
+        self._refresh_ann(0)
+        return {int(k): v for k, v in header.get("labels", {}).items()}
+
+    # --- persistência no formato YAML do cv2.face LBPH ---
+    def read(self, path: str) -> None:
+        if _is_binary_model(path):
+            self.read_binary(path)
+            return
+        fs = cv2.FileStorage(path, cv2.FILE_STORAGE_READ)
+        try:
+            node = fs.getNode("opencv_lbphfaces")
+            self.radius = int(node.getNode("radius").real())
+            self.neighbors = int(node.getNode("neighbors").real())
+            self.grid_x = int(node.getNode("grid_x").real())
+            self.grid_y = int(node.getNode("grid_y").real())
+            hnode = node.getNode("histograms")
+            hists = [hnode.at(i).mat().ravel() for i in range(hnode.size())]
+            labels = node.getNode("labels").mat()
+        finally:
+            fs.release()
+        self._n = 0
+        self._hists = np.empty((0, self.dim), np.float32)
+        if hists:
+            self._append(np.stack(hists).astype(np.float32), np.asarray(labels, np.int32).ravel())
+
+    def write(self, path: str) -> None:
+        fs = cv2.FileStorage(path, cv2.FILE_STORAGE_WRITE)
+        try:
+            fs.startWriteStruct("opencv_lbphfaces", cv2.FileNode_MAP)
+            fs.write("threshold", float(np.finfo(np.float64).max))
+            fs.write("radius", self.radius)
+            fs.write("neighbors", self.neighbors)
+            fs.write("grid_x", self.grid_x)
+            fs.write("grid_y", self.grid_y)
+            fs.startWriteStruct("histograms", cv2.FileNode_SEQ)
+            for h in self.histograms:
+                fs.write("", h.reshape(1, -1))
+            fs.endWriteStruct()
+            fs.write("labels", self.labels.reshape(-1, 1))
+            fs.startWriteStruct("labelsInfo", cv2.FileNode_SEQ)
+            fs.endWriteStruct()
+            fs.endWriteStruct()
+        finally:
+            fs.release()
+
+# ---------------------- Artefato versionado do modelo ----------------------
+def _read_label_file(path: str) -> dict:
+    lm = {}
+    if not path or not os.path.exists(path):
+        return lm
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            lab, name = line.split("\t", 1)
+            lm[int(lab)] = name
+    return lm
+
+def current_artifact():
+    """
+    Modelo publicado: {"version", "dir", "format", "built_at", "users_stamp",
+    "model", "labels"}.
+    Em "binary" o mapa de labels está dentro do model.lbpb ("labels" = None).
+    Sem nenhuma versão em models/, usa lbph_model.yml/labels.txt da raiz
+    (version 0). None se não existe modelo algum.
+    """
+    try:
+        with open(MODEL_CURRENT_PATH, "r", encoding="utf-8") as f:
+            cur = json.load(f)
+        d = os.path.join(MODELS_DIR, cur["dir"])
+        if cur.get("format") == "binary":
+            return dict(cur, model=os.path.join(d, "model.lbpb"), labels=None)
+        return dict(cur, format="yaml", model=os.path.join(d, "lbph_model.yml"),
+                    labels=os.path.join(d, "labels.txt"))
+    except (OSError, ValueError, KeyError, TypeError):
+        pass
+    if os.path.exists(MODEL_PATH):
+        return {"version": 0, "dir": None, "format": "yaml", "built_at": None,
+                "model": MODEL_PATH, "labels": LABELS_PATH}
+    return None
+
+def _write_artifact(recognizer, inv: dict, users_stamp: str = None) -> int:
+    """
+    Publica modelo + labels como uma versão só: grava numa pasta temporária,
+    renomeia para models/vNNNNNN e só então troca current.json (os.replace).
+    Leitores veem a versão antiga ou a nova, nunca metade. O motor "numpy"
+    grava model.lbpb (labels embutidos); o "opencv", YAML + labels.txt.
+    'users_stamp' (ver _stamp_key) registra de que estado do cadastro o modelo veio.
+    Roda sob _MODELS_LOCK: dois workers nunca disputam o mesmo número de versão.
+    """
+    os.makedirs(MODELS_DIR, exist_ok=True)
+    with _MODELS_LOCK:
+        return _write_artifact_locked(recognizer, inv, users_stamp)
+
+def _write_artifact_locked(recognizer, inv: dict, users_stamp: str = None) -> int:
+    cur = current_artifact()
+    version = int(cur["version"]) + 1 if cur else 1
+    name = f"v{version:06d}"
+    final = os.path.join(MODELS_DIR, name)
+    tmp = f"{final}.tmp{os.getpid()}"
+    shutil.rmtree(tmp, ignore_errors=True)
+    os.makedirs(tmp)
+    try:
+        if isinstance(recognizer, NumpyLBPH):
+            fmt = "binary"
+            recognizer.write_binary(os.path.join(tmp, "model.lbpb"), inv)
+        else:
+            fmt = "yaml"
+            recognizer.write(os.path.join(tmp, "lbph_model.yml"))
+            with open(os.path.join(tmp, "labels.txt"), "w", encoding="utf-8") as f:
+                for lab in sorted(inv.keys()):
+                    f.write(f"{lab}\t{inv[lab]}\n")
+        shutil.rmtree(final, ignore_errors=True)   # sobra de uma queda anterior
+        os.replace(tmp, final)
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+
+    pointer = json.dumps({"version": version, "dir": name, "format": fmt,
+                          "built_at": time.strftime("%Y-%m-%d %H:%M:%S"),
+                          "users_stamp": users_stamp})
+    def _write(path):
+        with open(path, "w", encoding="utf-8") as f:
+            f.write(pointer)
+    _atomic_replace_write(MODEL_CURRENT_PATH, _write)
+    _prune_artifacts(keep=name)
+    return version
+
+def _prune_artifacts(keep: str) -> None:
+    try:
+        names = sorted(n for n in os.listdir(MODELS_DIR) if n.startswith("v") and n[1:].isdigit())
+    except OSError:
+        return
+    for n in names[:-MODEL_KEEP_VERSIONS]:
+        if n != keep:
+            shutil.rmtree(os.path.join(MODELS_DIR, n), ignore_errors=True)
+
+# ------------------------ Modelo residente em memória -----------------------
+def _stamp_key(stamp) -> str:
+    """db.users_stamp() em forma comparável e gravável em current.json."""
+    return json.dumps(stamp)
+
+class _StaleArtifact(RuntimeError):
+    """persist() de um modelo mais antigo que o publicado por outro processo."""
+
+class _RecognizerHolder:
+    """
+    Mantém o reconhecedor LBPH e o seu mapa label -> nome carregados uma única
+    vez por processo. train_model() publica uma instância nova trocando só a
+    referência, então predições em andamento seguem com a instância antiga,
+    sempre completa. add() faz o mesmo (copy-on-write: acrescenta numa cópia
+    e troca a referência), então predict não precisa de lock; persist() grava
+    o estado atual como nova versão (chamado pelo worker de treino).
+    Com vários processos, current.json é vigiado (ChangeWatcher): quando outro
+    worker publica, get() recarrega a versão nova, a menos que este processo
+    tenha incrementos ainda não gravados; aí persist() detecta o conflito e o
+    worker de treino faz um rebuild, que junta as amostras dos dois lados.
+    users_stamp é o estado do cadastro lido pelo último rebuild (incrementos
+    não o avançam: só um rebuild garante que o modelo cobre o cadastro todo).
+    """
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._recognizer = None
+        self._labels = {}
+        self._version = None
+        self._updates = 0      # amostras incrementais aplicadas desde o início
+        self._saved_updates = 0
+        self._labels_rev = 0   # muda sempre que o mapa de labels muda
+        self._users_stamp = None
+        self._watch = ChangeWatcher(MODEL_CURRENT_PATH)
+
+    def get(self):
+        rec = self._recognizer
+        if rec is not None and not self._watch.changed():
+            return rec
+        with self._lock:
+            if self._recognizer is not None:
+                art = current_artifact()
+                if (art is None or art["version"] == self._version
+                        or self._updates != self._saved_updates):
+                    return self._recognizer
+                self._recognizer = None     # outro worker publicou: recarrega
+            if self._recognizer is None:
+                art = current_artifact()
+                if art is not None and os.path.exists(art["model"]):
+                    rec = get_recognizer()
+                    if art["format"] == "binary":
+                        if not isinstance(rec, NumpyLBPH):
+                            # cv2 LBPH não aceita histogramas prontos: o
+                            # chamador re-treina (a partir do FeatureStore)
+                            return None
+                        labels = rec.read_binary(art["model"])
+                    else:
+                        rec.read(art["model"])
+                        labels = _read_label_file(art["labels"])
+                    self._labels = labels
+                    self._labels_rev += 1
+                    self._version = art["version"]
+                    self._users_stamp = art.get("users_stamp")
+                    self._saved_updates = self._updates
+                    self._recognizer = rec
+            return self._recognizer
+
+    def recheck(self) -> None:
+        """Próximo get() confere current.json já, sem esperar o intervalo do ChangeWatcher."""
+        self._watch.recheck()
+
+    @property
+    def version(self):
+        return self._version
+
+    @property
+    def updates(self) -> int:
+        return self._updates
+
+    @property
+    def labels_rev(self) -> int:
+        return self._labels_rev
+
+    @property
+    def users_stamp(self):
+        return self._users_stamp
+
+    def labels(self) -> dict:
+        with self._lock:
+            return dict(self._labels)
+
+    def label_name(self, label):
+        return self._labels.get(label)
+
+    def publish(self, recognizer, labels: dict, version, users_stamp: str = None) -> None:
+        with self._lock:
+            self._recognizer = recognizer
+            self._labels = dict(labels)
+            self._labels_rev += 1
+            self._version = version
+            self._users_stamp = users_stamp
+            self._saved_updates = self._updates
+            self._watch.mark()
+
+    def predict(self, roi):
+        # sem lock: a instância publicada nunca é alterada depois de publicada
+        rec = self.get()
+        if rec is None:
+            return None, None
+        return rec.predict(roi)
+
+    def predict_batch(self, rois):
+        rec = self.get()
+        if rec is None:
+            return [(None, None)] * len(rois)
+        if isinstance(rec, NumpyLBPH):
+            return rec.predict_batch(rois)
+        return [rec.predict(roi) for roi in rois]
+
+    def add(self, name: str, images, hists=None) -> bool:
+        """Acrescenta amostras de 'name' ao modelo vivo (só memória). False se não há modelo."""
+        with self._lock:
+            rec = self.get()
+            if rec is None:
+                return False
+            key = name.strip().lower()
+            labels_map = self._labels
+            label = next((lab for lab, nm in labels_map.items() if nm.strip().lower() == key), None)
+            if label is None:
+                label = max(labels_map.keys(), default=-1) + 1
+                labels_map = {**labels_map, label: name}   # mapa novo: label_name() lê sem lock
+            labels = [label] * len(images)
+            rec = _fork_recognizer(rec)
+            if hists is not None and isinstance(rec, NumpyLBPH):
+                rec.update_histograms(hists, labels)
+            else:
+                rec.update(images, np.array(labels))
+            if labels_map is not self._labels:
+                self._labels = labels_map
+                self._labels_rev += 1
+            self._recognizer = rec
+            self._updates += 1
+            return True
+
+    def persist(self):
+        """
+        Grava o modelo vivo (com os incrementos) como nova versão.
+        _StaleArtifact se outro processo publicou depois da versão carregada
+        aqui (gravar por cima perderia as amostras dele).
+        """
+        with self._lock:
+            rec = self.get()
+            if rec is None:
+                return None
+            with _MODELS_LOCK:
+                cur = current_artifact()
+                if cur is not None and cur["version"] != self._version:
+                    raise _StaleArtifact(f"versão publicada {cur['version']} != carregada {self._version}")
+                self._version = _write_artifact(rec, self._labels, self._users_stamp)
+            self._saved_updates = self._updates
+            self._watch.mark()
+            return self._version
+
+def _fork_recognizer(rec):
+    """Cópia do reconhecedor para add() alterar sem afetar quem ainda o usa."""
+    if isinstance(rec, NumpyLBPH):
+        return rec.fork()
+    # cv2.face não tem cópia: ida e volta pelo YAML (só no cadastro incremental)
+    os.makedirs(MODELS_DIR, exist_ok=True)
+    tmp = os.path.join(MODELS_DIR, f"fork{os.getpid()}_{threading.get_ident()}.yml")
+    try:
+        rec.write(tmp)
+        other = get_recognizer("opencv")
+        other.read(tmp)
+        return other
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+
+_RECOGNIZER = _RecognizerHolder()
+
+# ------------------------- Worker de treino ---------------------------------
+class TrainingWorker:
+    """
+    Thread única que executa os builds do modelo fora do request.
+    submit("persist") grava o modelo vivo após cadastros incrementais;
+    submit("rebuild") roda train_model() completo. Pedidos que chegam dentro
+    de TRAIN_COALESCE_SEC (ou enquanto um build roda) são coalescidos num só
+    build, e um "rebuild" absorve "persist" pendentes. wait(ticket) bloqueia
+    até o build que cobre aquele pedido terminar.
+    """
+    _RANK = {"persist": 1, "rebuild": 2}
+
+    def __init__(self, coalesce_sec: float = None):
+        self.coalesce_sec = TRAIN_COALESCE_SEC if coalesce_sec is None else coalesce_sec
+        self._cond = threading.Condition()
+        self._thread = None
+        self._pending = None      # tipo do próximo build
+        self._queued = 0          # pedidos aguardando
+        self._requested = 0       # último ticket emitido
+        self._done = 0            # último ticket atendido (com ou sem sucesso)
+        self._ok = 0              # último ticket atendido com sucesso
+        self._building = False
+        self._build_upto = 0      # ticket coberto pelo build em andamento
+        self._build_stamp = None  # estado do cadastro que o rebuild em andamento já vai ler
+        self._last = {"kind": None, "duration_sec": None, "finished_at": None, "error": None}
+
+    def submit(self, kind: str = "rebuild") -> int:
+        with self._cond:
+            if self._pending is None or self._RANK[kind] > self._RANK[self._pending]:
+                self._pending = kind
+            self._queued += 1
+            self._requested += 1
+            ticket = self._requested
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name="training-worker", daemon=True)
+                self._thread.start()
+            self._cond.notify_all()
+            return ticket
+
+    def wait(self, ticket: int, timeout: float = None) -> bool:
+        """True se o build que cobre 'ticket' terminou com sucesso dentro do prazo."""
+        timeout = TRAIN_WAIT_SEC if timeout is None else timeout
+        with self._cond:
+            self._cond.wait_for(lambda: self._done >= ticket, timeout=timeout)
+            return self._ok >= ticket
+
+    def ensure_current(self, timeout: float = None):
+        """
+        Single-flight para "o modelo cobre o cadastro atual?" (login que não
+        reconheceu, p.ex. logo após um cadastro). None, na hora, se o modelo
+        publicado (em memória ou em disco) veio de um rebuild com o mesmo
+        users_stamp() de agora: nada a refazer. Senão entra no rebuild em
+        andamento se ele já lê esse estado, ou pede um (coalescido com os demais
+        pedidos), e retorna True/False conforme o build terminou com sucesso.
+        """
+        from db import users_stamp  # import tardio
+        stamp = _stamp_key(users_stamp())
+        if _RECOGNIZER.get() is not None and _RECOGNIZER.users_stamp == stamp:
+            return None
+        with self._cond:
+            if self._building and self._build_stamp == stamp:
+                ticket = self._build_upto
+            else:
+                ticket = None
+        if ticket is None:
+            ticket = self.submit("rebuild")
+        return self.wait(ticket, timeout)
+
+    def status(self) -> dict:
+        with self._cond:
+            return {
+                "version": _RECOGNIZER.version,
+                "queue_depth": self._queued,
+                "building": self._building,
+                "last_kind": self._last["kind"],
+                "last_build_sec": self._last["duration_sec"],
+                "last_build_at": self._last["finished_at"],
+                "last_error": self._last["error"],
+            }
+
+    def _run(self) -> None:
+        while True:
+            with self._cond:
+                self._cond.wait_for(lambda: self._pending is not None)
+                deadline = time.monotonic() + self.coalesce_sec
+                while (left := deadline - time.monotonic()) > 0:
+                    self._cond.wait(timeout=left)     # junta pedidos da janela
+                kind, upto = self._pending, self._requested
+                self._pending, self._queued, self._building = None, 0, True
+                self._build_upto = upto
+                self._build_stamp = None
+
+            if kind == "rebuild":
+                try:
+                    from db import users_stamp  # import tardio
+                    stamp = _stamp_key(users_stamp())
+                except Exception:
+                    stamp = None
+                with self._cond:
+                    self._build_stamp = stamp
+
+            t0 = time.perf_counter()
+            error = None
+            try:
+                if kind == "rebuild":
+                    ok = bool(train_model())
+                else:
+                    try:
+                        ok = _RECOGNIZER.persist() is not None
+                    except _StaleArtifact:
+                        ok = bool(train_model())   # reconstrói a partir do DB compartilhado
+            except Exception as e:
+                ok, error = False, str(e)
+
+            with self._cond:
+                self._building = False
+                self._build_stamp = None
+                self._done = upto
+                if ok:
+                    self._ok = upto
+                self._last = {"kind": kind, "duration_sec": round(time.perf_counter() - t0, 4),
+                              "finished_at": time.strftime("%Y-%m-%d %H:%M:%S"),
+                              "error": error if error or ok else "build sem amostras"}
+                self._cond.notify_all()
+
+TRAINER = TrainingWorker()
+
+# ------------------------- Cache de features --------------------------------
+def _resolve_sample_path(path):
+    """Caminho absoluto existente para 'path' (relativo faces/… ou absoluto), ou None."""
+    if not path:
+        return None
+
+    # aceita relativo (faces/…) e absoluto
+    path_abs = _to_abs(path)
+    if not os.path.exists(path_abs):
+        # fallback para barras invertidas etc.
+        alt = _to_abs(path.replace("\\", "/"))
+        if not os.path.exists(alt):
+            return None
+        path_abs = alt
+    return path_abs
+
+def _prep_sample(img: np.ndarray) -> np.ndarray:
+    """Mesmo pré-processamento do treino sobre uma amostra em cinza."""
+    # se estiver fora do padrão, normaliza
+    if img.shape != (200, 200):
+        img = cv2.resize(img, (200, 200))
+    img = _clahe(img)
+    img = _norm_0_255(img)
+    return img
+
+def _load_sample(path):
+    """
+    Lê uma amostra de faces/ (relativo ou absoluto) e aplica o mesmo
+    pré-processamento do treino. Retorna ROI 200x200 ou None.
+    """
+    path_abs = _resolve_sample_path(path)
+    if path_abs is None:
+        return None
+    img = cv2.imread(path_abs, cv2.IMREAD_GRAYSCALE)
+    if img is None:
+        return None
+    return _prep_sample(img)
+
+class FeatureStore:
+    """
+    ROI pré-processada + histograma LBP de cada amostra, calculados uma vez
+    (em save_face_image) e reaproveitados no treino e no cadastro incremental.
+
+    Em disco (FEATURES_DIR):
+      - samples.<gen>.bin : registros de tamanho fixo (hist float32 + ROI uint8),
+                            só acrescentados no fim e lidos via np.memmap;
+      - index.jsonl       : 1ª linha = metadados (parâmetros LBPH, arquivo de
+                            dados); depois uma linha por amostra
+                            {path, row, mtime_ns, size}. A última linha vale.
+    Uma entrada fica obsoleta quando o PNG muda (mtime/tamanho) e é recalculada
+    no próximo get(). compact() descarta linhas mortas gravando uma nova
+    geração de dados antes de trocar o índice, então uma queda no meio nunca
+    deixa índice e dados desencontrados.
+    """
+    ROI_SHAPE = (200, 200)
+
+    def __init__(self, root: str = FEATURES_DIR):
+        self.root = root
+        self._lock = threading.RLock()
+        self._flock = FileLock(os.path.join(root, "index"))   # escrita entre processos
+        self._index = None      # rel_path -> entrada
+        self._meta = None
+        self._rows = 0
+        self._mm = None
+        self._pos = 0           # bytes do index.jsonl já lidos
+        self._ino = None        # muda quando outro processo troca o índice
+
+    # --- formato ---
+    def _params(self) -> dict:
+        return {"version": 1, "radius": LBPH_RADIUS, "neighbors": LBPH_NEIGHBORS,
+                "grid_x": LBPH_GRID_X, "grid_y": LBPH_GRID_Y, "roi": list(self.ROI_SHAPE)}
+
+    def _dtype(self) -> np.dtype:
+        dim = LBPH_GRID_X * LBPH_GRID_Y * (1 << LBPH_NEIGHBORS)
+        return np.dtype([("hist", np.float32, (dim,)), ("roi", np.uint8, self.ROI_SHAPE)])
+
+    @property
+    def _index_path(self) -> str:
+        return os.path.join(self.root, "index.jsonl")
+
+    @property
+    def _data_path(self) -> str:
+        return os.path.join(self.root, self._meta["data"])
+
+    @staticmethod
+    def _key(path: str) -> str:
+        return (path or "").replace("\\", "/").strip()
+
+    # --- carga / reset ---
+    def _load(self) -> None:
+        """
+        Primeira chamada: lê o índice inteiro. Depois, um stat por chamada:
+        se outro worker só acrescentou linhas, lê apenas o final; se trocou o
+        arquivo (compact/reset), recarrega tudo.
+        """
+        if self._index is not None:
+            try:
+                st = os.stat(self._index_path)
+            except OSError:
+                st = None
+            if st is not None and st.st_ino == self._ino and st.st_size >= self._pos:
+                if st.st_size > self._pos:
+                    self._read_tail()
+                return
+            self._index = None
+        os.makedirs(self.root, exist_ok=True)
+        with self._flock:
+            self._load_full()
+
+    @staticmethod
+    def _parse_lines(chunk: bytes):
+        for line in chunk.splitlines():
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                yield json.loads(line)
+            except ValueError:
+                continue    # linha truncada por queda no meio da escrita
+
+    def _read_tail(self) -> None:
+        with open(self._index_path, "rb") as f:
+            f.seek(self._pos)
+            chunk = f.read()
+        end = chunk.rfind(b"\n") + 1      # só linhas completas
+        for e in self._parse_lines(chunk[:end]):
+            self._index[e["path"]] = e
+        self._pos += end
+        rows = os.path.getsize(self._data_path) // self._dtype().itemsize
+        if rows != self._rows:
+            self._rows, self._mm = rows, None
+
+    def _load_full(self) -> None:
+        meta, index, pos, ino = None, {}, 0, None
+        try:
+            with open(self._index_path, "rb") as f:
+                ino = os.fstat(f.fileno()).st_ino
+                chunk = f.read()
+            pos = chunk.rfind(b"\n") + 1
+            for i, e in enumerate(self._parse_lines(chunk[:pos])):
+                if i == 0:
+                    meta = e
+                else:
+                    index[e["path"]] = e
+        except (OSError, ValueError, KeyError):
+            meta = None
+
+        if not meta or {k: meta.get(k) for k in self._params()} != self._params():
+            self._reset(gen=int((meta or {}).get("gen", 0)) + 1)
+            return
+
+        self._meta = meta
+        itemsize = self._dtype().itemsize
+        size = os.path.getsize(self._data_path) if os.path.exists(self._data_path) else 0
+        rows = size // itemsize
+        if size != rows * itemsize:
+            # registro parcial no fim (queda durante append): descarta
+            with open(self._data_path, "r+b") as f:
+                f.truncate(rows * itemsize)
+        self._rows = rows
+        self._index = {k: e for k, e in index.items() if 0 <= int(e.get("row", -1)) < rows}
+        self._mm = None
+        self._pos, self._ino = pos, ino
+
+    def _mark_index(self) -> None:
+        """Depois de reescrever o índice: o que está em disco já está em memória."""
+        st = os.stat(self._index_path)
+        self._pos, self._ino = st.st_size, st.st_ino
+
+    def _reset(self, gen: int) -> None:
+        self._meta = dict(self._params(), gen=gen, data=f"samples.{gen}.bin")
+        open(self._data_path, "wb").close()
+        meta_line = json.dumps(self._meta) + "\n"
+        def _write(tmp):
+            with open(tmp, "w", encoding="utf-8") as f:
+                f.write(meta_line)
+        _atomic_replace_write(self._index_path, _write)
+        self._index, self._rows, self._mm = {}, 0, None
+        self._mark_index()
+
+    def _records(self):
+        if self._mm is None and self._rows:
+            self._mm = np.memmap(self._data_path, dtype=self._dtype(), mode="r", shape=(self._rows,))
+        return self._mm
+
+    # --- escrita ---
+    def _append(self, key: str, path_abs: str, roi: np.ndarray, hist: np.ndarray) -> None:
+        st = os.stat(path_abs)
+        rec = np.zeros(1, dtype=self._dtype())
+        rec["hist"][0] = hist
+        rec["roi"][0] = roi
+        with self._flock:
+            # outro worker pode ter acrescentado ou compactado: a linha vem do
+            # tamanho real do arquivo de dados, não do contador local
+            self._load()
+            with open(self._data_path, "ab") as f:
+                row = os.fstat(f.fileno()).st_size // rec.itemsize
+                f.write(rec.tobytes())
+            entry = {"path": key, "row": row, "mtime_ns": st.st_mtime_ns, "size": st.st_size}
+            line = (json.dumps(entry, ensure_ascii=False) + "\n").encode("utf-8")
+            with open(self._index_path, "ab") as f:
+                f.write(line)
+            self._pos += len(line)
+        self._rows = row + 1
+        self._index[key] = entry
+        self._mm = None     # remapeia no próximo acesso
+
+    def put(self, path: str, roi_raw: np.ndarray):
+        """Registra a amostra recém-gravada em 'path'. Retorna (roi, hist)."""
+        path_abs = _resolve_sample_path(path)
+        if path_abs is None:
+            return None, None
+        roi = _prep_sample(roi_raw)
+        hist = lbp_histogram(roi)
+        with self._lock:
+            self._load()
+            self._append(self._key(path), path_abs, roi, hist)
+        return roi, hist
+
+    # --- leitura ---
+    def get(self, path: str):
+        """
+        (roi, hist) da amostra; recalcula a partir do PNG se faltar no cache ou
+        se o arquivo mudou. (None, None) se a imagem não existe/não abre.
+        """
+        path_abs = _resolve_sample_path(path)
+        if path_abs is None:
+            return None, None
+        key = self._key(path)
+        with self._lock:
+            self._load()
+            e = self._index.get(key)
+            if e is not None:
+                st = os.stat(path_abs)
+                if e["mtime_ns"] == st.st_mtime_ns and e["size"] == st.st_size:
+                    rec = self._records()[int(e["row"])]
+                    return rec["roi"], rec["hist"]
+
+            roi = _load_sample(path_abs)
+            if roi is None:
+                return None, None
+            hist = lbp_histogram(roi)
+            self._append(key, path_abs, roi, hist)
+            return roi, hist
+
+    def compact(self, keep_paths) -> None:
+        """Mantém só as amostras em 'keep_paths'; reescreve apenas se houver lixo."""
+        keep = {self._key(p) for p in keep_paths if p}
+        with self._lock, self._flock:
+            self._load()
+            live = [e for k, e in self._index.items() if k in keep]
+            if len(live) == self._rows:
+                return
+            old_data = self._data_path
+            old_recs = self._records()
+            gen = int(self._meta.get("gen", 0)) + 1
+            meta = dict(self._params(), gen=gen, data=f"samples.{gen}.bin")
+            new_index = []
+            with open(os.path.join(self.root, meta["data"]), "wb") as f:
+                for row, e in enumerate(sorted(live, key=lambda x: int(x["row"]))):
+                    f.write(old_recs[int(e["row"])].tobytes())
+                    new_index.append(dict(e, row=row))
+
+            def _write(tmp):
+                with open(tmp, "w", encoding="utf-8") as f:
+                    f.write(json.dumps(meta) + "\n")
+                    for e in new_index:
+                        f.write(json.dumps(e, ensure_ascii=False) + "\n")
+            _atomic_replace_write(self._index_path, _write)
+
+            self._meta, self._rows, self._mm = meta, len(new_index), None
+            self._index = {e["path"]: e for e in new_index}
+            self._mark_index()
+            old_recs = None
+            try:
+                os.remove(old_data)
+            except OSError:
+                pass    # Windows: ainda mapeado por alguém; fica para a próxima
+
+FEATURE_STORE = FeatureStore()
+
 # ------------------------------- Treino ------------------------------------
 def train_model():
     """
-    Treina o LBPH a partir das imagens cadastradas no DB.
-    Aceita 'image_path' relativo (faces/…) ou absoluto.
-    Salva labels.txt (label -> name).
+    Treina o LBPH a partir das imagens cadastradas no DB (rebuild completo),
+    usando todas as amostras de cada usuário com o mesmo label.
+    Aceita caminhos relativos (faces/…) ou absolutos.
+    Publica modelo + labels (label -> name) como nova versão em models/.
+    Síncrono: no app, peça via TRAINER.submit("rebuild").
+    Para cadastros novos prefira add_sample(); isto fica como manutenção.
     """
-    from db import get_users  # import tardio para evitar ciclos
+    from db import get_users, user_samples, users_stamp  # import tardio para evitar ciclos
+    seen_updates = _RECOGNIZER.updates
+    stamp = _stamp_key(users_stamp())   # lido antes: o build cobre pelo menos este estado
     users = get_users()
     if not users:
         return False
 
-    images, labels = [], []
+    images, hists, labels, used = [], [], [], []
     label_map = {}   # name -> label
     next_label = 0
 
     for u in users:
-        path = u.get("image_path")
-        if not path:
-            continue
-
-        # aceita relativo (faces/…) e absoluto
-        path_abs = _to_abs(path)
-        if not os.path.exists(path_abs):
-            # fallback para barras invertidas etc.
-            alt = _to_abs(path.replace("\\", "/"))
-            if os.path.exists(alt):
-                path_abs = alt
-            else:
-                continue
-
-        img = cv2.imread(path_abs, cv2.IMREAD_GRAYSCALE)
-        if img is None:
-            continue
-
-        # se estiver fora do padrão, normaliza
-        if img.shape != (200, 200):
-            img = cv2.resize(img, (200, 200))
-        img = _clahe(img)
-        img = _norm_0_255(img)
-
         # normaliza label por nome
         name = (u.get("name") or "").strip() or "user"
-        if name not in label_map:
-            label_map[name] = next_label
-            next_label += 1
 
-        images.append(img)
-        labels.append(label_map[name])
+        for path in user_samples(u):
+            img, hist = FEATURE_STORE.get(path)
+            if img is None:
+                continue
+
+            if name not in label_map:
+                label_map[name] = next_label
+                next_label += 1
+
+            images.append(img)
+            hists.append(hist)
+            labels.append(label_map[name])
+            used.append(path)
 
     if not images:
         return False
 
     recognizer = get_recognizer()
-    recognizer.train(images, np.array(labels))
-    recognizer.write(MODEL_PATH)
+    if isinstance(recognizer, NumpyLBPH):
+        recognizer.train_histograms(np.stack(hists), labels)
+    else:
+        recognizer.train(images, np.array(labels))
+    FEATURE_STORE.compact(used)
 
-    # grava o mapa label -> name
+    # modelo + mapa label -> name numa versão só
     inv = {lab: nm for nm, lab in label_map.items()}
-    with open(LABELS_PATH, "w", encoding="utf-8") as f:
-        for lab in sorted(inv.keys()):
-            f.write(f"{lab}\t{inv[lab]}\n")
+    version = _write_artifact(recognizer, inv, stamp)
+
+    # troca atômica: próximos predict já usam o modelo novo, sem reler o YAML
+    _RECOGNIZER.publish(recognizer, inv, version, stamp)
+    if _RECOGNIZER.updates != seen_updates:
+        # cadastros incrementais chegaram durante o build e ficaram de fora
+        TRAINER.submit("rebuild")
     return True
 
+def add_sample(name: str, image_path: str) -> bool:
+    """
+    Caminho incremental do cadastro: processa só a amostra nova e a acrescenta
+    ao modelo vivo via LBPH update (custo independe do tamanho da galeria).
+    A gravação em disco fica com o worker (coalescida). Se ainda não existe
+    modelo, cai no train_model() completo.
+    """
+    img, hist = FEATURE_STORE.get(image_path)
+    if img is None:
+        return False
+
+    if _RECOGNIZER.get() is None:
+        return train_model()
+
+    name = (name or "").strip() or "user"
+    ok = _RECOGNIZER.add(name, [img], hists=[hist])
+    if ok:
+        TRAINER.submit("persist")
+    return ok
+
+def backfill_user_samples() -> int:
+    """
+    Liga ao cadastro as capturas antigas que ficaram só em faces/ (arquivos
+    <nome>_L<n>_<ts>.png gravados por save_face_image). Retorna quantos
+    usuários ganharam amostras.
+    """
+    from db import get_users, merge_user_samples
+    try:
+        files = sorted(os.listdir(FACES_DIR_ABS))
+    except OSError:
+        return 0
+    changed = 0
+    for u in get_users():
+        # só o nome exato: "Jo" não pode levar as capturas de "Jo_Lima"
+        pattern = re.compile(rf"{re.escape(_safe_name(u.get('name') or ''))}_L\d+_\d+\.png")
+        found = [os.path.join(FACES_DIR_REL, f).replace("\\", "/")
+                 for f in files if pattern.fullmatch(f)]
+        if found and merge_user_samples(u.get("name", ""), found):
+            changed += 1
+    return changed
+
 def load_label_map():
-    lm = {}
-    if not os.path.exists(LABELS_PATH):
-        return lm
-    with open(LABELS_PATH, "r", encoding="utf-8") as f:
-        for line in f:
-            line = line.strip()
-            if not line:
-                continue
-            lab, name = line.split("\t", 1)
-            lm[int(lab)] = name
-    return lm
+    """Mapa label -> nome do modelo em uso (o mesmo carregado para predição)."""
+    if _RECOGNIZER.get() is not None:
+        return _RECOGNIZER.labels()
+    art = current_artifact()
+    return _read_label_file(art["labels"]) if art else {}
+
+def convert_yaml_model(yaml_path: str = None, labels_path: str = None, out_path: str = None,
+                       dtype: str = None):
+    """
+    Converte um modelo YAML do cv2.face LBPH (+ labels.txt) para o formato
+    binário. Com out_path, só grava o arquivo e retorna o caminho; sem
+    caminhos, converte o modelo publicado e o publica como nova versão
+    (retorna o número da versão, ou None se já era binário / não há modelo).
+    """
+    if yaml_path is None:
+        art = current_artifact()
+        if not art or art["format"] == "binary":
+            return None
+        yaml_path, labels_path = art["model"], art["labels"]
+    rec = NumpyLBPH()
+    rec.read(yaml_path)
+    inv = _read_label_file(labels_path)
+    if out_path:
+        rec.write_binary(out_path, inv, dtype)
+        return out_path
+    version = _write_artifact(rec, inv)
+    if isinstance(get_recognizer(), NumpyLBPH):
+        _RECOGNIZER.publish(rec, inv, version)
+    return version
+
+# ------------------------ Diretório de identidades --------------------------
+class _IdentityDirectory:
+    """
+    label -> {"name", "level", "samples"} em memória para o caminho do login.
+    Combina o mapa de labels do modelo residente com o índice de usuários do
+    db.py; o memo é descartado quando qualquer um dos dois muda (versão do
+    modelo / revisão dos labels / users_stamp()).
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._stamp = None
+        self._by_label = {}
+
+    def lookup(self, label):
+        from db import users_stamp, get_user_by_name, user_samples  # import tardio
+        if label is None or _RECOGNIZER.get() is None:
+            return None
+        stamp = (_RECOGNIZER.version, _RECOGNIZER.labels_rev, users_stamp())
+        with self._lock:
+            if stamp != self._stamp:
+                self._by_label, self._stamp = {}, stamp
+            if label in self._by_label:
+                return self._by_label[label]
+        name = _RECOGNIZER.label_name(label)
+        ident = None
+        if name is not None:
+            u = get_user_by_name(name)
+            ident = {
+                "name": u.get("name", name) if u else name,
+                "level": int(u.get("level", 1)) if u else 1,
+                "samples": user_samples(u) if u else [],
+            }
+        with self._lock:
+            if self._stamp == stamp:
+                self._by_label[label] = ident
+        return ident
+
+_IDENTITIES = _IdentityDirectory()
+
+def lookup_identity(label):
+    """{"name", "level", "samples"} do label predito, ou None se desconhecido."""
+    return _IDENTITIES.lookup(label)
 
 # ------------------------------ Predição ------------------------------------
-def predict_face(img_bgr):
+def warm_up() -> None:
+    """Carrega detectores e o modelo publicado agora (ex.: processos do pool de visão)."""
+    for endpoint in ("verify", "liveness"):
+        get_detector(detector_for(endpoint))
+    try:
+        _RECOGNIZER.get()
+    except Exception:
+        pass    # sem modelo ainda: a primeira predição treina
+
+def sync_model() -> None:
     """
-    Prediz (label, confidence, bbox) para o maior rosto detectado.
-    Se não houver modelo, tenta treinar. Se nada der, retorna (None, None, None).
+    Para processos que só predizem: a próxima predição já confere se outro
+    processo publicou um modelo novo (um stat), em vez de esperar STORAGE_POLL_SEC.
+    """
+    _RECOGNIZER.recheck()
+
+def predict_face(img_bgr, detector=None):
     """
-    roi, bbox = detect_face(img_bgr)
+    Prediz (label, confidence, bbox) para o maior rosto detectado (ndarray ou
+    FrameContext; com contexto, uma nova chamada no mesmo frame não detecta de novo).
+    Usa o modelo residente em memória; se não houver modelo, tenta treinar.
+    Se nada der, retorna (None, None, None).
+    """
+    roi, bbox = detect_face(img_bgr, detector=detector)
     if roi is None:
         return None, None, None
 
-    recognizer = get_recognizer()
-    if not os.path.exists(MODEL_PATH):
+    if _RECOGNIZER.get() is None:
         ok = train_model()
         if not ok:
             return None, None, bbox
 
-    recognizer.read(MODEL_PATH)
-    label, confidence = recognizer.predict(roi)
+    label, confidence = _RECOGNIZER.predict(roi)
     return label, float(confidence), bbox
 
+def predict_faces(images_bgr, detector=None):
+    """
+    Versão em lote de predict_face: detecta em cada imagem e reconhece todas
+    as ROIs de uma vez com o mesmo modelo carregado (no motor "numpy", uma
+    única matriz de distâncias). Retorna [(label, confidence, bbox)] na ordem
+    de entrada, com a mesma convenção de None de predict_face. Com
+    detector "tracked" o lote é tratado como um fluxo só.
+    """
+    det = get_detector(detector)
+    dets = [detect_face(img, detector=det) for img in images_bgr]
+    results = [(None, None, bbox) for _, bbox in dets]
+    found = [i for i, (roi, _) in enumerate(dets) if roi is not None]
+    if not found:
+        return results
+
+    if _RECOGNIZER.get() is None:
+        ok = train_model()
+        if not ok:
+            return results
+
+    preds = _RECOGNIZER.predict_batch([dets[i][0] for i in found])
+    for i, (label, confidence) in zip(found, preds):
+        if label is not None:
+            results[i] = (label, float(confidence), dets[i][1])
+    return results
+
 # ------------------------------ Cadastro ------------------------------------
-def save_face_image(name: str, img_bgr, level: int):
+def _safe_name(name: str) -> str:
+    """Prefixo de arquivo em faces/ para o nome (mesma regra desde o início)."""
+    return "".join(c for c in name if c.isalnum() or c in ("_", "-")).strip() or "user"
+
+def save_face_image(name: str, img_bgr, level: int, detector=None):
     """
     Salva o recorte do rosto em faces/ (200x200) e retorna CAMINHO RELATIVO (faces/…png)
+    ('img_bgr' pode ser um FrameContext já usado na predição: o recorte é o mesmo)
     que é o que vai para o DB. O arquivo fisicamente fica em BASE_DIR/faces/…png
     """
     ensure_dirs()
-    roi, _ = detect_face(img_bgr)
+    roi, _ = detect_face(img_bgr, detector=detector)
     if roi is None:
         return None
 
-    safe = "".join(c for c in name if c.isalnum() or c in ("_", "-")).strip() or "user"
+    safe = _safe_name(name)
     ts = int(time.time() * 1000)
     filename = f"{safe}_L{int(level)}_{ts}.png"
 
@@ -218,4 +2145,10 @@ def save_face_image(name: str, img_bgr, level: int):
 
     # retornamos relativo (faces/arquivo.png) para guardar no DB
     rel_path = os.path.join(FACES_DIR_REL, filename).replace("\\", "/")
+
+    # features calculadas agora, para o treino não precisar reabrir o PNG
+    try:
+        FEATURE_STORE.put(rel_path, roi)
+    except Exception:
+        pass    # o cache se recompõe no próximo get()
     return rel_path
@@ -0,0 +1,167 @@
+# storage.py
+"""
+Primitivas de armazenamento seguras entre processos (vários workers do
+gunicorn sobre os mesmos arquivos):
+
+  - FileLock: lock exclusivo por arquivo "<alvo>.lock" (flock no POSIX,
+    msvcrt.locking no Windows), reentrante na mesma thread;
+  - atomic_replace_write / atomic_write_text / atomic_write_json: grava num
+    temporário da mesma pasta e troca com os.replace; leitores nunca veem
+    arquivo pela metade;
+  - ChangeWatcher: detecta que outro processo trocou um arquivo olhando
+    (mtime, tamanho, inode) no máximo a cada STORAGE_POLL_SEC, para os caches
+    em memória se renovarem sem reler o arquivo a cada requisição.
+"""
+import json
+import os
+import threading
+import time
+from typing import Any, Callable, Optional
+
+try:
+    import fcntl
+except ImportError:     # Windows
+    fcntl = None
+    import msvcrt
+
+STORAGE_POLL_SEC = 1.0   # intervalo mínimo entre dois stat() do mesmo arquivo
+
+
+# ---------------------------- Lock entre processos ----------------------------
+class FileLock:
+    """
+    Lock exclusivo sobre '<path>.lock'. Serializa processos e também threads do
+    mesmo processo; a mesma thread pode readquirir (with aninhado).
+    """
+
+    def __init__(self, path: str):
+        self.path = str(path) + ".lock"
+        self._rlock = threading.RLock()
+        self._depth = 0
+        self._fd = None
+
+    def acquire(self) -> None:
+        self._rlock.acquire()
+        if self._depth == 0:
+            try:
+                os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+                fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+                try:
+                    if fcntl is not None:
+                        fcntl.flock(fd, fcntl.LOCK_EX)
+                    else:
+                        while True:
+                            try:
+                                msvcrt.locking(fd, msvcrt.LK_LOCK, 1)
+                                break
+                            except OSError:
+                                continue    # LK_LOCK desiste após ~10 s; tenta de novo
+                except BaseException:
+                    os.close(fd)
+                    raise
+                self._fd = fd
+            except BaseException:
+                self._rlock.release()
+                raise
+        self._depth += 1
+
+    def release(self) -> None:
+        self._depth -= 1
+        if self._depth == 0:
+            fd, self._fd = self._fd, None
+            try:
+                if fcntl is not None:
+                    fcntl.flock(fd, fcntl.LOCK_UN)
+                else:
+                    os.lseek(fd, 0, os.SEEK_SET)
+                    msvcrt.locking(fd, msvcrt.LK_UNLCK, 1)
+            finally:
+                os.close(fd)
+        self._rlock.release()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc):
+        self.release()
+
+
+# ------------------------------ Escrita atômica -------------------------------
+def atomic_replace_write(path: str, writer: Callable[[str], Any]) -> None:
+    """
+    Grava em arquivo temporário na mesma pasta e troca com os.replace, para que
+    leitores nunca vejam o arquivo pela metade. 'writer(tmp_path)' faz a escrita.
+    """
+    path = str(path)
+    root, ext = os.path.splitext(path)
+    # pid + thread: dois escritores nunca compartilham o temporário;
+    # mantém a extensão (OpenCV usa p/ formato)
+    tmp = f"{root}.tmp{os.getpid()}_{threading.get_ident()}{ext}"
+    try:
+        writer(tmp)
+        os.replace(tmp, path)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+
+
+def atomic_write_text(path: str, text: str) -> None:
+    def _write(tmp):
+        with open(tmp, "w", encoding="utf-8") as f:
+            f.write(text)
+            f.flush()
+            os.fsync(f.fileno())
+    atomic_replace_write(path, _write)
+
+
+def atomic_write_json(path: str, data: Any, indent: Optional[int] = None) -> None:
+    atomic_write_text(path, json.dumps(data, ensure_ascii=False, indent=indent))
+
+
+# --------------------------- Notificação de mudança ---------------------------
+def file_signature(path: str):
+    """(mtime_ns, tamanho, inode) ou None se o arquivo não existe."""
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return (st.st_mtime_ns, st.st_size, st.st_ino)
+
+
+class ChangeWatcher:
+    """
+    changed() diz se 'path' mudou desde a última chamada que retornou True
+    (ou desde mark()). Faz no máximo um stat por STORAGE_POLL_SEC; entre um e
+    outro responde False sem tocar no disco.
+    """
+
+    def __init__(self, path: str, poll_sec: Optional[float] = None):
+        self.path = str(path)
+        self.poll_sec = STORAGE_POLL_SEC if poll_sec is None else poll_sec
+        self._sig = file_signature(self.path)
+        self._next = 0.0
+        self._lock = threading.Lock()
+
+    def mark(self) -> None:
+        """Registra o estado atual como visto (ex.: depois de gravar o arquivo)."""
+        with self._lock:
+            self._sig = file_signature(self.path)
+            self._next = time.monotonic() + self.poll_sec
+
+    def recheck(self) -> None:
+        """Faz o próximo changed() olhar o disco, sem esperar o intervalo."""
+        with self._lock:
+            self._next = 0.0
+
+    def changed(self) -> bool:
+        now = time.monotonic()
+        with self._lock:
+            if now < self._next:
+                return False
+            self._next = now + self.poll_sec
+            sig = file_signature(self.path)
+            if sig == self._sig:
+                return False
+            self._sig = sig
+            return True
@@ -0,0 +1,40 @@
+# tests/test_backfill.py
+"""
+backfill_user_samples: cada usuário só recebe as capturas com o próprio nome
+(<nome>_L<n>_<ts>.png), mesmo quando outro nome começa igual.
+"""
+import json
+import os
+import shutil
+import subprocess
+import sys
+from pathlib import Path
+
+REPO = Path(__file__).resolve().parents[1]
+MODULES = ("storage.py", "db.py", "face_utils.py")
+
+
+def test_backfill_ignores_users_sharing_a_prefix(tmp_path):
+    for name in MODULES:
+        shutil.copy(REPO / name, tmp_path / name)
+    (tmp_path / "users.json").write_text(json.dumps([
+        {"name": "Jo", "level": 1, "image_path": ""},
+        {"name": "Jo_Lima", "level": 3, "image_path": ""},
+    ]))
+    faces = tmp_path / "faces"
+    faces.mkdir()
+    roi = next((REPO / "faces").iterdir()).read_bytes()
+    for f in ("Jo_L1_1.png", "Jo_Lima_L3_2.png", "Jo_L1_x.png", "Jo_L1_3.png.bak"):
+        (faces / f).write_bytes(roi)
+
+    code = ("import json, db, face_utils as fu\n"
+            "fu.backfill_user_samples()\n"
+            "print(json.dumps([db.get_user_by_name(n)['samples'] for n in ('Jo', 'Jo_Lima')]))\n")
+    proc = subprocess.run([sys.executable, "-c", code], cwd=tmp_path, capture_output=True,
+                          text=True, timeout=120,
+                          env=dict(os.environ, PYTHONPATH=str(tmp_path),
+                                   PYTHONDONTWRITEBYTECODE="1"))
+    assert proc.returncode == 0, proc.stderr
+    jo, jo_lima = json.loads(proc.stdout.strip().splitlines()[-1])
+    assert jo == ["faces/Jo_L1_1.png"]
+    assert jo_lima == ["faces/Jo_Lima_L3_2.png"]
@@ -0,0 +1,162 @@
+# tests/test_cross_process.py
+"""
+Código que coordena vários processos (workers do gunicorn) sobre os mesmos
+arquivos: FileLock, estatísticas, leitura incremental do FeatureStore e o
+rebuild quando outro processo publicou o modelo antes.
+
+Cada teste roda numa cópia do app em tmp_path (os caminhos de dados são
+relativos aos módulos), com os processos em subprocessos de verdade.
+"""
+import os
+import shutil
+import subprocess
+import sys
+import textwrap
+from pathlib import Path
+
+import pytest
+
+REPO = Path(__file__).resolve().parents[1]
+MODULES = ("storage.py", "db.py", "face_utils.py")
+
+
+@pytest.fixture
+def sandbox(tmp_path):
+    for name in MODULES:
+        shutil.copy(REPO / name, tmp_path / name)
+    shutil.copy(REPO / "users.json", tmp_path / "users.json")
+    shutil.copytree(REPO / "faces", tmp_path / "faces")
+    return tmp_path
+
+
+def _cmd(code: str):
+    return [sys.executable, "-c", textwrap.dedent(code)]
+
+
+def _env(root: Path) -> dict:
+    return dict(os.environ, PYTHONPATH=str(root), PYTHONDONTWRITEBYTECODE="1")
+
+
+def run_py(root: Path, code: str, timeout: float = 180) -> str:
+    """Roda 'code' num processo novo dentro de 'root'; devolve o stdout."""
+    proc = subprocess.run(_cmd(code), cwd=root, env=_env(root), capture_output=True,
+                          text=True, timeout=timeout)
+    assert proc.returncode == 0, proc.stderr
+    return proc.stdout.strip()
+
+
+def run_parallel(root: Path, code: str, n: int, timeout: float = 180):
+    """'code' em n processos ao mesmo tempo (argv[1] = índice)."""
+    procs = [subprocess.Popen(_cmd(code) + [str(i)], cwd=root, env=_env(root),
+                              stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+             for i in range(n)]
+    outs = []
+    for p in procs:
+        out, err = p.communicate(timeout=timeout)
+        assert p.returncode == 0, err
+        outs.append(out.strip())
+    return outs
+
+
+def test_file_lock_serializes_processes(sandbox):
+    run_parallel(sandbox, """
+        import sys
+        from storage import FileLock, atomic_write_text
+        lock = FileLock("counter")
+        for _ in range(100):
+            with lock:
+                try:
+                    n = int(open("counter").read())
+                except FileNotFoundError:
+                    n = 0
+                atomic_write_text("counter", str(n + 1))
+    """, 4)
+    assert (sandbox / "counter").read_text() == "400"
+
+
+def test_stats_rebuilt_once_across_processes(sandbox):
+    run_py(sandbox, """
+        import db
+        for i in range(7):
+            db.log_event("auth_seed", note=str(i))
+        db.flush_logs()
+    """)
+    (sandbox / "stats.json").unlink(missing_ok=True)
+
+    # dois workers sobem sem stats.json e registram eventos ao mesmo tempo
+    run_parallel(sandbox, """
+        import sys, db
+        for i in range(10):
+            db.log_event("auth_test", note=sys.argv[1] + "-" + str(i))
+        db.flush_logs()
+    """, 2)
+
+    out = run_py(sandbox, """
+        import db
+        print(sum(r["count"] for r in db.auth_stats("hour")), len(db.get_logs()))
+    """)
+    counted, logged = map(int, out.split())
+    assert counted == logged == 27
+
+
+def test_stats_idle_worker_sees_other_process(sandbox):
+    out = run_py(sandbox, """
+        import subprocess, sys, time, db, storage
+        db.log_event("auth_seed"); db.flush_logs(); db._STATS.persist()
+        before = sum(r["count"] for r in db.auth_stats("hour"))
+        subprocess.run([sys.executable, "-c",
+                        "import db; [db.log_event('auth_test') for _ in range(3)]"], check=True)
+        time.sleep(storage.STORAGE_POLL_SEC + 0.2)    # este processo não registra nada
+        print(before, sum(r["count"] for r in db.auth_stats("hour")))
+    """)
+    before, after = map(int, out.split())
+    assert after == before + 3
+
+
+def test_feature_store_reads_tail_appended_by_other_process(sandbox):
+    faces = sorted(p.name for p in (sandbox / "faces").iterdir())
+    out = run_py(sandbox, f"""
+        import subprocess, sys
+        import face_utils as fu
+        store = fu.FeatureStore()
+        store.get("faces/{faces[0]}")
+        subprocess.run([sys.executable, "-c",
+                        "import face_utils as fu; fu.FEATURE_STORE.get('faces/{faces[1]}')"],
+                       check=True)
+        size = store._pos
+        store._load()                     # só o final novo do índice
+        grew = store._pos > size
+        roi, hist = store.get("faces/{faces[1]}")
+        fresh_roi, fresh_hist = fu.FeatureStore().get("faces/{faces[1]}")
+        print(grew, "faces/{faces[1]}" in store._index,
+              bool((hist == fresh_hist).all()), bool((roi == fresh_roi).all()))
+    """)
+    assert out == "True True True True"
+
+
+def test_stale_artifact_triggers_rebuild(sandbox):
+    faces = sorted(p.name for p in (sandbox / "faces").iterdir())
+    run_py(sandbox, "import face_utils as fu; assert fu.train_model()")
+    other = ("import face_utils as fu\n"
+             f"assert fu.add_sample('Outro Worker', 'faces/{faces[0]}')\n"
+             "assert fu.TRAINER.wait(fu.TRAINER.submit('persist'), timeout=60)\n")
+    out = run_py(sandbox, f"""
+        import subprocess, sys
+        import face_utils as fu
+        assert fu._RECOGNIZER.get() is not None
+        loaded = fu._RECOGNIZER.version
+        # incremento ainda não gravado neste worker (sem passar pelo worker de treino)
+        roi, hist = fu.FEATURE_STORE.get("faces/{faces[1]}")
+        assert fu._RECOGNIZER.add("Este Worker", [roi], hists=[hist])
+        # enquanto isso outro worker cadastra e publica uma versão nova
+        subprocess.run([sys.executable, "-c", {other!r}], check=True)
+        assert fu.current_artifact()["version"] > loaded
+        try:
+            fu._RECOGNIZER.persist()
+            stale = False
+        except fu._StaleArtifact:
+            stale = True
+        ok = fu.TRAINER.wait(fu.TRAINER.submit("persist"), timeout=120)
+        print(stale, ok, fu.current_artifact()["version"] > loaded + 1)
+    """)
+    assert out == "True True True"
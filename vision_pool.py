@@ -0,0 +1,250 @@
+# vision_pool.py
+"""
+Trabalho de visão pesado (decodificação, detecção, fluxo óptico, LBPH) fora do
+thread da requisição:
+
+  - pool de VISION_WORKERS processos, cada um com detectores e modelo já
+    carregados (warm_up); o modelo novo publicado por outro processo é visto
+    na tarefa seguinte (sync_model);
+  - vagas limitadas: VISION_MAX_PENDING tarefas por processo do app (rodando +
+    na fila) e VISION_LIMITS por grupo de rotas, para o cadastro não tomar as
+    vagas do login. Sem vaga a chamada falha na hora com Busy (429 = limite do
+    grupo, 503 = pool cheio ou sem resposta), que o app devolve com Retry-After.
+
+As tarefas recebem os bytes/base64 das imagens (baratos de enviar ao
+processo) e devolvem só números, nunca ndarrays.
+"""
+import math
+import multiprocessing
+import os
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, TimeoutError as FutureTimeout
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import contextmanager
+
+import cv2
+
+import face_utils as fu
+
+VISION_WORKERS = min(4, os.cpu_count() or 1)   # 0 = roda no próprio thread da requisição
+VISION_MAX_PENDING = 16        # tarefas aceitas ao mesmo tempo por processo do app
+VISION_LIMITS = {"verify": 8, "liveness": 8, "verify_batch": 2, "enroll": 2}
+VISION_DECODE_THREADS = 2      # threads de decodificação do burst em cada processo
+VISION_TASK_TIMEOUT = 30.0     # s; depois disso a rota responde 503
+VISION_RETRY_MAX = 30          # teto do Retry-After (s)
+
+
+class Busy(RuntimeError):
+    """Sem vaga para a tarefa: 'status' HTTP (429/503) e 'retry_after' em segundos."""
+
+    def __init__(self, status: int, retry_after: int, reason: str):
+        super().__init__(reason)
+        self.status = status
+        self.retry_after = retry_after
+
+
+# ------------------------------ Tarefas -------------------------------------
+def _analysis(ctx, detector) -> dict:
+    return _pack(ctx, *fu.predict_face(ctx, detector=detector))
+
+
+def _pack(ctx, label, conf, bbox) -> dict:
+    # nome/nível resolvidos aqui, no mesmo modelo que deu o label: o processo
+    # do app pode estar numa versão anterior (ou com outros incrementos)
+    try:
+        ident = fu.lookup_identity(label)
+    except Exception:
+        ident = None
+    return {"label": None if label is None else int(label),
+            "conf": None if conf is None else float(conf),
+            "name": ident["name"] if ident else None,
+            "level": int(ident["level"]) if ident else None,
+            "bbox": bbox,
+            "shape": tuple(ctx.shape[:2]),
+            "face_blur": ctx.blur_score(bbox) if bbox else None}
+
+
+def analyze_frame(data, detector=None) -> dict:
+    """
+    Decodifica um frame e reconhece o maior rosto: {label, conf, name, level,
+    bbox, shape, face_blur}. ValueError se a imagem não decodifica.
+    """
+    fu.sync_model()
+    return _analysis(fu.FrameContext(fu.decode_image(data)), detector)
+
+
+def analyze_first_frontal(items, detector=None):
+    """
+    items = [(índice, dados)] do mais para o menos nítido: reconhece o primeiro
+    em que o detector acha rosto (como analyze_frame, mais "frame" = índice).
+    None se nenhum tem rosto.
+    """
+    fu.sync_model()
+    for i, data in items:
+        try:
+            ctx = fu.FrameContext(fu.decode_image(data, gray=True))
+        except ValueError:
+            continue
+        if ctx.face(detector)[0] is not None:
+            return dict(_analysis(ctx, detector), frame=i)
+    return None
+
+
+def analyze_burst(frames, reduce: int = 1) -> dict:
+    """
+    Métricas de liveness de um burst: movimento (flow_score), brilho e nitidez
+    do frame do meio e a nitidez de cada frame [(nitidez, índice)], para a
+    rota escolher o frame de reconhecimento.
+    """
+    decoded = fu.decode_frames(frames, gray=True, reduce=reduce)
+    burst = [(i, fu.FrameContext(f)) for i, f in enumerate(decoded) if f is not None]
+    out = {"frames": len(burst), "flow": 0.0, "glare": 0.0, "blur": 0.0, "sharpness": []}
+    if len(burst) < 3:
+        return out
+    mid = burst[len(burst) // 2][1]
+    out.update(flow=fu.flow_score([ctx for _, ctx in burst], scale=reduce),
+               glare=mid.glare_ratio(), blur=mid.blur_score(),
+               sharpness=[(ctx.blur_score(), i) for i, ctx in burst])
+    return out
+
+
+def predict_frames(frames, detector=None):
+    """
+    predict_faces sobre os frames que decodificam: uma análise por frame (como
+    analyze_frame, mais "frame" = índice em 'frames'); None se nenhum decodifica.
+    """
+    fu.sync_model()
+    decoded = [(i, fu.FrameContext(f)) for i, f in enumerate(fu.decode_frames(frames)) if f is not None]
+    if not decoded:
+        return None
+    results = fu.predict_faces([ctx for _, ctx in decoded], detector=detector)
+    return [dict(_pack(ctx, label, conf, bbox), frame=i)
+            for (i, ctx), (label, conf, bbox) in zip(decoded, results)]
+
+
+def _ping() -> int:
+    return os.getpid()
+
+
+# ------------------------------- Execução -----------------------------------
+_POOL = None
+_POOL_LOCK = threading.Lock()
+_SLOTS_LOCK = threading.Lock()
+_inflight = {}          # grupo -> tarefas ocupando vaga
+_total = 0
+_avg_sec = 0.5          # média móvel da latência (fila + execução), base do Retry-After
+
+
+def _init_worker(decode_threads: int) -> None:
+    cv2.setNumThreads(1)    # o paralelismo vem dos processos...
+    # ...menos na decodificação do burst de liveness, que é uma tarefa só:
+    # um pool pequeno por processo (imdecode solta o GIL)
+    fu.DECODE_WORKERS = decode_threads
+    fu.warm_up()
+
+
+def _pool() -> ProcessPoolExecutor:
+    global _POOL
+    with _POOL_LOCK:
+        if _POOL is None:
+            # spawn: o app já tem threads (log, treino) e fork com threads pode travar
+            _POOL = ProcessPoolExecutor(max_workers=VISION_WORKERS,
+                                        mp_context=multiprocessing.get_context("spawn"),
+                                        initializer=_init_worker,
+                                        initargs=(VISION_DECODE_THREADS,))
+        return _POOL
+
+
+def _reset_pool(pool) -> None:
+    global _POOL
+    with _POOL_LOCK:
+        if _POOL is pool:
+            _POOL = None
+    pool.shutdown(wait=False, cancel_futures=True)
+
+
+def _retry_after() -> int:
+    return int(min(VISION_RETRY_MAX, max(1, math.ceil(_avg_sec))))
+
+
+def _acquire(group: str) -> float:
+    global _total
+    with _SLOTS_LOCK:
+        n = _inflight.get(group, 0)
+        if n >= VISION_LIMITS.get(group, VISION_MAX_PENDING):
+            raise Busy(429, _retry_after(), f"limite de '{group}' atingido ({n})")
+        if _total >= VISION_MAX_PENDING:
+            raise Busy(503, _retry_after(), f"pool de visão cheio ({_total})")
+        _inflight[group] = n + 1
+        _total += 1
+    return time.monotonic()
+
+
+def _release(group: str, t0: float) -> None:
+    global _total, _avg_sec
+    with _SLOTS_LOCK:
+        _inflight[group] -= 1
+        _total -= 1
+        _avg_sec = 0.8 * _avg_sec + 0.2 * (time.monotonic() - t0)
+
+
+@contextmanager
+def slot(group: str):
+    """
+    Ocupa uma vaga de 'group' (e do total) enquanto o bloco roda; Busy na hora
+    se não há. Serve também para trabalho que fica no processo do app (cadastro).
+    """
+    t0 = _acquire(group)
+    try:
+        yield
+    finally:
+        _release(group, t0)
+
+
+def run(group: str, fn, *args):
+    """
+    fn(*args) num processo do pool (ou no thread, com VISION_WORKERS=0),
+    ocupando uma vaga de 'group'. No pool a vaga só é devolvida quando a
+    tarefa termina de fato: depois de um timeout o processo continua ocupado,
+    e a vaga também, senão a fila interna do executor cresceria sem limite.
+    """
+    if VISION_WORKERS <= 0:
+        with slot(group):
+            return fn(*args)
+    t0 = _acquire(group)
+    pool = _pool()
+    try:
+        fut = pool.submit(fn, *args)
+    except BaseException as e:
+        _release(group, t0)
+        if isinstance(e, BrokenProcessPool):
+            _reset_pool(pool)
+            raise Busy(503, _retry_after(), "pool de visão reiniciando")
+        raise
+    fut.add_done_callback(lambda _: _release(group, t0))
+    try:
+        return fut.result(timeout=VISION_TASK_TIMEOUT)
+    except FutureTimeout:
+        fut.cancel()    # só tira da fila; se já roda, a vaga sai quando terminar
+        raise Busy(503, _retry_after(), "tarefa de visão sem resposta")
+    except BrokenProcessPool:
+        _reset_pool(pool)   # um processo morreu: o próximo pedido sobe outro pool
+        raise Busy(503, _retry_after(), "pool de visão reiniciando")
+
+
+def start() -> None:
+    """Sobe os processos já (início do app), para a 1ª requisição não pagar o spawn + carga do modelo."""
+    if VISION_WORKERS <= 0:
+        return
+    pool = _pool()
+    for fut in [pool.submit(_ping) for _ in range(VISION_WORKERS)]:
+        fut.result()
+
+
+def stats() -> dict:
+    with _SLOTS_LOCK:
+        return {"workers": VISION_WORKERS, "pending": _total,
+                "max_pending": VISION_MAX_PENDING,
+                "inflight": {g: n for g, n in _inflight.items() if n},
+                "avg_latency_sec": round(_avg_sec, 4)}